@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -42,15 +43,24 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'base.middleware.MetricsMiddleware',
+    'base.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'base.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'base.middleware.AuthenticationMiddleware',
+    'base.middleware.TokenAuthenticationMiddleware',
+    'base.middleware.AdmissionControlMiddleware',
+    'base.middleware.MessageMiddleware',
+    'base.middleware.XFrameOptionsMiddleware',
 ]
 
+# Requests under these prefixes skip the session, authentication, message
+# and clickjacking middleware. Their views must not use request.session or
+# request.user.
+LEAN_PATH_PREFIXES = ['/orders/']
+
 ROOT_URLCONF = 'api.urls'
 
 TEMPLATES = [
@@ -85,6 +95,48 @@ DATABASES = {
     }
 }
 
+# Read replicas of 'default' are added to DATABASES with
+# 'TEST': {'MIRROR': 'default'}, and their aliases listed here. Reads of
+# the models of DATABASE_REPLICA_APPS are then spread over them, except
+# for clients that wrote in the last DATABASE_PIN_SECONDS.
+DATABASE_ROUTERS = ['base.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_APPS = ['orders']
+DATABASE_PIN_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Read by every request with a Bearer token, and shared by all workers
+    # so that a revoked token is refused by every one of them
+    'token-revocations': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': 'memcached:11211',
+        'KEY_PREFIX': 'token-revocations',
+    },
+    # Shared by all workers, so that a client's token bucket does not
+    # depend on the worker that serves it. Every rate limited request reads
+    # and writes it, which must not cost a disk access.
+    'admission': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': 'memcached:11211',
+        'KEY_PREFIX': 'admission',
+    },
+    # Shared by all workers and by the reap_orders command, so that a
+    # status change made by one of them is seen by the others
+    'order-status': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': 'memcached:11211',
+        'KEY_PREFIX': 'order-status',
+        'TIMEOUT': 60,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -123,3 +175,135 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# API tokens
+
+# Seconds before an API token expires
+AUTH_TOKEN_MAX_AGE = 24 * 60 * 60
+
+# Cache alias remembering revoked tokens. It must be shared by all workers.
+AUTH_TOKEN_REVOCATION_CACHE = 'token-revocations'
+
+# Requests under these prefixes are rejected without a valid API token
+AUTH_TOKEN_REQUIRED_PREFIXES = []
+
+
+# Admission control
+
+# Limits by path prefix, the longest matching prefix applies. "rate" and
+# "burst" give each client, by API token user or else by remote address, a
+# token bucket of that many requests per second. "concurrent" routes share
+# ADMISSION_MAX_CONCURRENT slots in each worker process, and are answered
+# with 503 when all are taken. Long polls hold a slot while they wait, so
+# they share the ADMISSION_MAX_WAITING slots of the "waiting" routes
+# instead.
+ADMISSION_ROUTES = {
+    '/orders/': {'rate': 20, 'burst': 40, 'concurrent': True},
+    '/orders/uncompleted/': {'rate': 2, 'burst': 10, 'waiting': True},
+    '/orders/claim/': {'rate': 2, 'burst': 10, 'waiting': True},
+}
+
+# Per worker process, not in total. The limit keeps a worker's own threads
+# from all being busy on the concurrent routes, so it is below the uWSGI
+# threads per process, and a worker always has a thread left for the other
+# requests.
+ADMISSION_MAX_CONCURRENT = 3
+
+# Per worker process as well. A long poll can hold its thread for
+# ORDERS_MAX_WAIT seconds, whatever the rate limits, so at most this many
+# threads of a worker wait at once.
+ADMISSION_MAX_WAITING = 2
+
+# Cache alias holding the token buckets
+ADMISSION_CACHE = 'admission'
+
+
+# Metrics
+
+# Directory where each worker writes its request metrics, shared by all
+# uWSGI workers so that /metrics can report on all of them
+METRICS_DIR = os.path.join(tempfile.gettempdir(), 'api-metrics')
+
+# Fraction of requests that are measured
+METRICS_SAMPLE_RATE = 1.0
+
+# Seconds between writes of a worker's metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = 1.0
+
+
+# Orders
+
+# Seconds a train has to complete or extend the lease of an active order
+# before the reap_orders command makes the order available again
+ORDERS_LEASE_DURATION = 300
+
+# Maximum number of orders accepted by a single batch creation or status
+# request
+ORDERS_MAX_BATCH_SIZE = 500
+
+# Rows each order status count is split over, so that concurrent claims
+# and status updates seldom wait on each other's counter updates
+ORDERS_COUNTER_SHARDS = 8
+
+# Maximum number of orders claimed together for a single trip
+ORDERS_MAX_TRIP_SIZE = 50
+
+# Orders returned per page by the order listing, by default and at most
+ORDERS_PAGE_SIZE = 100
+ORDERS_MAX_PAGE_SIZE = 500
+
+# Cache alias used to serve order status reads
+ORDERS_STATUS_CACHE = 'order-status'
+
+# Longest time in seconds that uncompleted and claim requests may wait for
+# a new order. Each waiting request occupies a uWSGI worker.
+ORDERS_MAX_WAIT = 30
+
+# Dotted path to the class that wakes waiting requests when orders are
+# created. When None, PostgreSQL uses LISTEN/NOTIFY and other databases
+# fall back to an in-process notifier.
+ORDERS_NOTIFY_BACKEND = None
+
+# Seconds the first waiting request of a worker waits for the PostgreSQL
+# listener to connect. Until it does, waiting requests and event streams
+# look for changes every ORDERS_POLL_INTERVAL seconds instead.
+ORDERS_LISTEN_TIMEOUT = 2
+ORDERS_POLL_INTERVAL = 1
+
+# Dotted path to the class that delivers order status changes to event
+# streams. When None, PostgreSQL uses LISTEN/NOTIFY and other databases
+# fall back to an in-process broadcaster.
+ORDERS_BROADCAST_BACKEND = None
+
+# Maximum number of open status event streams per uWSGI worker, leaving the
+# worker's remaining threads free for other requests
+ORDERS_MAX_STREAMS = 2
+
+# Seconds between keepalive comments on idle status event streams
+ORDERS_STREAM_KEEPALIVE = 15
+
+# When True, new_order queues orders in memory and returns at once, and a
+# background thread writes them in bulk. Queued orders are not visible to
+# other requests until they are written.
+ORDERS_WRITE_BEHIND = False
+
+# Orders queued per worker before new_order starts answering 503
+ORDERS_WRITE_BEHIND_MAX_SIZE = 5000
+
+# Queued orders are written every ORDERS_WRITE_BEHIND_INTERVAL seconds, or
+# as soon as ORDERS_WRITE_BEHIND_BATCH_SIZE of them are waiting
+ORDERS_WRITE_BEHIND_BATCH_SIZE = 100
+ORDERS_WRITE_BEHIND_INTERVAL = 0.05
+
+# Number of order ids reserved from the database at a time
+ORDERS_WRITE_BEHIND_ID_BLOCK_SIZE = 100
+
+# Responses to requests with an Idempotency-Key are kept in the database
+# until the purge_idempotency_keys command deletes them, by default after
+# ORDERS_IDEMPOTENCY_KEY_MAX_AGE seconds. Each worker also keeps the most
+# recent ORDERS_IDEMPOTENCY_CACHE_SIZE of them in memory for
+# ORDERS_IDEMPOTENCY_CACHE_TTL seconds.
+ORDERS_IDEMPOTENCY_KEY_MAX_AGE = 24 * 60 * 60
+ORDERS_IDEMPOTENCY_CACHE_SIZE = 10000
+ORDERS_IDEMPOTENCY_CACHE_TTL = 300
@@ -0,0 +1,70 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_route(path):
+    # Returns (prefix, limits) of the longest ADMISSION_ROUTES prefix that
+    # matches the path, or (None, None)
+    routes = getattr(settings, "ADMISSION_ROUTES", {})
+    matches = [prefix for prefix in routes if path.startswith(prefix)]
+
+    if not matches:
+        return None, None
+
+    prefix = max(matches, key=len)
+    return prefix, routes[prefix]
+
+
+class TokenBucketLimiter:
+    # Token buckets kept in a cache shared by all workers. Each bucket is
+    # stored as the time at which it will be full again (the generic cell
+    # rate algorithm), so taking a token is one get and one set. Workers
+    # racing on the same bucket may let a few extra requests through, which
+    # is fine for shedding load.
+
+    def __init__(self, cache, clock=time.time):
+        self.cache = cache
+        self.clock = clock
+
+    def take(self, key, rate, burst):
+        # Takes a token from the bucket of `key`, which refills at `rate`
+        # tokens per second up to `burst`. Returns 0 if a token was taken,
+        # otherwise the number of seconds until one is available.
+        now = self.clock()
+        interval = 1 / rate
+
+        # The bucket is full again at full_at, missing a token per interval
+        full_at = max(self.cache.get(key, now), now)
+        wait = (full_at - now) - (burst - 1) * interval
+        if wait > 0:
+            return wait
+
+        full_at += interval
+        self.cache.set(key, full_at, timeout=math.ceil(full_at - now) + 1)
+        return 0
+
+
+class ConcurrencyLimiter:
+    # Bounds the requests running at once in this worker process. A request
+    # over the limit is turned away immediately instead of queueing. What
+    # runs out is the threads of a worker, so the slots are not shared: a
+    # busy worker turns requests away even while others are idle.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        return self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        self._semaphore.release()
+
+
+def get_limiter(clock=time.time):
+    return TokenBucketLimiter(
+        caches[getattr(settings, "ADMISSION_CACHE", "default")], clock)
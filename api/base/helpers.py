@@ -2,23 +2,26 @@ import django.http as http
 
 
 def validate_positive_int(data, include_zero=False):
-    if isinstance(data, int):
-        return True
+    # bool is a subclass of int, but true and false are not numbers here
+    if isinstance(data, bool):
+        return False
+    elif isinstance(data, int):
+        num = data
     elif not isinstance(data, str):
         return False
-
-    if include_zero:
-        return data.isdigit()
-
+    # isdigit() alone would accept digits such as "²" that int() rejects
+    elif include_zero and not data.isdigit():
+        return False
     # Catch any decimals
-    if "." in data:
+    elif "." in data:
         return False
+    else:
+        try:
+            num = int(data)
+        except ValueError:
+            return False
 
-    try:
-        num = int(data)
-        return num > 0
-    except ValueError:
-        return False
+    return num >= 0 if include_zero else num > 0
 
 
 def has_keys(keys, d):
@@ -36,4 +39,8 @@ def create_json_response(success=True, message="", status=200, data=None,
     if data is not None or empty_data:
         payload["data"] = data
 
-    return http.JsonResponse(payload, status=status)
\ No newline at end of file
+    response = http.JsonResponse(payload, status=status)
+    # Lets other formats be encoded without parsing the JSON again
+    response.payload = payload
+
+    return response
\ No newline at end of file
@@ -0,0 +1,181 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricsStore:
+    # Aggregates request metrics in memory and periodically writes them to
+    # one file per worker in `directory`. Reading merges the files of all
+    # workers, so any worker can answer for the whole uWSGI instance.
+
+    def __init__(self, directory, flush_interval=1.0, worker_id=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._worker_id = worker_id
+        self._lock = threading.Lock()
+        self._pid = None
+        self._views = {}
+        self._last_flush = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _check_fork(self):
+        # A forked worker must not report what its parent recorded
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._views = {}
+
+    def _path(self):
+        worker_id = self._worker_id or self._pid
+        return os.path.join(self.directory, "{}.json".format(worker_id))
+
+    def record(self, view, duration, queries, query_time):
+        with self._lock:
+            self._check_fork()
+
+            metrics = self._views.get(view)
+            if metrics is None:
+                metrics = self._views[view] = {
+                    "buckets": [0] * (len(BUCKETS) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                    "queries": 0,
+                    "query_seconds": 0.0,
+                }
+
+            index = 0
+            while index < len(BUCKETS) and duration > BUCKETS[index]:
+                index += 1
+
+            metrics["buckets"][index] += 1
+            metrics["count"] += 1
+            metrics["sum"] += duration
+            metrics["queries"] += queries
+            metrics["query_seconds"] += query_time
+
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._check_fork()
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+
+        # Write then rename, so readers never see a partial file
+        path = self._path()
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w") as f:
+            json.dump(self._views, f)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        # Returns the metrics of every worker summed per view
+        self.flush()
+
+        merged = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    views = json.load(f)
+            except (OSError, ValueError):
+                # The worker file went away or is not readable
+                continue
+
+            for view, metrics in views.items():
+                total = merged.get(view)
+                if total is None:
+                    merged[view] = metrics
+                    continue
+
+                total["buckets"] = [
+                    a + b for a, b in zip(total["buckets"], metrics["buckets"])
+                ]
+                for key in ("count", "sum", "queries", "query_seconds"):
+                    total[key] += metrics[key]
+
+        return merged
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def render(views, sample_rate):
+    # Formats collected metrics in the Prometheus text exposition format
+    lines = [
+        "# HELP api_request_duration_seconds Time spent handling sampled "
+        "requests, by view.",
+        "# TYPE api_request_duration_seconds histogram",
+    ]
+    for view, metrics in sorted(views.items()):
+        label = _label(view)
+
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), metrics["buckets"]):
+            cumulative += count
+            lines.append(
+                'api_request_duration_seconds_bucket{{view="{}",le="{}"}} {}'
+                .format(label, bound, cumulative))
+
+        lines.append('api_request_duration_seconds_sum{{view="{}"}} {}'
+                     .format(label, metrics["sum"]))
+        lines.append('api_request_duration_seconds_count{{view="{}"}} {}'
+                     .format(label, metrics["count"]))
+
+    lines += [
+        "# HELP api_db_queries_total Database queries run by sampled "
+        "requests, by view.",
+        "# TYPE api_db_queries_total counter",
+    ]
+    for view, metrics in sorted(views.items()):
+        lines.append('api_db_queries_total{{view="{}"}} {}'.format(
+            _label(view), metrics["queries"]))
+
+    lines += [
+        "# HELP api_db_query_duration_seconds_total Time spent in database "
+        "queries by sampled requests, by view.",
+        "# TYPE api_db_query_duration_seconds_total counter",
+    ]
+    for view, metrics in sorted(views.items()):
+        lines.append('api_db_query_duration_seconds_total{{view="{}"}} {}'
+                     .format(_label(view), metrics["query_seconds"]))
+
+    lines += [
+        "# HELP api_metrics_sample_rate Fraction of requests measured.",
+        "# TYPE api_metrics_sample_rate gauge",
+        "api_metrics_sample_rate {}".format(sample_rate),
+    ]
+
+    return "\n".join(lines) + "\n"
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = MetricsStore(
+                settings.METRICS_DIR,
+                flush_interval=getattr(settings, "METRICS_FLUSH_INTERVAL", 1),
+            )
+            atexit.register(_store.flush)
+
+        return _store
@@ -0,0 +1,215 @@
+import contextlib
+import math
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as message_middleware
+from django.contrib.sessions import middleware as session_middleware
+from django.db import connections
+from django.middleware import clickjacking
+
+from base import admission, metrics, routers, tokens
+from base.helpers import create_json_response
+
+
+class MetricsMiddleware:
+    # Records the latency and database queries of a sample of requests,
+    # grouped by view. Should be first in MIDDLEWARE so that the latency
+    # covers the other middleware too.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = getattr(settings, "METRICS_SAMPLE_RATE", 1.0)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return self.get_response(request)
+
+        queries = {"count": 0, "time": 0.0}
+
+        def count_queries(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries["count"] += 1
+                queries["time"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            # Replicas included
+            for database in connections.all():
+                stack.enter_context(database.execute_wrapper(count_queries))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        metrics.get_store().record(
+            getattr(request, "metrics_view", "unmatched"), duration,
+            queries["count"], queries["time"])
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = "{}.{}".format(
+            view_func.__module__, view_func.__name__)
+
+
+def is_lean_path(path):
+    return any(path.startswith(prefix)
+               for prefix in getattr(settings, "LEAN_PATH_PREFIXES", ()))
+
+
+class SkipLeanPathsMixin:
+    # Passes requests under LEAN_PATH_PREFIXES straight through, skipping
+    # the wrapped middleware's processing
+
+    def __call__(self, request):
+        if is_lean_path(request.path_info):
+            return self.get_response(request)
+
+        return super().__call__(request)
+
+
+class SessionMiddleware(SkipLeanPathsMixin,
+                        session_middleware.SessionMiddleware):
+    pass
+
+
+class AuthenticationMiddleware(SkipLeanPathsMixin,
+                               auth_middleware.AuthenticationMiddleware):
+    pass
+
+
+class MessageMiddleware(SkipLeanPathsMixin,
+                        message_middleware.MessageMiddleware):
+    pass
+
+
+class XFrameOptionsMiddleware(SkipLeanPathsMixin,
+                              clickjacking.XFrameOptionsMiddleware):
+    pass
+
+
+class TokenAuthenticationMiddleware:
+    # Sets request.token to the payload of a valid "Authorization: Bearer"
+    # token. Paths under AUTH_TOKEN_REQUIRED_PREFIXES are rejected without
+    # one.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.token = None
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+
+        if header.startswith("Bearer "):
+            request.token = tokens.verify(header[len("Bearer "):])
+
+            if request.token is None:
+                return create_json_response(
+                    success=False,
+                    message="Invalid token",
+                    status=401,
+                )
+
+        if request.token is None and any(
+                request.path_info.startswith(prefix)
+                for prefix in getattr(
+                    settings, "AUTH_TOKEN_REQUIRED_PREFIXES", ())):
+            return create_json_response(
+                success=False,
+                message="Authentication required",
+                status=401,
+            )
+
+        return self.get_response(request)
+
+
+class AdmissionControlMiddleware:
+    # Sheds load before it reaches the views. Every client has a token
+    # bucket per route in ADMISSION_ROUTES. Routes marked "concurrent"
+    # share ADMISSION_MAX_CONCURRENT slots per worker, and the long polls
+    # marked "waiting" share ADMISSION_MAX_WAITING others. Rejections are
+    # answered without touching the database. Must come after
+    # TokenAuthenticationMiddleware, as token users are limited by user.
+
+    def __init__(self, get_response, clock=time.time):
+        self.get_response = get_response
+        self.limiter = admission.get_limiter(clock)
+        self.slots = {
+            "concurrent": admission.ConcurrencyLimiter(
+                getattr(settings, "ADMISSION_MAX_CONCURRENT", 3)),
+            "waiting": admission.ConcurrencyLimiter(
+                getattr(settings, "ADMISSION_MAX_WAITING", 2)),
+        }
+
+    def _client(self, request):
+        # request.user would need a session query, the token does not
+        if getattr(request, "token", None) is not None:
+            return "user:{}".format(request.token["user"])
+
+        return "addr:{}".format(request.META.get("REMOTE_ADDR", ""))
+
+    def __call__(self, request):
+        prefix, limits = admission.get_route(request.path_info)
+        if limits is None:
+            return self.get_response(request)
+
+        if "rate" in limits:
+            wait = self.limiter.take(
+                "admission:{}:{}".format(prefix, self._client(request)),
+                limits["rate"], limits.get("burst", 1))
+
+            if wait:
+                response = create_json_response(
+                    success=False,
+                    message="Too many requests",
+                    status=429,
+                )
+                response["Retry-After"] = str(math.ceil(wait))
+                return response
+
+        kinds = [kind for kind in self.slots if limits.get(kind, False)]
+        if not kinds:
+            return self.get_response(request)
+
+        slots = self.slots[kinds[0]]
+        if not slots.acquire():
+            response = create_json_response(
+                success=False,
+                message="The server is busy, try again later",
+                status=503,
+            )
+            response["Retry-After"] = "1"
+            return response
+
+        try:
+            return self.get_response(request)
+        finally:
+            # Streamed responses give the slot back before streaming
+            slots.release()
+
+
+class ReplicaPinMiddleware:
+    # Lets clients read their own writes when PrimaryReplicaRouter sends
+    # reads to replicas. A request that writes reads from the primary from
+    # then on, and so do the client's requests in the next
+    # DATABASE_PIN_SECONDS, through a cookie.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.reset(pinned=routers.PIN_COOKIE in request.COOKIES)
+
+        response = self.get_response(request)
+
+        if routers.wrote():
+            response.set_cookie(
+                routers.PIN_COOKIE, "1",
+                max_age=getattr(settings, "DATABASE_PIN_SECONDS", 10),
+                httponly=True)
+
+        return response
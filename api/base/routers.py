@@ -0,0 +1,65 @@
+import contextlib
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Set on responses to requests that wrote, so that the client's next
+# requests read from the primary until the replicas have caught up
+PIN_COOKIE = "primary_pin"
+
+_state = threading.local()
+
+
+def reset(pinned=False):
+    # Called at the start of each request, requests run on one thread
+    _state.pinned = pinned
+    _state.wrote = False
+
+
+def wrote():
+    return getattr(_state, "wrote", False)
+
+
+def is_pinned():
+    return getattr(_state, "pinned", False) or wrote()
+
+
+@contextlib.contextmanager
+def use_primary(enabled=True):
+    # Sends the reads inside the block to the primary, when enabled
+    pinned = getattr(_state, "pinned", False)
+    _state.pinned = pinned or enabled
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+class PrimaryReplicaRouter:
+    # Sends reads of the models in DATABASE_REPLICA_APPS to one of the
+    # DATABASE_REPLICAS, and everything else to the primary. Once a request
+    # writes, the rest of it reads from the primary, and so does every read
+    # inside a transaction on the primary, such as a claim.
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, "DATABASE_REPLICAS", [])
+        apps = getattr(settings, "DATABASE_REPLICA_APPS", [])
+
+        if not replicas or model._meta.app_label not in apps:
+            return DEFAULT_DB_ALIAS
+        if is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # Querysets meant for writing, e.g. select_for_update(), come here
+        # too, which pins the request before the write itself
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
@@ -0,0 +1,387 @@
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import RequestFactory
+
+from base import admission
+from base import metrics
+from base import middleware
+from base import tokens
+from base import views
+
+
+class MetricsStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        store = metrics.MetricsStore(self.directory)
+        store.record("view", 0.003, 2, 0.001)
+        store.record("view", 0.2, 1, 0.1)
+        store.record("view", 60, 0, 0)
+
+        collected = store.collect()["view"]
+        self.assertEqual(collected["count"], 3)
+        self.assertEqual(collected["queries"], 3)
+        self.assertAlmostEqual(collected["query_seconds"], 0.101)
+
+        # One in the first bucket, one under 0.25s and one past the last
+        self.assertEqual(collected["buckets"][0], 1)
+        self.assertEqual(collected["buckets"][metrics.BUCKETS.index(0.25)], 1)
+        self.assertEqual(collected["buckets"][-1], 1)
+
+    def test_collect_merges_workers(self):
+        # Other workers' files are only as fresh as their last flush
+        first = metrics.MetricsStore(
+            self.directory, flush_interval=0, worker_id="first")
+        second = metrics.MetricsStore(
+            self.directory, flush_interval=0, worker_id="second")
+
+        first.record("view", 0.01, 1, 0.001)
+        second.record("view", 0.01, 2, 0.001)
+        second.record("other", 0.01, 0, 0)
+
+        collected = first.collect()
+        self.assertEqual(collected["view"]["count"], 2)
+        self.assertEqual(collected["view"]["queries"], 3)
+        self.assertEqual(collected["other"]["count"], 1)
+
+    def test_render(self):
+        store = metrics.MetricsStore(self.directory)
+        store.record("orders.views.new_order", 0.02, 1, 0.001)
+
+        text = metrics.render(store.collect(), 0.5)
+
+        self.assertIn("# TYPE api_request_duration_seconds histogram", text)
+        self.assertIn(
+            'api_request_duration_seconds_bucket{view="orders.views.new_order"'
+            ',le="0.01"} 0', text)
+        self.assertIn(
+            'api_request_duration_seconds_bucket{view="orders.views.new_order"'
+            ',le="+Inf"} 1', text)
+        self.assertIn(
+            'api_db_queries_total{view="orders.views.new_order"} 1', text)
+        self.assertIn("api_metrics_sample_rate 0.5", text)
+
+
+class MetricsMiddlewareTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.factory = RequestFactory()
+
+        self.old_store = metrics._store
+        metrics._store = metrics.MetricsStore(self.directory)
+
+    def tearDown(self):
+        metrics._store = self.old_store
+        shutil.rmtree(self.directory)
+
+    def send_request(self):
+        def view(request):
+            return HttpResponse()
+
+        metrics_middleware = middleware.MetricsMiddleware(
+            lambda request: (
+                metrics_middleware.process_view(request, view, (), {}) or
+                view(request)
+            ))
+
+        return metrics_middleware(self.factory.get("/"))
+
+    def test_records_view(self):
+        self.send_request()
+
+        collected = metrics.get_store().collect()
+        self.assertEqual(collected["base.tests.view"]["count"], 1)
+        self.assertEqual(collected["base.tests.view"]["queries"], 0)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_sampling(self):
+        self.send_request()
+
+        self.assertEqual(metrics.get_store().collect(), {})
+
+    def test_metrics_view(self):
+        self.send_request()
+
+        response = views.metrics(self.factory.get("/metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'view="base.tests.view"', response.content)
+
+
+class TokenTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="train", password="password")
+
+    def test_verify(self):
+        token = tokens.issue(self.user)
+
+        with self.assertNumQueries(0):
+            payload = tokens.verify(token)
+
+        self.assertEqual(payload["user"], self.user.pk)
+
+        # Tokens are unique even for the same user
+        self.assertNotEqual(tokens.issue(self.user), token)
+
+    def test_reject_tampered_token(self):
+        token = tokens.issue(self.user)
+
+        self.assertIsNone(tokens.verify(token + "x"))
+        self.assertIsNone(tokens.verify("not a token"))
+
+    @override_settings(AUTH_TOKEN_MAX_AGE=-1)
+    def test_reject_expired_token(self):
+        self.assertIsNone(tokens.verify(tokens.issue(self.user)))
+
+    def test_revoke(self):
+        token = tokens.issue(self.user)
+        other_token = tokens.issue(self.user)
+
+        tokens.revoke(tokens.verify(token))
+
+        self.assertIsNone(tokens.verify(token))
+        self.assertIsNotNone(tokens.verify(other_token))
+
+    def test_token_view(self):
+        request = self.factory.post(
+            "/token/", {"username": "train", "password": "password"})
+        response_json = json.loads(views.token(request).content)
+
+        self.assertTrue(response_json["success"])
+        payload = tokens.verify(response_json["data"]["token"])
+        self.assertEqual(payload["user"], self.user.pk)
+
+        request = self.factory.post(
+            "/token/", {"username": "train", "password": "wrong"})
+        response_json = json.loads(views.token(request).content)
+        self.assertFalse(response_json["success"])
+
+
+class TokenAuthenticationMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username="train", password="password")
+        self.token_middleware = middleware.TokenAuthenticationMiddleware(
+            lambda request: HttpResponse())
+
+    def send_request(self, path, token=None):
+        headers = {}
+        if token is not None:
+            headers["HTTP_AUTHORIZATION"] = "Bearer {}".format(token)
+
+        request = self.factory.post(path, **headers)
+        return request, self.token_middleware(request)
+
+    def test_valid_token(self):
+        request, response = self.send_request(
+            "/orders/status/", tokens.issue(self.user))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.token["user"], self.user.pk)
+
+    def test_invalid_token(self):
+        _, response = self.send_request("/orders/status/", "bad")
+        self.assertEqual(response.status_code, 401)
+
+    def test_optional_token(self):
+        request, response = self.send_request("/orders/status/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(request.token)
+
+    @override_settings(AUTH_TOKEN_REQUIRED_PREFIXES=["/orders/"])
+    def test_required_token(self):
+        _, response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 401)
+
+        _, response = self.send_request("/login/")
+        self.assertEqual(response.status_code, 200)
+
+        _, response = self.send_request(
+            "/orders/status/", tokens.issue(self.user))
+        self.assertEqual(response.status_code, 200)
+
+    def test_revoke_view(self):
+        token = tokens.issue(self.user)
+        request, _ = self.send_request("/token/revoke/", token)
+
+        response = views.revoke_token(request)
+        self.assertEqual(response.status_code, 200)
+
+        _, response = self.send_request("/orders/status/", token)
+        self.assertEqual(response.status_code, 401)
+
+
+class LeanPathMiddlewareTestCase(SimpleTestCase):
+    def test_skips_lean_paths(self):
+        factory = RequestFactory()
+        session_middleware = middleware.SessionMiddleware(
+            lambda request: HttpResponse())
+
+        with override_settings(LEAN_PATH_PREFIXES=["/orders/"]):
+            request = factory.post("/orders/status/")
+            session_middleware(request)
+            self.assertFalse(hasattr(request, "session"))
+
+            request = factory.post("/login/")
+            session_middleware(request)
+            self.assertTrue(hasattr(request, "session"))
+
+
+@override_settings(
+    ADMISSION_ROUTES={
+        "/orders/": {"rate": 1, "burst": 2, "concurrent": True},
+        "/orders/claim/": {"rate": 10, "burst": 1},
+    },
+    ADMISSION_MAX_CONCURRENT=1,
+)
+class AdmissionControlMiddlewareTestCase(SimpleTestCase):
+    def setUp(self):
+        caches["admission"].clear()
+        self.factory = RequestFactory()
+        self.now = [1000.0]
+        self.admission_middleware = middleware.AdmissionControlMiddleware(
+            lambda request: HttpResponse(), clock=lambda: self.now[0])
+
+    def send_request(self, path, address="10.0.0.1", token=None):
+        request = self.factory.post(path, REMOTE_ADDR=address)
+        request.token = token
+        return self.admission_middleware(request)
+
+    def test_rate_limit(self):
+        # SimpleTestCase fails on any query, so rejections are query free
+        for _ in range(2):
+            response = self.send_request("/orders/status/")
+            self.assertEqual(response.status_code, 200)
+
+        response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertFalse(json.loads(response.content)["success"])
+
+        self.now[0] += 1
+        response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 429)
+
+    def test_buckets_per_client(self):
+        for _ in range(2):
+            self.send_request("/orders/status/")
+
+        response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 429)
+
+        response = self.send_request("/orders/status/", address="10.0.0.2")
+        self.assertEqual(response.status_code, 200)
+
+        # Token users are limited by user, whatever their address
+        for address in ("10.0.0.1", "10.0.0.3"):
+            response = self.send_request(
+                "/orders/status/", address=address, token={"user": 1})
+            self.assertEqual(response.status_code, 200)
+
+        response = self.send_request(
+            "/orders/status/", address="10.0.0.4", token={"user": 1})
+        self.assertEqual(response.status_code, 429)
+
+    def test_longest_prefix(self):
+        self.assertEqual(admission.get_route("/orders/claim/")[0],
+                         "/orders/claim/")
+        self.assertEqual(admission.get_route("/orders/new/")[0], "/orders/")
+        self.assertEqual(admission.get_route("/login/"), (None, None))
+
+        response = self.send_request("/orders/claim/")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.send_request("/orders/claim/")
+        self.assertEqual(response.status_code, 429)
+
+        # The buckets of other routes are separate
+        response = self.send_request("/orders/status/")
+        self.assertEqual(response.status_code, 200)
+
+        for _ in range(5):
+            response = self.send_request("/login/")
+            self.assertEqual(response.status_code, 200)
+
+    def test_concurrency_limit(self):
+        responses = []
+
+        def get_response(request):
+            # Sent while the outer request holds the only slot, if it took one
+            if request.path == "/orders/slow/":
+                responses.append(self.send_request(
+                    "/orders/status/", address="10.0.0.2"))
+            return HttpResponse()
+
+        self.admission_middleware.get_response = get_response
+
+        response = self.send_request("/orders/slow/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responses[-1].status_code, 503)
+        self.assertEqual(responses[-1]["Retry-After"], "1")
+
+        # The slot was given back
+        response = self.send_request("/orders/status/", address="10.0.0.3")
+        self.assertEqual(response.status_code, 200)
+
+        # Routes that are not concurrent take no slot
+        with override_settings(ADMISSION_ROUTES={
+                "/orders/": {"rate": 1, "burst": 2, "concurrent": True},
+                "/orders/slow/": {"rate": 1, "burst": 2}}):
+            response = self.send_request("/orders/slow/", address="10.0.0.4")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responses[-1].status_code, 200)
+
+    @override_settings(ADMISSION_MAX_WAITING=1)
+    def test_waiting_limit(self):
+        responses = []
+
+        def get_response(request):
+            # Sent while the outer long poll holds the only waiting slot
+            if request.path == "/orders/claim/":
+                self.now[0] += 60
+                responses.append(self.send_request(
+                    "/orders/claim/", address="10.0.0.2"))
+                responses.append(self.send_request(
+                    "/orders/status/", address="10.0.0.2"))
+            return HttpResponse()
+
+        self.admission_middleware = middleware.AdmissionControlMiddleware(
+            get_response, clock=lambda: self.now[0])
+
+        with override_settings(ADMISSION_ROUTES={
+                "/orders/": {"rate": 1, "burst": 2, "concurrent": True},
+                "/orders/claim/": {"rate": 10, "burst": 1,
+                                   "waiting": True}}):
+            response = self.send_request("/orders/claim/")
+
+            # The bucket had a token, the slot was taken
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(responses[0].status_code, 503)
+            self.assertEqual(responses[0]["Retry-After"], "1")
+
+            # Waits do not take the slots of the concurrent routes
+            self.assertEqual(responses[1].status_code, 200)
+
+            # The slot was given back
+            self.now[0] += 60
+            self.admission_middleware.get_response = (
+                lambda request: HttpResponse())
+            response = self.send_request("/orders/claim/", address="10.0.0.3")
+            self.assertEqual(response.status_code, 200)
@@ -0,0 +1,46 @@
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+SALT = "base.tokens"
+
+
+def _get_revocations():
+    return caches[getattr(settings, "AUTH_TOKEN_REVOCATION_CACHE", "default")]
+
+
+def _make_key(token_id):
+    return "revoked-token:{}".format(token_id)
+
+
+def get_max_age():
+    return getattr(settings, "AUTH_TOKEN_MAX_AGE", 24 * 60 * 60)
+
+
+def issue(user):
+    # The token carries the user id and a unique token id, signed together
+    # with the time of issue
+    return signing.dumps({"user": user.pk, "id": uuid.uuid4().hex},
+                         salt=SALT)
+
+
+def verify(token):
+    # Returns the token payload, or None if the token is forged, expired or
+    # revoked. Needs no database query.
+    try:
+        payload = signing.loads(token, salt=SALT, max_age=get_max_age())
+    except signing.BadSignature:
+        return None
+
+    if _get_revocations().get(_make_key(payload["id"])) is not None:
+        return None
+
+    return payload
+
+
+def revoke(payload):
+    # Revoked ids only need to be remembered until the token would have
+    # expired anyway
+    _get_revocations().set(_make_key(payload["id"]), True, get_max_age())
@@ -6,4 +6,7 @@ urlpatterns = [
     path("login/", views.login, name="login"),
     path("logout/", views.logout, name="logout"),
     path("register/", views.register, name="register"),
+    path("token/", views.token, name="token"),
+    path("token/revoke/", views.revoke_token, name="revoke_token"),
+    path("metrics", views.metrics, name="metrics"),
 ]
\ No newline at end of file
@@ -1,6 +1,10 @@
+from django.conf import settings
+from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 
+from base import metrics as base_metrics
+from base import tokens
 from base.helpers import create_json_response
 import django.contrib.auth as django_auth
 
@@ -31,6 +35,45 @@ def logout(request):
     return create_json_response()
 
 
+@csrf_exempt
+@require_POST
+def token(request):
+    username = request.POST.get("username", "")
+    password = request.POST.get("password", "")
+
+    user = django_auth.authenticate(
+        request, username=username, password=password)
+
+    if user is not None:
+        # No session is created, the token is all the client needs
+        return create_json_response(
+            data={
+                "token": tokens.issue(user),
+                "expires_in": tokens.get_max_age(),
+            }
+        )
+    else:
+        return create_json_response(
+            success=False,
+            message="Login failed",
+        )
+
+
+@csrf_exempt
+@require_POST
+def revoke_token(request):
+    if getattr(request, "token", None) is None:
+        return create_json_response(
+            success=False,
+            message="Missing token",
+            status=400,
+        )
+
+    tokens.revoke(request.token)
+
+    return create_json_response()
+
+
 @csrf_exempt
 @require_POST
 def register(request):
@@ -50,3 +93,14 @@ def register(request):
             message="Missing username or password",
             status=400
         )
+
+
+@require_GET
+def metrics(request):
+    body = base_metrics.render(
+        base_metrics.get_store().collect(),
+        getattr(settings, "METRICS_SAMPLE_RATE", 1.0),
+    )
+
+    return HttpResponse(
+        body, content_type="text/plain; version=0.0.4; charset=utf-8")
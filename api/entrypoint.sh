@@ -1,4 +1,3 @@
 ./wait-for-it.sh db:5432
-python manage.py makemigrations
 python manage.py migrate
 uwsgi --ini api_uwsgi.ini
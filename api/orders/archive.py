@@ -0,0 +1,61 @@
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from orders.models import Order, OrderArchive
+
+# Columns copied from Order to OrderArchive
+COLUMNS = ("id", "destination_id", "color", "status", "completed_at",
+           "version")
+
+
+def archive_completed(older_than, batch_size=1000, max_batches=None):
+    # Moves orders completed more than `older_than` (a timedelta) ago from
+    # Order to OrderArchive, `batch_size` orders per transaction. Orders
+    # completed before completed_at existed are always archived. Returns
+    # the number of orders archived.
+    cutoff = timezone.now() - older_than
+    quote = connection.ops.quote_name
+    columns = ", ".join(quote(column) for column in COLUMNS)
+
+    archived = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        batches += 1
+
+        with transaction.atomic():
+            ids = list(Order.objects.filter(
+                Q(completed_at__lt=cutoff) | Q(completed_at__isnull=True),
+                status=Order.STATUS_COMPLETED,
+            ).order_by("id").values_list("id", flat=True)[:batch_size])
+
+            if not ids:
+                break
+
+            placeholders = ", ".join(["%s"] * len(ids))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO {archive} ({columns}) "
+                    "SELECT {columns} FROM {order} "
+                    "WHERE {id} IN ({placeholders})".format(
+                        archive=quote(OrderArchive._meta.db_table),
+                        order=quote(Order._meta.db_table),
+                        columns=columns,
+                        id=quote("id"),
+                        placeholders=placeholders,
+                    ), ids)
+                cursor.execute(
+                    "DELETE FROM {order} WHERE {id} IN ({placeholders})"
+                    .format(
+                        order=quote(Order._meta.db_table),
+                        id=quote("id"),
+                        placeholders=placeholders,
+                    ), ids)
+
+        archived += len(ids)
+
+        if len(ids) < batch_size:
+            break
+
+    return archived
@@ -0,0 +1,342 @@
+import io
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from orders import counters, destinations
+from orders.models import Order
+
+DEFAULT_MIX = {
+    "new": 4,
+    "claim": 2,
+    "update": 2,
+    "status": 10,
+    "login": 1,
+}
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+
+def parse_mix(value):
+    # Parses "new=4,status=10" into {"new": 4, "status": 10}
+    mix = {}
+
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+
+        if name not in DEFAULT_MIX:
+            raise ValueError("Unknown endpoint {}".format(name))
+        if not weight.isdigit():
+            raise ValueError("Bad weight for {}".format(name))
+
+        mix[name] = int(weight)
+
+    if not any(mix.values()):
+        raise ValueError("The mix has no traffic")
+
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list: the smallest value
+    # with at least `fraction` of the values at or below it. The rounding
+    # keeps float noise, as in 0.1 * 30, from moving up a rank.
+    if not sorted_values:
+        return 0
+
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class _Traffic:
+    # Shared state between the benchmark threads, such as the ids of the
+    # orders that can be looked up and the (id, lease token) pairs of the
+    # orders that can be updated
+
+    def __init__(self, seed_ids, active):
+        self._lock = threading.Lock()
+        self._order_ids = list(seed_ids)
+        self._active = list(active)
+
+    def add_order(self, order_id):
+        with self._lock:
+            self._order_ids.append(order_id)
+
+    def add_active(self, order_id, lease_token):
+        with self._lock:
+            self._active.append((order_id, lease_token))
+
+    def pop_active(self):
+        with self._lock:
+            return self._active.pop() if self._active else None
+
+    def random_order(self):
+        with self._lock:
+            return random.choice(self._order_ids) if self._order_ids else 0
+
+
+def _server_name():
+    # A host that passes the ALLOWED_HOSTS check. With DEBUG on, an empty
+    # ALLOWED_HOSTS allows localhost.
+    for host in settings.ALLOWED_HOSTS:
+        if host != "*":
+            return host.lstrip(".")
+
+    return "localhost"
+
+
+class _Runner:
+    def __init__(self, traffic):
+        self.handler = WSGIHandler()
+        self.server_name = _server_name()
+        self.traffic = traffic
+        self._requests = itertools.count()
+
+    def _remote_addr(self):
+        # Every request comes from another address, so that the per-client
+        # admission limits do not shed the benchmark traffic
+        number = next(self._requests)
+        return "10.{}.{}.{}".format(
+            number >> 16 & 255, number >> 8 & 255, number & 255)
+
+    def call(self, path, body, content_type="application/json"):
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "PATH_INFO": path,
+            "SCRIPT_NAME": "",
+            "QUERY_STRING": "",
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": self._remote_addr(),
+            "CONTENT_TYPE": content_type,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": io.StringIO(),
+            "wsgi.url_scheme": "http",
+            "wsgi.version": (1, 0),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split()[0]))
+
+        response = self.handler(environ, start_response)
+        try:
+            content = b"".join(response)
+        finally:
+            # Fires request_finished, like a real WSGI server
+            response.close()
+
+        return status[0], content
+
+    def call_json(self, path, data=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        status, content = self.call(path, body)
+
+        try:
+            return status, json.loads(content.decode())
+        except ValueError:
+            return status, None
+
+    def new(self):
+        status, payload = self.call_json("/orders/new/", {
+            "destination": "Bishan",
+            "color": random.randint(0, 10),
+        })
+        if status == 200:
+            self.traffic.add_order(payload["data"]["id"])
+        return status
+
+    def claim(self):
+        status, payload = self.call_json("/orders/claim/")
+        if status == 200 and payload["data"] is not None:
+            self.traffic.add_active(
+                payload["data"]["id"], payload["data"]["lease_token"])
+        return status
+
+    def update(self):
+        active = self.traffic.pop_active()
+        if active is None:
+            # Nothing to complete yet
+            return None
+
+        order_id, lease_token = active
+        status, _ = self.call_json("/orders/update/", {
+            "id": order_id,
+            "new_status": Order.STATUS_COMPLETED,
+            "lease_token": lease_token,
+        })
+        return status
+
+    def status(self):
+        status, _ = self.call_json("/orders/status/", {
+            "id": self.traffic.random_order(),
+        })
+        return status
+
+    def login(self):
+        body = urllib.parse.urlencode({
+            "username": USERNAME,
+            "password": PASSWORD,
+        }).encode()
+        status, _ = self.call(
+            "/login/", body,
+            content_type="application/x-www-form-urlencoded")
+        return status
+
+
+def _prepare(seed_orders):
+    # Returns the ids of all orders and the (id, lease token) pairs of the
+    # active orders created, half of the seed orders are active so that
+    # updates have work from the start
+    if not User.objects.filter(username=USERNAME).exists():
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+
+    destination_id = destinations.intern("Bishan")
+    # Creates the counter rows of every shard, so that the first writes of
+    # each thread do not pay for the INSERTs
+    counters.rebuild()
+
+    orders = [
+        Order(destination_id=destination_id, color=i % 10,
+              status=Order.STATUS_ACTIVE if i % 2 else Order.STATUS_NOT_ACTIVE)
+        for i in range(seed_orders)
+    ]
+    with transaction.atomic():
+        Order.objects.bulk_create(orders)
+        counters.add_orders(
+            (order.destination_id, order.status) for order in orders)
+
+    # Not every backend returns ids from bulk inserts
+    seed_ids = list(Order.objects.values_list("id", flat=True))
+    active = list(Order.objects.filter(
+        status=Order.STATUS_ACTIVE).values_list("id", "version"))
+
+    return seed_ids, active
+
+
+def run(mix=None, requests=1000, threads=8, seed_orders=100,
+        admission=False):
+    # Sends `requests` requests, picked at random according to the weights
+    # in `mix`, through the WSGI handler from `threads` threads. Returns
+    # the results per endpoint. Admission control is off unless
+    # `admission`, as it would turn most of the traffic away from a single
+    # process and the results would measure load shedding.
+    mix = mix or DEFAULT_MIX
+    traffic = _Traffic(*_prepare(seed_orders))
+    runner = _Runner(traffic)
+
+    names = [name for name, weight in mix.items() if weight]
+    weights = [mix[name] for name in names]
+    plan = random.choices(names, weights=weights, k=requests)
+
+    samples_lock = threading.Lock()
+    samples = {name: [] for name in names}
+
+    def send(name):
+        queries = {"count": 0, "time": 0}
+
+        def count_queries(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries["count"] += 1
+                queries["time"] += time.perf_counter() - start
+
+        try:
+            with connection.execute_wrapper(count_queries):
+                start = time.perf_counter()
+                status = getattr(runner, name)()
+                latency = time.perf_counter() - start
+        finally:
+            connection.close()
+
+        if status is not None:
+            with samples_lock:
+                samples[name].append(
+                    (latency, status, queries["count"], queries["time"]))
+
+    routes = settings.ADMISSION_ROUTES if admission else {}
+    start = time.perf_counter()
+    with override_settings(ADMISSION_ROUTES=routes), \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(send, plan))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "elapsed": elapsed,
+        "threads": threads,
+        "database": connection.vendor,
+        "endpoints": {
+            name: _summarise(endpoint_samples, elapsed)
+            for name, endpoint_samples in samples.items()
+            if endpoint_samples
+        },
+    }
+
+
+def _summarise(samples, elapsed):
+    latencies = sorted(sample[0] for sample in samples)
+    count = len(samples)
+
+    return {
+        "requests": count,
+        "errors": sum(1 for sample in samples if sample[1] >= 400),
+        "requests_per_second": count / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "queries_per_request": sum(sample[2] for sample in samples) / count,
+        "query_ms_per_request":
+            sum(sample[3] for sample in samples) / count * 1000,
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    # Returns a list of regressions of `results` against `baseline`. A
+    # throughput drop or p95 rise beyond `tolerance`, or any extra query
+    # per request, is a regression.
+    regressions = []
+
+    for name, base in baseline["endpoints"].items():
+        current = results["endpoints"].get(name)
+        if current is None:
+            continue
+
+        if current["requests_per_second"] < \
+                base["requests_per_second"] * (1 - tolerance):
+            regressions.append(
+                "{}: {:.1f} req/s, baseline {:.1f} req/s".format(
+                    name, current["requests_per_second"],
+                    base["requests_per_second"]))
+
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append("{}: p95 {:.2f} ms, baseline {:.2f} ms".format(
+                name, current["p95_ms"], base["p95_ms"]))
+
+        if current["queries_per_request"] > \
+                base["queries_per_request"] + 0.01:
+            regressions.append(
+                "{}: {:.2f} queries/request, baseline {:.2f}".format(
+                    name, current["queries_per_request"],
+                    base["queries_per_request"]))
+
+    return regressions
@@ -0,0 +1,142 @@
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from orders import notify
+from orders.notify import PostgresListener
+
+CHANNEL = "orders_status"
+
+# Queued instead of a status when updates may have been missed, so that
+# subscribers read the status again
+RESYNC = None
+
+
+class Subscription:
+    def __init__(self, broadcaster, order_id):
+        self.order_id = order_id
+        self._broadcaster = broadcaster
+        self._queue = queue.Queue()
+
+    def put(self, status):
+        self._queue.put(status)
+
+    def get(self, timeout):
+        # Returns the next status, RESYNC, or raises queue.Empty. While the
+        # broadcaster cannot deliver every change, RESYNC is returned every
+        # poll interval instead of waiting for the whole timeout.
+        interval = self._broadcaster.poll_interval()
+        if interval is None or timeout <= interval:
+            return self._queue.get(timeout=timeout)
+
+        try:
+            return self._queue.get(timeout=interval)
+        except queue.Empty:
+            return RESYNC
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+
+class InMemoryBroadcaster:
+    # Delivers status changes to subscribers in this process only
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, order_id):
+        subscription = Subscription(self, order_id)
+
+        with self._lock:
+            self._subscriptions.setdefault(order_id, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.order_id)
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.order_id]
+
+    def publish(self, order_id, status):
+        # Must be called after the status change has been committed
+        self._deliver(order_id, status)
+
+    def poll_interval(self):
+        # Every change is delivered, there is no need to poll
+        return None
+
+    def _deliver(self, order_id, status):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(order_id, ()))
+
+        for subscription in subscriptions:
+            subscription.put(status)
+
+    def _resync(self):
+        with self._lock:
+            subscriptions = [
+                subscription
+                for order_subscriptions in self._subscriptions.values()
+                for subscription in order_subscriptions
+            ]
+
+        for subscription in subscriptions:
+            subscription.put(RESYNC)
+
+
+class PostgresBroadcaster(InMemoryBroadcaster):
+    # Publishes through NOTIFY so that subscribers in every worker process
+    # receive the status change
+
+    def __init__(self):
+        super().__init__()
+        self._listener = PostgresListener(
+            CHANNEL, on_notify=self._on_notify, on_resync=self._resync)
+
+    def subscribe(self, order_id):
+        self._listener.start()
+        return super().subscribe(order_id)
+
+    def poll_interval(self):
+        if self._listener.is_listening():
+            return None
+
+        return notify.poll_interval()
+
+    def publish(self, order_id, status):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)",
+                           [CHANNEL, "{}:{}".format(order_id, status)])
+
+    def _on_notify(self, payload):
+        order_id, status = payload.split(":")
+        self._deliver(int(order_id), int(status))
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    global _broadcaster
+
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            backend = getattr(settings, "ORDERS_BROADCAST_BACKEND", None)
+
+            if backend is not None:
+                _broadcaster = import_string(backend)()
+            elif connection.vendor == "postgresql":
+                _broadcaster = PostgresBroadcaster()
+            else:
+                _broadcaster = InMemoryBroadcaster()
+
+        return _broadcaster
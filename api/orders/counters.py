@@ -0,0 +1,230 @@
+import collections
+import random
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, F, Sum, When
+from django.db.models.functions import Coalesce
+
+from orders.models import (
+    Destination, DestinationCount, Order, OrderArchive, StatusCount,
+)
+
+# Order counts by status and by destination. Every write path adjusts the
+# counters in the same transaction as the orders, with F() expressions, so
+# reading them never counts the orders table. Archiving moves orders
+# without changing the counts, which include archived orders.
+#
+# Every claim and status update moves orders between statuses, and every
+# new order adds to its destination, so the counts are split over
+# ORDERS_COUNTER_SHARDS rows per status and per destination. A writer only
+# updates its own shard, and readers add the shards up.
+
+_local = threading.local()
+
+
+def _shard():
+    # Each thread keeps to one shard, so a transaction never locks rows of
+    # two shards and cannot deadlock with a writer on another shard
+    shards = getattr(settings, "ORDERS_COUNTER_SHARDS", 8)
+    shard = getattr(_local, "shard", None)
+    if shard is None or shard >= shards:
+        shard = _local.shard = random.randrange(shards)
+
+    return shard
+
+
+def add_orders(orders):
+    # Counts new orders, given as (destination id, status) pairs. Must run
+    # in the transaction that inserts them.
+    add_counts(collections.Counter(orders))
+
+
+def add_counts(counts):
+    # Like add_orders, with the number of new orders per (destination id,
+    # status)
+    by_status = collections.Counter()
+    by_destination = collections.Counter()
+    for (destination_id, status), count in counts.items():
+        by_status[status] += count
+        by_destination[destination_id] += count
+
+    _add_sharded(StatusCount, "status", by_status)
+    _add_sharded(DestinationCount, "destination_id", by_destination)
+
+
+def move(count, from_status, to_status):
+    # Counts `count` orders changing status. Must run in the transaction
+    # that changes them.
+    if count:
+        _add_sharded(
+            StatusCount, "status", {from_status: -count, to_status: count})
+
+
+def _add_sharded(model, key, deltas):
+    # Adds the deltas to this thread's shard of the counts of `model`,
+    # keyed by `key`
+    deltas = {value: delta for value, delta in deltas.items() if delta}
+    shard = _shard()
+    rows = model.objects.filter(shard=shard)
+    if _add(rows, key, "count", deltas) == len(deltas):
+        return
+
+    # The first write to a shard, e.g. for a new destination or after the
+    # table was emptied, creates its rows
+    existing = set(rows.filter(
+        **{key + "__in": list(deltas)}).values_list(key, flat=True))
+    for value in sorted(set(deltas) - existing):
+        try:
+            with transaction.atomic():
+                model.objects.create(
+                    **{key: value, "shard": shard, "count": deltas[value]})
+        except IntegrityError:
+            _add(rows, key, "count", {value: deltas[value]})
+
+
+def _add(rows, key, field, deltas):
+    # A single UPDATE for all the rows, returns the number of rows updated.
+    # Writers always update the status counts before the destination
+    # counts, so they cannot deadlock on each other.
+    deltas = {value: delta for value, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+
+    return rows.filter(**{key + "__in": list(deltas)}).update(**{
+        field: F(field) + Case(*[
+            When(**{key: value, "then": delta})
+            for value, delta in sorted(deltas.items())
+        ])
+    })
+
+
+def get_counts():
+    # Returns the counts by status and by destination name
+    return {
+        "by_status": dict(StatusCount.objects.order_by().values_list(
+            "status").annotate(Sum("count"))),
+        "by_destination": dict(
+            Destination.objects.order_by().values_list("name").annotate(
+                count=Coalesce(Sum("counts__count"), 0))),
+    }
+
+
+def count_orders():
+    # Returns the number of live and archived orders per (destination id,
+    # status). A single statement reads both tables, so orders being
+    # archived are counted exactly once.
+    live = Order.objects.order_by().values_list(
+        "destination_id", "status").annotate(Count("id"))
+    archived = OrderArchive.objects.order_by().values_list(
+        "destination_id", "status").annotate(Count("id"))
+
+    counts = collections.Counter()
+    for destination_id, status, count in live.union(archived, all=True):
+        counts[destination_id, status] += count
+
+    return counts
+
+
+def _read_snapshot():
+    # Makes the rest of the transaction read from a single snapshot.
+    # SQLite transactions always do.
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+
+def rebuild(check_only=False):
+    # Recounts the orders and, unless `check_only`, fixes the counters.
+    # Returns the drift found as (kind, key, recorded, actual) tuples.
+    # Writers wait on the locked counters until the recount is saved, so
+    # their changes are counted either by the recount or by them. A check
+    # locks nothing, and reads the counters and the orders from the same
+    # snapshot instead.
+    with transaction.atomic():
+        if check_only:
+            _read_snapshot()
+            status_counts = StatusCount.objects.all()
+            destination_counts = DestinationCount.objects.all()
+        else:
+            status_counts = StatusCount.objects.select_for_update()
+            destination_counts = DestinationCount.objects.select_for_update()
+
+        status_rows = collections.defaultdict(list)
+        for row in status_counts:
+            status_rows[row.status].append(row)
+        destination_rows = collections.defaultdict(list)
+        for row in destination_counts:
+            destination_rows[row.destination_id].append(row)
+        names = dict(Destination.objects.values_list("pk", "name"))
+
+        by_status = collections.Counter()
+        by_destination = collections.Counter()
+        for (destination_id, status), count in count_orders().items():
+            by_status[status] += count
+            by_destination[destination_id] += count
+
+        drift = []
+        for status in sorted(set(Order.STATUS_FLOW) | set(status_rows)):
+            rows = status_rows.get(status)
+            recorded = sum(row.count for row in rows) if rows else None
+            if recorded != by_status[status]:
+                drift.append(("status", status, recorded, by_status[status]))
+
+                if not check_only:
+                    # The whole count goes to the first shard
+                    StatusCount.objects.filter(status=status).exclude(
+                        shard=0).update(count=0)
+                    StatusCount.objects.update_or_create(
+                        status=status, shard=0,
+                        defaults={"count": by_status[status]})
+
+        for destination_id, name in sorted(names.items()):
+            # Destinations without orders have no rows until a rebuild
+            recorded = sum(
+                row.count for row in destination_rows[destination_id])
+            if recorded != by_destination[destination_id]:
+                drift.append(("destination", name, recorded,
+                              by_destination[destination_id]))
+
+                if not check_only:
+                    DestinationCount.objects.filter(
+                        destination_id=destination_id).exclude(
+                        shard=0).update(count=0)
+                    DestinationCount.objects.update_or_create(
+                        destination_id=destination_id, shard=0,
+                        defaults={"count": by_destination[destination_id]})
+
+        if not check_only:
+            _create_shards(status_rows, destination_rows, names)
+
+    return drift
+
+
+def _create_shards(status_rows, destination_rows, destination_ids):
+    # Creates the missing shard rows of every status and destination, so
+    # that writers do not have to
+    shards = getattr(settings, "ORDERS_COUNTER_SHARDS", 8)
+
+    def missing(keys, rows_by_key):
+        existing = {
+            (key, row.shard)
+            for key, rows in rows_by_key.items() for row in rows
+        }
+        return [
+            (key, shard)
+            for key in keys for shard in range(shards)
+            if (key, shard) not in existing
+        ]
+
+    StatusCount.objects.bulk_create([
+        StatusCount(status=status, shard=shard)
+        for status, shard in missing(Order.STATUS_FLOW, status_rows)
+    ], ignore_conflicts=True)
+    DestinationCount.objects.bulk_create([
+        DestinationCount(destination_id=destination_id, shard=shard)
+        for destination_id, shard in missing(
+            sorted(destination_ids), destination_rows)
+    ], ignore_conflicts=True)
@@ -0,0 +1,69 @@
+import threading
+
+from django.db import transaction
+
+# Destination names never change, so name <-> id pairs can be cached for
+# the life of the process. There are only a few dozen destinations.
+_lock = threading.Lock()
+_ids = {}
+_names = {}
+
+
+def _remember(name, destination_id):
+    with _lock:
+        _ids[name] = destination_id
+        _names[destination_id] = name
+
+
+def intern(name):
+    # Returns the id of the destination, creating it if needed. Only the
+    # first use of a name in a process touches the database.
+    destination_id = _ids.get(name)
+    if destination_id is not None:
+        return destination_id
+
+    from orders.models import Destination
+
+    destination, _ = Destination.objects.get_or_create(name=name)
+    # A destination created in a transaction that is rolled back must not
+    # be remembered
+    transaction.on_commit(lambda: _remember(name, destination.pk))
+
+    return destination.pk
+
+
+def lookup(name):
+    # Returns the id of the destination, or None if there is no such
+    # destination
+    destination_id = _ids.get(name)
+    if destination_id is not None:
+        return destination_id
+
+    from orders.models import Destination
+
+    destination_id = Destination.objects.filter(
+        name=name).values_list("id", flat=True).first()
+    if destination_id is not None:
+        _remember(name, destination_id)
+
+    return destination_id
+
+
+def name_of(destination_id):
+    name = _names.get(destination_id)
+    if name is not None:
+        return name
+
+    from orders.models import Destination
+
+    name = Destination.objects.filter(
+        pk=destination_id).values_list("name", flat=True).get()
+    _remember(name, destination_id)
+
+    return name
+
+
+def clear():
+    with _lock:
+        _ids.clear()
+        _names.clear()
@@ -0,0 +1,68 @@
+import csv
+import io
+import itertools
+import json
+
+from orders import destinations
+from orders.models import Order, OrderArchive
+
+FIELDS = ("id", "destination", "color", "status")
+# The columns read for FIELDS, destination ids are turned into names
+COLUMNS = ("id", "destination_id", "color", "status")
+FORMATS = ("ndjson", "csv")
+
+
+def export_rows(status=None, destination=None, min_id=None, max_id=None,
+                include_archive=False, chunk_size=2000):
+    # Returns an iterator over order rows as tuples of FIELDS, ordered by id
+    # within each table. Rows are fetched `chunk_size` at a time (through a
+    # server-side cursor on PostgreSQL) and no model instances are built, so
+    # memory use does not grow with the table.
+    filters = {}
+    if status is not None:
+        filters["status"] = status
+    if destination is not None:
+        filters["destination_id"] = destinations.lookup(destination)
+        if filters["destination_id"] is None:
+            return iter(())
+    if min_id is not None:
+        filters["id__gte"] = min_id
+    if max_id is not None:
+        filters["id__lte"] = max_id
+
+    models = [Order, OrderArchive] if include_archive else [Order]
+
+    rows = itertools.chain.from_iterable(
+        model.objects.filter(**filters).order_by("id").values_list(
+            *COLUMNS).iterator(chunk_size=chunk_size)
+        for model in models
+    )
+
+    return (
+        (order_id, destinations.name_of(destination_id), color, status)
+        for order_id, destination_id, color, status in rows
+    )
+
+
+def format_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row))) + "\n"
+
+
+def format_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for row in itertools.chain([FIELDS], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def format_rows(rows, export_format):
+    if export_format == "csv":
+        return format_csv(rows)
+
+    return format_ndjson(rows)
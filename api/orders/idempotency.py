@@ -0,0 +1,152 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from orders.models import IdempotencyKey
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+MAX_KEY_LENGTH = 255
+
+
+class LRUCache:
+    # Keeps at most `max_size` entries, dropping the least recently used
+    # first. Entries also expire `ttl` seconds after they were set.
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = LRUCache(
+                max_size=getattr(
+                    settings, "ORDERS_IDEMPOTENCY_CACHE_SIZE", 10000),
+                ttl=getattr(settings, "ORDERS_IDEMPOTENCY_CACHE_TTL", 300),
+            )
+
+        return _cache
+
+
+def get_key(request):
+    # Returns the Idempotency-Key header of the request, or None
+    return request.META.get(HEADER)
+
+
+def hash_request(body):
+    # A key may only be reused for the same request
+    return hashlib.sha256(body).hexdigest()
+
+
+def lookup(scope, key):
+    # Returns the (request hash, response data) stored for the key, or None.
+    # The cache only knows the keys this worker recorded or looked up, so
+    # the database is read on a miss.
+    stored = _get_cache().get((scope, key))
+    if stored is not None:
+        return stored
+
+    row = IdempotencyKey.objects.filter(scope=scope, key=key).values_list(
+        "request_hash", "response").first()
+    if row is None:
+        return None
+
+    stored = (row[0], json.loads(row[1]))
+    _get_cache().set((scope, key), stored)
+
+    return stored
+
+
+def record(scope, key, request_hash, data):
+    # Stores the response data for the key. Must run in the transaction
+    # that creates the orders, so that a concurrent request with the same
+    # key fails on the unique index and nothing it wrote is kept.
+    IdempotencyKey.objects.create(
+        scope=scope, key=key, request_hash=request_hash,
+        response=json.dumps(data))
+
+    transaction.on_commit(
+        lambda: _get_cache().set((scope, key), (request_hash, data)))
+
+
+def forget(scope, key):
+    # Removes a key whose request failed after it was recorded, so that a
+    # retry is handled as a new request
+    IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+    _get_cache().delete((scope, key))
+
+
+def purge(older_than, batch_size=1000, max_batches=None, now=None):
+    # Deletes keys created more than `older_than` (a timedelta) ago,
+    # `batch_size` keys per DELETE. Returns the number of keys deleted.
+    cutoff = (now or timezone.now()) - older_than
+    deleted = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        batches += 1
+
+        ids = list(IdempotencyKey.objects.filter(
+            created_at__lt=cutoff,
+        ).order_by("created_at").values_list("id", flat=True)[:batch_size])
+
+        if not ids:
+            break
+
+        IdempotencyKey.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+        if len(ids) < batch_size:
+            break
+
+    return deleted
+
+
+def clear():
+    _get_cache().clear()
@@ -0,0 +1,191 @@
+import csv
+import json
+import tempfile
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from orders.models import Destination, Order
+from orders import counters, destinations, leases, notify, validation
+
+FORMATS = ("csv", "ndjson")
+
+# The columns that the COPY import sets, with their values, when it adds
+# destinations and orders. Every NOT NULL column needs a value here, as
+# the model defaults are not known to the database. The %(...)s
+# parameters are those of _timestamps().
+DESTINATION_COLUMNS = (
+    ("name", "destination"),
+)
+ORDER_COLUMNS = (
+    ("destination_id", "d.id"),
+    ("color", "i.color"),
+    ("status", "i.status"),
+    ("version", "0"),
+    ("lease_expires_at",
+     "CASE WHEN i.status = %(active)s THEN %(lease_expires_at)s END"),
+    ("completed_at",
+     "CASE WHEN i.status = %(completed)s THEN %(completed_at)s END"),
+)
+
+
+def read_rows(f, file_format):
+    # Yields (line number, row) pairs. Rows that cannot be parsed are
+    # yielded as None.
+    if file_format == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+def _valid_orders(rows, on_reject):
+    # Yields (destination, color, status) for every valid row
+    for line_number, row in rows:
+        error = ("Bad row" if row is None
+                 else validation.validate_imported_order(row))
+
+        if error is not None:
+            if on_reject is not None:
+                on_reject(line_number, error)
+            continue
+
+        status = row.get("status")
+        if status is None or status == "":
+            status = Order.STATUS_NOT_ACTIVE
+
+        yield row["destination"], int(row["color"]), int(status)
+
+
+def _column_lists(columns):
+    return {
+        "columns": ", ".join(
+            connection.ops.quote_name(column) for column, _ in columns),
+        "values": ", ".join(value for _, value in columns),
+    }
+
+
+def _timestamps():
+    # Imported active orders get a lease, so that the reaper requeues them
+    # if no train completes them. Completed orders count as completed at
+    # the import, or the next archive run would move them all at once.
+    return {
+        "active": Order.STATUS_ACTIVE,
+        "lease_expires_at": leases.new_lease_expiry(),
+        "completed": Order.STATUS_COMPLETED,
+        "completed_at": timezone.now(),
+    }
+
+
+def _copy_orders(orders):
+    # Loads the orders into a staging table with COPY, then merges them
+    # into the orders table with a single INSERT ... SELECT, after adding
+    # the destinations that do not exist yet. The counters are then
+    # adjusted by the imported orders, grouped in the database.
+    count = 0
+
+    # Spills to disk when the import is large
+    with tempfile.SpooledTemporaryFile(
+            max_size=64 * 1024 * 1024, mode="w+", newline="") as buffer:
+        writer = csv.writer(buffer)
+        for order in orders:
+            writer.writerow(order)
+            count += 1
+        buffer.seek(0)
+
+        if not count:
+            return 0
+
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE orders_import ("
+                "destination text, color smallint, status smallint"
+                ") ON COMMIT DROP")
+            cursor.copy_expert(
+                "COPY orders_import (destination, color, status) "
+                "FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute(
+                "INSERT INTO {destination} ({columns}) "
+                "SELECT DISTINCT {values} FROM orders_import "
+                "ON CONFLICT (name) DO NOTHING".format(
+                    destination=quote(Destination._meta.db_table),
+                    **_column_lists(DESTINATION_COLUMNS)))
+            cursor.execute(
+                "INSERT INTO {order} ({columns}) "
+                "SELECT {values} FROM orders_import i "
+                "JOIN {destination} d ON d.name = i.destination".format(
+                    order=quote(Order._meta.db_table),
+                    destination=quote(Destination._meta.db_table),
+                    **_column_lists(ORDER_COLUMNS)),
+                _timestamps())
+            cursor.execute(
+                "SELECT d.id, i.status, count(*) FROM orders_import i "
+                "JOIN {destination} d ON d.name = i.destination "
+                "GROUP BY d.id, i.status".format(
+                    destination=quote(Destination._meta.db_table)))
+            counters.add_counts({
+                (destination_id, status): imported
+                for destination_id, status, imported in cursor.fetchall()
+            })
+
+    return count
+
+
+def _insert_orders(chunk):
+    Order.objects.bulk_create(chunk)
+    counters.add_orders((order.destination_id, order.status)
+                        for order in chunk)
+
+
+def _bulk_create_orders(orders, chunk_size):
+    count = 0
+    chunk = []
+    timestamps = _timestamps()
+
+    for destination, color, status in orders:
+        order = Order(destination_id=destinations.intern(destination),
+                      color=color, status=status)
+        if status == Order.STATUS_ACTIVE:
+            order.lease_expires_at = timestamps["lease_expires_at"]
+        elif status == Order.STATUS_COMPLETED:
+            order.completed_at = timestamps["completed_at"]
+        chunk.append(order)
+
+        if len(chunk) >= chunk_size:
+            _insert_orders(chunk)
+            count += len(chunk)
+            chunk = []
+
+    if chunk:
+        _insert_orders(chunk)
+        count += len(chunk)
+
+    return count
+
+
+def import_orders(f, file_format, chunk_size=1000, on_reject=None):
+    # Imports the orders in `f` in a single transaction. Invalid rows are
+    # skipped and passed to on_reject(line number, error). Returns the
+    # number of orders imported.
+    orders = _valid_orders(read_rows(f, file_format), on_reject)
+
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            imported = _copy_orders(orders)
+        else:
+            imported = _bulk_create_orders(orders, chunk_size)
+
+    if imported:
+        notify.get_notifier().notify()
+
+    return imported
@@ -0,0 +1,281 @@
+import atexit
+import collections
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DataError, IntegrityError, connection, transaction
+
+from orders.models import Order
+from orders import counters, destinations, notify, status_cache
+
+logger = logging.getLogger(__name__)
+
+# The databases reserve_ids can reserve order ids on
+ID_VENDORS = ("postgresql", "sqlite")
+
+
+def check_settings():
+    # Called when the app is loaded, so that a write-behind buffer that
+    # cannot reserve ids stops the worker from starting instead of failing
+    # the first order
+    if (getattr(settings, "ORDERS_WRITE_BEHIND", False) and
+            connection.vendor not in ID_VENDORS):
+        raise ImproperlyConfigured(
+            "ORDERS_WRITE_BEHIND needs a {} database, not {}".format(
+                " or ".join(ID_VENDORS), connection.vendor))
+
+
+def reserve_ids(count):
+    # Returns `count` order ids that no other insert will use
+    table = Order._meta.db_table
+
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                "FROM generate_series(1, %s)", [table, count])
+            return [row[0] for row in cursor.fetchall()]
+
+        if connection.vendor == "sqlite":
+            # AUTOINCREMENT tables keep their counter in sqlite_sequence,
+            # which only has a row after the first insert
+            with transaction.atomic():
+                cursor.execute(
+                    "SELECT seq FROM sqlite_sequence WHERE name = %s",
+                    [table])
+                row = cursor.fetchone()
+
+                if row is not None:
+                    start = row[0]
+                    cursor.execute(
+                        "UPDATE sqlite_sequence SET seq = %s "
+                        "WHERE name = %s", [start + count, table])
+                else:
+                    cursor.execute(
+                        "SELECT COALESCE(MAX(id), 0) FROM {}".format(table))
+                    start = cursor.fetchone()[0]
+                    cursor.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) "
+                        "VALUES (%s, %s)", [table, start + count])
+
+            return list(range(start + 1, start + count + 1))
+
+    raise NotImplementedError(
+        "Reserving order ids is not supported on {}".format(
+            connection.vendor))
+
+
+class WriteBehindBuffer:
+    # Holds validated orders in memory and writes them with bulk_create
+    # from a background thread, every `interval` seconds or as soon as
+    # `batch_size` orders are waiting. Ids are handed out from blocks
+    # reserved up front, so callers get their id before the insert.
+    #
+    # A batch that the database refuses is retried one order at a time.
+    # Orders it still refuses are logged and kept in dead_letters() instead
+    # of being retried forever.
+
+    def __init__(self, max_size, batch_size, interval, id_block_size):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.id_block_size = id_block_size
+
+        self._condition = threading.Condition()
+        self._orders = []
+        self._flushing = 0
+        self._ids = []
+        self._stopped = False
+        self._dead_letters = collections.deque(maxlen=max_size)
+
+        # Only taken to reserve a new block of ids, which is the only
+        # database work on the submitting side. Submitters and the flusher
+        # never wait on the database while holding _condition.
+        self._id_lock = threading.Lock()
+
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="orders-write-behind", daemon=True)
+        self._thread.start()
+
+    def _accepting(self):
+        with self._condition:
+            return not self._stopped and len(self._orders) < self.max_size
+
+    def _take_id(self):
+        with self._condition:
+            if self._ids:
+                return self._ids.pop(0)
+
+        return None
+
+    def reserve_id(self):
+        # Returns an id to submit an order with later, so that the id can be
+        # recorded before the order is queued
+        order_id = self._take_id()
+        if order_id is not None:
+            return order_id
+
+        with self._id_lock:
+            # Another thread may have reserved a block in the meantime
+            order_id = self._take_id()
+            if order_id is not None:
+                return order_id
+
+            ids = reserve_ids(self.id_block_size)
+            with self._condition:
+                self._ids.extend(ids[1:])
+
+            return ids[0]
+
+    def submit(self, destination, color, order_id=None):
+        # Returns the id of the queued order, or None if the buffer is full
+        if not self._accepting():
+            return None
+
+        destination_id = destinations.intern(destination)
+        if order_id is None:
+            order_id = self.reserve_id()
+
+        with self._condition:
+            if not self._accepting():
+                return None
+
+            order = Order(
+                id=order_id, destination_id=destination_id, color=color,
+                status=Order.STATUS_NOT_ACTIVE)
+            self._orders.append(order)
+
+            if len(self._orders) >= self.batch_size:
+                self._condition.notify_all()
+
+            return order.pk
+
+    def pending(self):
+        with self._condition:
+            return len(self._orders) + self._flushing
+
+    def dead_letters(self):
+        # The most recent orders that could not be written
+        with self._condition:
+            return list(self._dead_letters)
+
+    def _insert(self, batch):
+        with transaction.atomic():
+            Order.objects.bulk_create(batch)
+            counters.add_orders(
+                (order.destination_id, order.status) for order in batch)
+
+    def _written(self, batch):
+        for order in batch:
+            status_cache.set_status(order.pk, order.status, order.version)
+        notify.get_notifier().notify()
+
+    def flush(self):
+        # Writes everything queued so far. Returns the number of orders
+        # written.
+        with self._flush_lock:
+            with self._condition:
+                orders = self._orders
+                self._orders = []
+                self._flushing = len(orders)
+
+            done = 0
+            written = 0
+            try:
+                while done < len(orders):
+                    batch = orders[done:done + self.batch_size]
+                    try:
+                        self._insert(batch)
+                    except (DataError, IntegrityError):
+                        logger.exception(
+                            "Failed to write %s buffered orders, retrying "
+                            "them one by one", len(batch))
+                    else:
+                        done += len(batch)
+                        written += len(batch)
+                        self._written(batch)
+                        continue
+
+                    # Any other error, e.g. a lost connection, stops the
+                    # flush and the orders left are kept for the next one
+                    for order in batch:
+                        try:
+                            self._insert([order])
+                        except (DataError, IntegrityError):
+                            logger.exception(
+                                "Dropped buffered order %s (destination "
+                                "%s, color %s)", order.pk,
+                                order.destination_id, order.color)
+                            with self._condition:
+                                self._dead_letters.append(order)
+                        else:
+                            written += 1
+                            self._written([order])
+                        done += 1
+            except Exception:
+                # Keep the unwritten orders for the next flush, in order
+                with self._condition:
+                    self._orders = orders[done:] + self._orders
+                raise
+            finally:
+                with self._condition:
+                    self._flushing = 0
+
+        return written
+
+    def drain(self):
+        # Stops accepting orders and writes everything that is left
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: (self._stopped or
+                             len(self._orders) >= self.batch_size),
+                    self.interval)
+
+                if self._stopped:
+                    break
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write buffered orders")
+                connection.close()
+
+        connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(
+                max_size=getattr(
+                    settings, "ORDERS_WRITE_BEHIND_MAX_SIZE", 5000),
+                batch_size=getattr(
+                    settings, "ORDERS_WRITE_BEHIND_BATCH_SIZE", 100),
+                interval=getattr(
+                    settings, "ORDERS_WRITE_BEHIND_INTERVAL", 0.05),
+                id_block_size=getattr(
+                    settings, "ORDERS_WRITE_BEHIND_ID_BLOCK_SIZE", 100),
+            )
+
+            # Write out what is left when the worker shuts down
+            atexit.register(_buffer.drain)
+
+        return _buffer
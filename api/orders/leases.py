@@ -0,0 +1,61 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from orders.models import Order
+from orders import broadcast, counters, notify, status_cache
+
+
+def new_lease_expiry():
+    # When a lease taken now runs out
+    return timezone.now() + datetime.timedelta(
+        seconds=getattr(settings, "ORDERS_LEASE_DURATION", 300))
+
+
+def requeue_expired(batch_size=500, max_batches=None, now=None):
+    # Moves active orders whose lease has run out back to NOT_ACTIVE, at
+    # most `batch_size` per UPDATE. Returns the number of orders requeued.
+    # The lookup walks the lease index from the oldest expiry, so it only
+    # ever touches expired rows.
+    now = now or timezone.now()
+    requeued = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        batches += 1
+
+        ids = list(Order.objects.filter(
+            status=Order.STATUS_ACTIVE, lease_expires_at__lt=now,
+        ).order_by("lease_expires_at").values_list(
+            "id", flat=True)[:batch_size])
+
+        if not ids:
+            break
+
+        # Repeat the conditions in case a train completed the order or
+        # extended its lease in the meantime
+        with transaction.atomic():
+            batch_requeued = Order.objects.filter(
+                id__in=ids, status=Order.STATUS_ACTIVE,
+                lease_expires_at__lt=now,
+            ).update(status=Order.STATUS_NOT_ACTIVE, lease_expires_at=None,
+                     version=F("version") + 1)
+            counters.move(batch_requeued, Order.STATUS_ACTIVE,
+                          Order.STATUS_NOT_ACTIVE)
+        requeued += batch_requeued
+
+        states = Order.objects.filter(
+            id__in=ids).values_list("id", "status", "version")
+        for order_id, status, version in states:
+            status_cache.set_status(order_id, status, version)
+            broadcast.get_broadcaster().publish(order_id, status)
+
+        notify.get_notifier().notify()
+
+        if len(ids) < batch_size:
+            break
+
+    return requeued
@@ -0,0 +1,102 @@
+import base64
+import binascii
+import json
+
+from orders import destinations
+from orders.models import Order
+
+FIELDS = ("id", "destination", "color", "status")
+# The columns read for FIELDS, destination ids are turned into names
+COLUMNS = ("id", "destination_id", "color", "status")
+# The keys pages can be ordered by, id breaks status ties
+ORDERINGS = ("id", "status")
+
+
+def encode_cursor(query, after):
+    # Cursors are opaque to clients. They hold the query they continue and
+    # the key of the last order of the previous page.
+    data = json.dumps([query, after], separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, query):
+    # Returns the key to continue after, or None if the cursor is not valid
+    # for the query
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, binascii.Error):
+        return None
+
+    if not isinstance(data, list) or len(data) != 2 or data[0] != query:
+        return None
+
+    after = data[1]
+    if (not isinstance(after, list) or
+            len(after) != (1 if query["order"] == "id" else 2) or
+            not all(isinstance(value, int) and not isinstance(value, bool)
+                    for value in after)):
+        return None
+
+    return after
+
+
+def _rows(filters, after_id, limit):
+    # One index range scan that starts right after after_id, whatever the
+    # depth of the page
+    if after_id is not None:
+        filters = dict(filters, id__gt=after_id)
+
+    return list(Order.objects.filter(**filters).order_by("id").values_list(
+        *COLUMNS)[:limit])
+
+
+def list_orders(query, after=None, size=100):
+    # Returns up to `size` orders of the query, as dicts of FIELDS, and the
+    # key to continue after, or None on the last page. The query has the
+    # ordering and the status and destination filters, which may be None.
+    # No model instances are built and nothing is counted.
+    filters = {}
+    if query["destination"] is not None:
+        filters["destination_id"] = destinations.lookup(query["destination"])
+        if filters["destination_id"] is None:
+            return [], None
+    if query["status"] is not None:
+        filters["status"] = query["status"]
+
+    # One more row than asked for tells whether there is a next page
+    if query["order"] == "id":
+        rows = _rows(filters, after[0] if after else None, size + 1)
+    else:
+        # (status, id) order is one range per status, read in turn, so
+        # that each range is a scan of an index ending with id
+        after_status, after_id = after if after else (None, None)
+        statuses = ([query["status"]] if query["status"] is not None
+                    else Order.STATUS_FLOW)
+
+        rows = []
+        for status in statuses:
+            if after_status is not None and status < after_status:
+                continue
+
+            rows += _rows(
+                dict(filters, status=status),
+                after_id if status == after_status else None,
+                size + 1 - len(rows))
+            if len(rows) > size:
+                break
+
+    orders = [
+        dict(zip(FIELDS, (order_id, destinations.name_of(destination_id),
+                          color, status)))
+        for order_id, destination_id, color, status in rows[:size]
+    ]
+
+    if len(rows) <= size:
+        return orders, None
+
+    last = orders[-1]
+    if query["order"] == "id":
+        return orders, [last["id"]]
+
+    return orders, [last["status"], last["id"]]
@@ -0,0 +1,32 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from orders import archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves completed orders into the archive table, keeping the live "
+        "orders table small."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days", type=float, default=7,
+            help="Only archive orders completed at least this long ago")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of orders moved per transaction")
+        parser.add_argument(
+            "--max-batches", type=int, default=None,
+            help="Stop after this many batches")
+
+    def handle(self, *args, **options):
+        archived = archive.archive_completed(
+            datetime.timedelta(days=options["older_than_days"]),
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+        )
+
+        self.stdout.write("Archived {} orders".format(archived))
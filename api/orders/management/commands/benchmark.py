@@ -0,0 +1,100 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from orders import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the throughput and latency of the API endpoints by "
+        "sending a mix of requests through the WSGI handler. Runs against a "
+        "throwaway test copy of the default database, so use a settings "
+        "module pointing at SQLite or a local PostgreSQL. SQLite's in-memory "
+        "test database fails concurrent writes instead of waiting, so use "
+        "--threads 1 there."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mix", default=None,
+            help="Endpoint weights, e.g. new=4,claim=2,update=2,status=10,"
+                 "login=1")
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument(
+            "--seed-orders", type=int, default=100,
+            help="Number of orders created before the run")
+        parser.add_argument(
+            "--admission", action="store_true",
+            help="Keep admission control on, which sheds most of the load "
+                 "of a single process")
+        parser.add_argument(
+            "--output", help="Write the results as JSON to this file")
+        parser.add_argument(
+            "--baseline",
+            help="Fail if the results regressed against this JSON file")
+        parser.add_argument(
+            "--tolerance", type=float, default=0.1,
+            help="Allowed fraction of throughput or p95 latency regression")
+
+    def handle(self, *args, **options):
+        try:
+            mix = (benchmark.parse_mix(options["mix"])
+                   if options["mix"] else None)
+        except ValueError as e:
+            raise CommandError(e)
+
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = benchmark.run(
+                mix=mix,
+                requests=options["requests"],
+                threads=options["threads"],
+                seed_orders=options["seed_orders"],
+                admission=options["admission"],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.write_results(results)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            regressions = benchmark.compare(
+                results, baseline, options["tolerance"])
+
+            for regression in regressions:
+                self.stderr.write(regression)
+
+            if regressions:
+                raise CommandError("Performance regressed against baseline")
+
+    def write_results(self, results):
+        self.stdout.write(
+            "{} requests from {} threads on {} in {:.2f}s".format(
+                sum(endpoint["requests"]
+                    for endpoint in results["endpoints"].values()),
+                results["threads"], results["database"], results["elapsed"]))
+        self.stdout.write(
+            "{:<8} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+                "endpoint", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms",
+                "queries"))
+
+        for name, endpoint in sorted(results["endpoints"].items()):
+            self.stdout.write(
+                "{:<8} {:>8.1f} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}"
+                .format(name, endpoint["requests_per_second"],
+                        endpoint["errors"], endpoint["p50_ms"],
+                        endpoint["p95_ms"], endpoint["p99_ms"],
+                        endpoint["queries_per_request"]))
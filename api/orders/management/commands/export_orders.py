@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from orders import export
+
+
+class Command(BaseCommand):
+    help = "Streams orders as NDJSON or CSV without loading them into memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=export.FORMATS, default="ndjson")
+        parser.add_argument("--status", type=int, default=None)
+        parser.add_argument("--destination", default=None)
+        parser.add_argument("--min-id", type=int, default=None)
+        parser.add_argument("--max-id", type=int, default=None)
+        parser.add_argument(
+            "--include-archive", action="store_true",
+            help="Also export archived orders")
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000,
+            help="Number of rows fetched from the database at a time")
+        parser.add_argument(
+            "--output", default=None,
+            help="File to write to instead of stdout")
+
+    def handle(self, *args, **options):
+        rows = export.export_rows(
+            status=options["status"],
+            destination=options["destination"],
+            min_id=options["min_id"],
+            max_id=options["max_id"],
+            include_archive=options["include_archive"],
+            chunk_size=options["chunk_size"],
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(export.format_rows(rows, options["format"]))
+        else:
+            # Every line already ends with a newline, so none is added
+            for line in export.format_rows(rows, options["format"]):
+                self.stdout.write(line)
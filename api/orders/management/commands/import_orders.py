@@ -0,0 +1,47 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders import importer
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports orders from a CSV or NDJSON file with destination, color "
+        "and optional status fields. Uses COPY on PostgreSQL and chunked "
+        "bulk inserts elsewhere. Invalid rows are reported and skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format", choices=importer.FORMATS, default=None,
+            help="Defaults to the file extension")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Orders per INSERT when COPY is not available")
+
+    def handle(self, *args, **options):
+        file_format = options["format"]
+        if file_format is None:
+            file_format = os.path.splitext(options["path"])[1].lstrip(".")
+
+            if file_format not in importer.FORMATS:
+                raise CommandError(
+                    "Cannot tell the format of {}, use --format".format(
+                        options["path"]))
+
+        rejected = []
+
+        def on_reject(line_number, error):
+            rejected.append(line_number)
+            self.stderr.write("Rejected line {}: {}".format(
+                line_number, error))
+
+        with open(options["path"], newline="") as f:
+            imported = importer.import_orders(
+                f, file_format, chunk_size=options["chunk_size"],
+                on_reject=on_reject)
+
+        self.stdout.write("Imported {} orders, rejected {}".format(
+            imported, len(rejected)))
@@ -0,0 +1,35 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from orders import idempotency
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes stored Idempotency-Key responses that are old enough that "
+        "clients no longer retry with them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-seconds", type=float,
+            default=getattr(
+                settings, "ORDERS_IDEMPOTENCY_KEY_MAX_AGE", 24 * 60 * 60),
+            help="Only delete keys created at least this long ago")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of keys deleted per DELETE")
+        parser.add_argument(
+            "--max-batches", type=int, default=None,
+            help="Stop after this many batches")
+
+    def handle(self, *args, **options):
+        deleted = idempotency.purge(
+            datetime.timedelta(seconds=options["older_than_seconds"]),
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+        )
+
+        self.stdout.write("Deleted {} keys".format(deleted))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders import leases
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves active orders whose lease has expired back to not active, so "
+        "that another train can claim them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of orders requeued per UPDATE")
+        parser.add_argument(
+            "--max-batches", type=int, default=None,
+            help="Stop after this many batches per run")
+        parser.add_argument(
+            "--interval", type=float, default=None,
+            help="Keep running, reaping every this many seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            requeued = leases.requeue_expired(
+                batch_size=options["batch_size"],
+                max_batches=options["max_batches"],
+            )
+            self.stdout.write("Requeued {} orders".format(requeued))
+
+            if options["interval"] is None:
+                break
+
+            time.sleep(options["interval"])
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from orders import counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the orders by status and by destination and fixes the "
+        "counters served by the stats endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Only report drift, and fail if there is any")
+
+    def handle(self, *args, **options):
+        drift = counters.rebuild(check_only=options["check"])
+
+        for kind, key, recorded, actual in drift:
+            self.stdout.write("{} {}: counted {}, actually {}".format(
+                kind, key, recorded, actual))
+
+        if options["check"] and drift:
+            raise CommandError("The counters have drifted")
+
+        self.stdout.write("{} counters {}".format(
+            len(drift), "drifted" if options["check"] else "fixed"))
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destination', models.TextField()),
+                ('color', models.PositiveSmallIntegerField()),
+                ('status', models.SmallIntegerField()),
+            ],
+        ),
+    ]
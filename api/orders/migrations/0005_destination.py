@@ -0,0 +1,41 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_order_status_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Destination',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(unique=True)),
+            ],
+        ),
+        # The names stay until 0006 has copied them to Destination. They
+        # are nullable so that the migrations can be reversed.
+        migrations.AlterField(
+            model_name='order',
+            name='destination',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='orderarchive',
+            name='destination',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='destination_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='orders.Destination'),
+        ),
+        migrations.AddField(
+            model_name='orderarchive',
+            name='destination_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='orders.Destination'),
+        ),
+    ]
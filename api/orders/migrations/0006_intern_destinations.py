@@ -0,0 +1,47 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+MODELS = ('Order', 'OrderArchive')
+
+
+def intern_destinations(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Destination = apps.get_model('orders', 'Destination')
+
+    names = set()
+    for model_name in MODELS:
+        model = apps.get_model('orders', model_name)
+        names.update(model.objects.using(db_alias).values_list(
+            'destination', flat=True).distinct())
+
+    Destination.objects.using(db_alias).bulk_create(
+        [Destination(name=name) for name in names if name is not None])
+
+    # One UPDATE per table instead of one per destination
+    for model_name in MODELS:
+        model = apps.get_model('orders', model_name)
+        model.objects.using(db_alias).update(destination_ref=Subquery(
+            Destination.objects.filter(
+                name=OuterRef('destination')).values('id')[:1]))
+
+
+def restore_destination_names(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Destination = apps.get_model('orders', 'Destination')
+
+    for model_name in MODELS:
+        model = apps.get_model('orders', model_name)
+        model.objects.using(db_alias).update(destination=Subquery(
+            Destination.objects.filter(
+                pk=OuterRef('destination_ref')).values('name')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_destination'),
+    ]
+
+    operations = [
+        migrations.RunPython(intern_destinations, restore_destination_names),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_intern_destinations'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='order',
+            name='destination',
+        ),
+        migrations.RemoveField(
+            model_name='orderarchive',
+            name='destination',
+        ),
+        migrations.RenameField(
+            model_name='order',
+            old_name='destination_ref',
+            new_name='destination',
+        ),
+        migrations.RenameField(
+            model_name='orderarchive',
+            old_name='destination_ref',
+            new_name='destination',
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='destination',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='orders.Destination'),
+        ),
+        migrations.AlterField(
+            model_name='orderarchive',
+            name='destination',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='orders.Destination'),
+        ),
+    ]
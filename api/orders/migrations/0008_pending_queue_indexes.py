@@ -0,0 +1,25 @@
+from django.db import migrations
+
+# Partial indexes over pending orders only, so they stay small however many
+# orders have been completed. Each ends with id to keep queues FIFO.
+INDEXES = {
+    'orders_pending_destination_idx': '(destination_id, id)',
+    'orders_pending_color_idx': '(color, id)',
+    'orders_pending_queue_idx': '(destination_id, color, id)',
+}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_remove_destination_name'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX {} ON orders_order {} WHERE status = 0'.format(
+                name, columns),
+            'DROP INDEX {}'.format(name),
+        )
+        for name, columns in sorted(INDEXES.items())
+    ]
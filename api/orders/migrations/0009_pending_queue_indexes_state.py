@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+# 0008 created the partial indexes with RunSQL, so they were missing from
+# the migration state. Records them there without touching the database,
+# which already has them. SQLite applies schema changes by rebuilding the
+# table, and only recreates the indexes it knows about.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_pending_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='order',
+                    index=models.Index(condition=models.Q(status=0), fields=['destination', 'id'], name='orders_pending_destination_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='order',
+                    index=models.Index(condition=models.Q(status=0), fields=['color', 'id'], name='orders_pending_color_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='order',
+                    index=models.Index(condition=models.Q(status=0), fields=['destination', 'color', 'id'], name='orders_pending_queue_idx'),
+                ),
+            ],
+        ),
+    ]
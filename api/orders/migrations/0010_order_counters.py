@@ -0,0 +1,52 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_orders(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Destination = apps.get_model('orders', 'Destination')
+    StatusCount = apps.get_model('orders', 'StatusCount')
+
+    by_status = {status: 0 for status in (0, 1, 2)}
+    by_destination = {}
+    for model_name in ('Order', 'OrderArchive'):
+        model = apps.get_model('orders', model_name)
+        counts = model.objects.using(db_alias).order_by().values_list(
+            'destination_id', 'status').annotate(Count('id'))
+
+        for destination_id, status, count in counts:
+            by_status[status] = by_status.get(status, 0) + count
+            by_destination[destination_id] = \
+                by_destination.get(destination_id, 0) + count
+
+    StatusCount.objects.using(db_alias).bulk_create([
+        StatusCount(status=status, count=count)
+        for status, count in sorted(by_status.items())
+    ])
+    for destination_id, count in by_destination.items():
+        Destination.objects.using(db_alias).filter(
+            pk=destination_id).update(order_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0009_pending_queue_indexes_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='destination',
+            name='order_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StatusCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(unique=True)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0010_order_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='orderarchive',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0012_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='destination',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='orders.Destination'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['destination', 'id'], name='orders_destination_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['destination', 'status', 'id'], name='orders_destination_status_idx'),
+        ),
+    ]
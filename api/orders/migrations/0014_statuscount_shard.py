@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0013_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscount',
+            name='shard',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='statuscount',
+            name='status',
+            field=models.SmallIntegerField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='statuscount',
+            unique_together={('status', 'shard')},
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:44
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def move_counts(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Destination = apps.get_model('orders', 'Destination')
+    DestinationCount = apps.get_model('orders', 'DestinationCount')
+
+    DestinationCount.objects.using(db_alias).bulk_create([
+        DestinationCount(destination_id=destination_id, count=count)
+        for destination_id, count in Destination.objects.using(
+            db_alias).values_list('id', 'order_count')
+    ])
+
+
+def add_up_counts(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Destination = apps.get_model('orders', 'Destination')
+    DestinationCount = apps.get_model('orders', 'DestinationCount')
+
+    counts = DestinationCount.objects.using(db_alias).order_by().values_list(
+        'destination_id').annotate(Sum('count'))
+    for destination_id, count in counts:
+        Destination.objects.using(db_alias).filter(
+            pk=destination_id).update(order_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0014_statuscount_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DestinationCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.SmallIntegerField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('destination', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='counts', to='orders.Destination')),
+            ],
+            options={
+                'unique_together': {('destination', 'shard')},
+            },
+        ),
+        migrations.RunPython(move_counts, add_up_counts),
+        migrations.RemoveField(
+            model_name='destination',
+            name='order_count',
+        ),
+    ]
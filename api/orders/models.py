@@ -1,13 +1,31 @@
 from django.db import models
 
+from orders import destinations
+
+
+class Destination(models.Model):
+    # A train location, e.g. Bishan. Stored once and referenced by id, as
+    # the same few names repeat across all orders.
+    name = models.TextField(unique=True)
+
 
 class Order(models.Model):
-    # A train location, e.g. Bishan
-    destination = models.TextField()
+    # Indexed by orders_destination_id_idx instead
+    destination = models.ForeignKey(
+        Destination, on_delete=models.PROTECT, related_name="orders",
+        db_index=False)
     # PositiveSmallIntegerField accepts [0, 32767]
     color = models.PositiveSmallIntegerField()
     # SmallIntegerField accepts [-32768, 32767]
     status = models.SmallIntegerField()
+    # When the train working on an active order must extend its lease by,
+    # before the order is requeued. Empty unless the order is active.
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # Set when the order is completed, used to decide when to archive it
+    completed_at = models.DateTimeField(null=True, blank=True)
+    # Bumped on every status change, including requeues, so that clients
+    # can tell whether the status changed since they last read it
+    version = models.PositiveIntegerField(default=0)
 
     # The status values should be the same order as the flow and starting
     # from 0
@@ -16,10 +34,106 @@ class Order(models.Model):
     STATUS_COMPLETED = 2
     STATUS_FLOW = [STATUS_NOT_ACTIVE, STATUS_ACTIVE, STATUS_COMPLETED]
 
+    class Meta:
+        indexes = [
+            # Lets the oldest pending order be found without scanning the
+            # whole table
+            models.Index(fields=["status", "id"],
+                         name="orders_status_id_idx"),
+            # Serve the order listing filtered by destination, and by
+            # destination and status, a page at a time in id order
+            models.Index(fields=["destination", "id"],
+                         name="orders_destination_id_idx"),
+            models.Index(fields=["destination", "status", "id"],
+                         name="orders_destination_status_idx"),
+            # Lets expired leases be found without scanning the whole table
+            models.Index(fields=["lease_expires_at"],
+                         name="orders_lease_expires_idx"),
+            # Partial indexes over pending orders only, so they stay small
+            # however many orders have been completed. They serve the per
+            # destination and per color queues, ending with id to keep
+            # each queue FIFO.
+            models.Index(fields=["destination", "id"],
+                         name="orders_pending_destination_idx",
+                         condition=models.Q(status=0)),
+            models.Index(fields=["color", "id"],
+                         name="orders_pending_color_idx",
+                         condition=models.Q(status=0)),
+            models.Index(fields=["destination", "color", "id"],
+                         name="orders_pending_queue_idx",
+                         condition=models.Q(status=0)),
+        ]
+
+    def as_json(self):
+        return {
+            "id": self.id,
+            # Looked up in the process-wide cache instead of joining
+            "destination": destinations.name_of(self.destination_id),
+            "color": self.color,
+            "status": self.status,
+        }
+
+
+class OrderArchive(models.Model):
+    # Completed orders moved out of Order by the archive_orders command, so
+    # that the live table and its indexes stay small. Ids are kept.
+    id = models.IntegerField(primary_key=True)
+    destination = models.ForeignKey(
+        Destination, on_delete=models.PROTECT, related_name="+")
+    color = models.PositiveSmallIntegerField()
+    status = models.SmallIntegerField()
+    completed_at = models.DateTimeField(null=True, blank=True)
+    version = models.PositiveIntegerField(default=0)
+
     def as_json(self):
         return {
             "id": self.id,
-            "destination": self.destination,
+            "destination": destinations.name_of(self.destination_id),
             "color": self.color,
             "status": self.status,
         }
+
+
+class StatusCount(models.Model):
+    # Live and archived orders in each status, kept up to date by
+    # orders.counters so that stats never count the orders table. Each
+    # status is spread over several shard rows, summed when read, so that
+    # concurrent writers seldom update the same row.
+    status = models.SmallIntegerField()
+    shard = models.SmallIntegerField(default=0)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("status", "shard")]
+
+
+class DestinationCount(models.Model):
+    # Live and archived orders to each destination, kept up to date by
+    # orders.counters and split over shard rows like StatusCount.
+
+    # Indexed by the (destination, shard) unique index instead
+    destination = models.ForeignKey(
+        Destination, on_delete=models.CASCADE, related_name="counts",
+        db_index=False)
+    shard = models.SmallIntegerField(default=0)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("destination", "shard")]
+
+
+class IdempotencyKey(models.Model):
+    # The response to an order creation request sent with an
+    # Idempotency-Key header, so that a retry gets the same response
+    # instead of creating the orders again
+    scope = models.CharField(max_length=32)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the request body, a key cannot be reused for another
+    # request
+    request_hash = models.CharField(max_length=64)
+    # The JSON data of the response
+    response = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = [("scope", "key")]
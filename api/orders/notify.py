@@ -0,0 +1,177 @@
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "orders_new"
+
+
+class LocalNotifier:
+    # Wakes waiters in this process only. Each notification bumps a
+    # generation counter, so a waiter that read the counter before checking
+    # for orders cannot miss a notification sent after that check.
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    def current(self):
+        with self._condition:
+            return self._generation
+
+    def notify(self):
+        self._wake()
+
+    def wait(self, since, timeout):
+        # Returns True if there was a notification after the generation
+        # `since`, or False if the timeout expired first
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._generation != since, timeout)
+
+    def _wake(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+
+def poll_interval():
+    # Seconds between the checks of waiters while there is no listener
+    return getattr(settings, "ORDERS_POLL_INTERVAL", 1)
+
+
+class PostgresListener:
+    # Relays the NOTIFY payloads sent on a channel to a callback. A single
+    # daemon thread per process does the listening, so waiting requests
+    # hold no connection of their own. `on_resync` is called whenever
+    # notifications may have been missed: after connecting, and after the
+    # connection was lost.
+
+    def __init__(self, channel, on_notify, on_resync):
+        self.channel = channel
+        self._on_notify = on_notify
+        self._on_resync = on_resync
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._listening = threading.Event()
+
+    def start(self):
+        # Returns whether the listener is listening. Only the first call
+        # waits for it, for at most ORDERS_LISTEN_TIMEOUT seconds, so that
+        # requests do not hang while the database cannot be reached.
+        with self._thread_lock:
+            starting = self._thread is None
+            if starting:
+                self._thread = threading.Thread(
+                    target=self._listen, name=self.channel, daemon=True)
+                self._thread.start()
+
+        if starting:
+            # Notifications sent before LISTEN would be lost
+            self._listening.wait(
+                getattr(settings, "ORDERS_LISTEN_TIMEOUT", 2))
+
+        return self.is_listening()
+
+    def is_listening(self):
+        # When False, callers must poll instead of waiting for notifications
+        return self._listening.is_set()
+
+    def _listen(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**connection.get_connection_params())
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+                with conn.cursor() as cursor:
+                    cursor.execute("LISTEN {}".format(self.channel))
+
+                self._listening.set()
+                self._on_resync()
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        self._relay(conn.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("Lost the %s listener", self.channel)
+                self._listening.clear()
+                # Waiters switch to polling until the listener is back
+                self._on_resync()
+                if conn is not None:
+                    conn.close()
+                time.sleep(1)
+
+    def _relay(self, payload):
+        # A bad notification must not stop the ones after it
+        try:
+            self._on_notify(payload)
+        except Exception:
+            logger.exception(
+                "Bad %s notification %r", self.channel, payload)
+
+
+class PostgresNotifier(LocalNotifier):
+    # Sends NOTIFY so that waiters in every worker process are woken. While
+    # the listener is down, waiters are woken every poll_interval() instead,
+    # to look for orders again.
+
+    def __init__(self):
+        super().__init__()
+        self._listener = PostgresListener(
+            CHANNEL, on_notify=lambda payload: self._wake(),
+            on_resync=self._wake)
+
+    def current(self):
+        self._listener.start()
+        return super().current()
+
+    def wait(self, since, timeout):
+        if self._listener.is_listening():
+            return super().wait(since, timeout)
+
+        interval = poll_interval()
+        if timeout <= interval:
+            return super().wait(since, timeout)
+
+        super().wait(since, interval)
+        return True
+
+    def notify(self):
+        with connection.cursor() as cursor:
+            cursor.execute("NOTIFY {}".format(CHANNEL))
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    global _notifier
+
+    with _notifier_lock:
+        if _notifier is None:
+            backend = getattr(settings, "ORDERS_NOTIFY_BACKEND", None)
+
+            if backend is not None:
+                _notifier = import_string(backend)()
+            elif connection.vendor == "postgresql":
+                _notifier = PostgresNotifier()
+            else:
+                _notifier = LocalNotifier()
+
+        return _notifier
@@ -0,0 +1,141 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+from orders.models import Order, OrderArchive
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _get_cache():
+    return caches[getattr(settings, "ORDERS_STATUS_CACHE", "default")]
+
+
+def _make_key(order_id):
+    # Values are (status, version) pairs
+    return "order-state:{}".format(order_id)
+
+
+def _count(hits=0, misses=0):
+    with _stats_lock:
+        _stats["hits"] += hits
+        _stats["misses"] += misses
+
+
+def _remember(order_id, state):
+    # Reads only fill empty entries, so a read that raced with a write can
+    # never replace the value stored by that write
+    _get_cache().add(_make_key(order_id), state)
+
+
+def fetch_state(order_id):
+    # Reads the (status, version) of the order from the database, bypassing
+    # the cache. Archived orders are looked up after the live table, so an
+    # order archived in between is still found.
+    state = Order.objects.filter(
+        pk=order_id).values_list("status", "version").first()
+
+    if state is None:
+        state = OrderArchive.objects.filter(
+            pk=order_id).values_list("status", "version").first()
+
+    return state
+
+
+def fetch_status(order_id):
+    state = fetch_state(order_id)
+    return state[0] if state is not None else None
+
+
+def fetch_states(order_ids):
+    # Like fetch_state for many orders, with one query per table
+    states = {
+        order_id: (status, version)
+        for order_id, status, version in Order.objects.filter(
+            id__in=order_ids).values_list("id", "status", "version")
+    }
+
+    missing = set(order_ids) - states.keys()
+    if missing:
+        states.update(
+            (order_id, (status, version))
+            for order_id, status, version in OrderArchive.objects.filter(
+                id__in=missing).values_list("id", "status", "version"))
+
+    return states
+
+
+def get_state(order_id):
+    # Returns the (status, version) of the order, or None if there is no
+    # such order
+    state = _get_cache().get(_make_key(order_id))
+
+    if state is not None:
+        _count(hits=1)
+        return state
+
+    _count(misses=1)
+    state = fetch_state(order_id)
+
+    if state is not None:
+        _remember(order_id, state)
+
+    return state
+
+
+def get_status(order_id):
+    # Returns the status of the order, or None if there is no such order
+    state = get_state(order_id)
+    return state[0] if state is not None else None
+
+
+def get_statuses(order_ids):
+    # Returns a dict of order id to status, leaving out missing orders
+    keys = {_make_key(order_id): order_id for order_id in order_ids}
+    cached = _get_cache().get_many(keys.keys())
+
+    states = {keys[key]: state for key, state in cached.items()}
+    missed = set(order_ids) - states.keys()
+    _count(hits=len(states), misses=len(missed))
+
+    if missed:
+        # Only fetch the columns needed, for all misses at once
+        fetched = fetch_states(missed)
+
+        for order_id, state in fetched.items():
+            _remember(order_id, state)
+
+        states.update(fetched)
+
+    return {order_id: state[0] for order_id, state in states.items()}
+
+
+def set_status(order_id, status, version):
+    # Must be called after the write has been committed. Writers can get
+    # here in another order than they committed, e.g. the reaper and a
+    # train, so an entry is only replaced by a newer version. Two writers
+    # racing between the get and the set can still leave the older one,
+    # until the entry expires.
+    cache = _get_cache()
+    key = _make_key(order_id)
+    if cache.add(key, (status, version)):
+        return
+
+    cached = cache.get(key)
+    if cached is None or cached[1] < version:
+        cache.set(key, (status, version))
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def clear():
+    _get_cache().clear()
+
+    with _stats_lock:
+        _stats["hits"] = 0
+        _stats["misses"] = 0
@@ -1,14 +1,53 @@
+import datetime
+import io
 import json
-
-from django.test import TransactionTestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipIf, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+from django.test import (
+    Client, SimpleTestCase, TransactionTestCase, override_settings)
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 
+from base import routers
+import base.helpers as base_helpers
 from orders import views
 from orders import models
+from orders import benchmark
+from orders import broadcast
+from orders import counters
+from orders import archive
+from orders import destinations
+from orders import idempotency
+from orders import importer
+from orders import ingest
+from orders import leases
+from orders import listing
+from orders import notify
+from orders import status_cache
+from orders import wire
 
 
 class OrderViewTestCase(TransactionTestCase):
     def setUp(self, url, view):
+        # Ids are reused between tests, so cached statuses and
+        # destinations must not leak
+        status_cache.clear()
+        destinations.clear()
+        # Tables are emptied between tests, including the counter rows
+        counters.rebuild()
+
         self.factory = RequestFactory()
         self.order_url = url
         self.view = view
@@ -61,6 +100,29 @@ class NewOrderViewTestCase(OrderViewTestCase):
         }
         self.assertRequestStatusCode(payload, 400)
 
+        # Color too large for the column
+        payload = {
+            "destination": "Bishan",
+            "color": 40000,
+        }
+        self.assertRequestStatusCode(payload, 400)
+
+        # Not storable in a PostgreSQL text column
+        payload = {
+            "destination": "Bi\x00shan",
+            "color": 5,
+        }
+        self.assertRequestStatusCode(payload, 400)
+
+        # Not non-negative integers, though Python's int() and isdigit()
+        # accept some of them
+        for color in (True, -1, "-1", "\u00b2", 1.5):
+            payload = {
+                "destination": "Bishan",
+                "color": color,
+            }
+            self.assertRequestStatusCode(payload, 400)
+
     def test_create(self):
         payload = {
             "destination": "Bishan",
@@ -78,9 +140,109 @@ class NewOrderViewTestCase(OrderViewTestCase):
 
         # Check the contents of the new record
         db_order = query.first()
-        self.assertEqual(db_order.destination, "Bishan")
+        self.assertEqual(db_order.destination.name, "Bishan")
         self.assertEqual(db_order.color, 5)
 
+    def test_destination_is_stored_once(self):
+        payload = {
+            "destination": "Bishan",
+            "color": 5,
+        }
+        self.assertRequestStatusCode(payload, 200)
+
+        # The destination id is cached
+        with CaptureQueriesContext(connection) as queries:
+            self.assertRequestStatusCode(payload, 200)
+        self.assertFalse(any(query["sql"].startswith("SELECT")
+                             for query in queries))
+
+        self.assertEqual(models.Destination.objects.count(), 1)
+        self.assertEqual(
+            models.Order.objects.filter(
+                destination__name="Bishan").count(), 2)
+
+
+class NewOrderBatchViewTestCase(OrderViewTestCase):
+    def setUp(self):
+        super().setUp("/orders/new/batch", views.new_order_batch)
+
+    def test_invalid_batch(self):
+        # Not a list
+        self.assertRequestStatusCode({"destination": "Bishan"}, 400)
+
+        # Empty list
+        self.assertRequestStatusCode([], 400)
+
+    @override_settings(ORDERS_MAX_BATCH_SIZE=2)
+    def test_batch_too_large(self):
+        payload = [{"destination": "Bishan", "color": 5}] * 3
+        self.assertRequestStatusCode(payload, 400)
+
+        self.assertFalse(models.Order.objects.exists())
+
+    def test_create_batch(self):
+        payload = [
+            {"destination": "Bishan", "color": 5},
+            {"destination": 5, "color": 5},
+            {"destination": "Changi", "color": 0},
+            {"color": 5},
+        ]
+
+        response = self.assertRequestStatusCode(payload, 200)
+        results = json.loads(response.content)["data"]
+
+        # Each item gets either an id or an error, in request order
+        self.assertEqual(len(results), len(payload))
+        self.assertIn("error", results[1])
+        self.assertIn("error", results[3])
+
+        first = models.Order.objects.get(pk=results[0]["id"])
+        self.assertEqual(first.destination.name, "Bishan")
+        self.assertEqual(first.status, models.Order.STATUS_NOT_ACTIVE)
+
+        second = models.Order.objects.get(pk=results[2]["id"])
+        self.assertEqual(second.destination.name, "Changi")
+        self.assertEqual(second.color, 0)
+
+        self.assertEqual(models.Order.objects.count(), 2)
+
+    def test_batch_with_order_refused_by_database(self):
+        # A constraint the validation does not know about, refusing color
+        # 999
+        if connection.vendor == "sqlite":
+            create = (
+                "CREATE TRIGGER orders_refuse_color BEFORE INSERT ON "
+                "orders_order WHEN NEW.color = 999 BEGIN "
+                "SELECT RAISE(ABORT, 'refused'); END")
+            drop = "DROP TRIGGER orders_refuse_color"
+        else:
+            create = (
+                "ALTER TABLE orders_order ADD CONSTRAINT "
+                "orders_refuse_color CHECK (color <> 999)")
+            drop = ("ALTER TABLE orders_order DROP CONSTRAINT "
+                    "orders_refuse_color")
+
+        counters.rebuild()
+        with connection.cursor() as cursor:
+            cursor.execute(create)
+        try:
+            payload = [
+                {"destination": "Bishan", "color": 5},
+                {"destination": "Bishan", "color": 999},
+                {"destination": "Changi", "color": 6},
+            ]
+            response = self.assertRequestStatusCode(payload, 200)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(drop)
+
+        results = json.loads(response.content)["data"]
+        self.assertIn("error", results[1])
+        self.assertEqual(
+            sorted(models.Order.objects.values_list("id", "color")),
+            [(results[0]["id"], 5), (results[2]["id"], 6)])
+        self.assertEqual(counters.rebuild(check_only=True), [])
+
 
 class UpdateOrderViewTestCase(OrderViewTestCase):
     def setUp(self):
@@ -88,19 +250,19 @@ class UpdateOrderViewTestCase(OrderViewTestCase):
 
         # Create some orders
         self.not_active = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE,
         )
 
         self.active = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_ACTIVE,
         )
 
         self.completed = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_COMPLETED,
         )
@@ -153,6 +315,50 @@ class UpdateOrderViewTestCase(OrderViewTestCase):
         updated_order = models.Order.objects.get(pk=self.not_active.pk)
         self.assertEqual(updated_order.status, models.Order.STATUS_COMPLETED)
 
+    @skipIf(connection.vendor == "sqlite" and
+            connection.Database.sqlite_version_info < (3, 35),
+            "UPDATE ... RETURNING needs SQLite 3.35")
+    def test_update_queries(self):
+        payload = {
+            "id": self.not_active.pk,
+            "new_status": models.Order.STATUS_ACTIVE
+        }
+
+        # A conditional UPDATE of the order, which returns its new version
+        # for the status cache, and one of the status counters
+        with CaptureQueriesContext(connection) as queries:
+            self.assertRequestStatusCode(payload, 200)
+
+        statements = [query["sql"] for query in queries
+                      if query["sql"] != "BEGIN"]
+        self.assertEqual([sql.split()[0] for sql in statements],
+                         ["UPDATE", "UPDATE"])
+        self.assertIn("RETURNING", statements[0])
+
+    def test_rejected_update_messages(self):
+        def get_message(order_id, new_status):
+            payload = {
+                "id": order_id,
+                "new_status": new_status
+            }
+            response = self.assertRequestStatusCode(payload, 400)
+            return json.loads(response.content)["message"]
+
+        self.assertEqual(
+            get_message(self.completed.pk, models.Order.STATUS_COMPLETED),
+            "The order is already complete")
+        self.assertEqual(
+            get_message(self.not_active.pk, models.Order.STATUS_COMPLETED),
+            "Cannot update status beyond 1 step")
+        self.assertEqual(
+            get_message(500, models.Order.STATUS_ACTIVE),
+            "There is no order with that id")
+
+        # Rejected updates leave the order untouched
+        self.not_active.refresh_from_db()
+        self.assertEqual(self.not_active.status,
+                         models.Order.STATUS_NOT_ACTIVE)
+
     def test_update_with_missing_data(self):
         # Only id
         payload = {
@@ -196,13 +402,13 @@ class UncompletedOrderViewTestCase(OrderViewTestCase):
     def test_no_uncompleted_orders(self):
         # Create some completed and active orders
         models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_ACTIVE
         )
 
         models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_COMPLETED
         )
@@ -217,7 +423,7 @@ class UncompletedOrderViewTestCase(OrderViewTestCase):
     def test_get_uncompleted_orders(self):
         # Create an uncompleted order
         order = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE
         )
@@ -230,18 +436,18 @@ class UncompletedOrderViewTestCase(OrderViewTestCase):
 
     def test_returns_oldest_uncompleted_order(self):
         oldest_order = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE
         )
 
         models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE
         )
         models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE
         )
@@ -252,6 +458,271 @@ class UncompletedOrderViewTestCase(OrderViewTestCase):
         # Check that it returns the correct order
         self.assertEqual(response_json["data"]["id"], oldest_order.pk)
 
+    def test_invalid_wait(self):
+        self.assertRequestStatusCode({"wait": "asdf"}, 400)
+        self.assertRequestStatusCode({"wait": -1}, 400)
+        self.assertRequestStatusCode({"wait": True}, 400)
+        self.assertRequestStatusCode({"wait": float("nan")}, 400)
+        self.assertRequestStatusCode({"wait": float("inf")}, 400)
+
+    def test_filters_by_destination_and_color(self):
+        for destination, color in [("Bishan", 1), ("Changi", 1),
+                                   ("Changi", 2), ("Changi", 1)]:
+            models.Order.objects.create(
+                destination_id=destinations.intern(destination),
+                color=color,
+                status=models.Order.STATUS_NOT_ACTIVE
+            )
+        orders = list(models.Order.objects.order_by("id"))
+
+        def oldest(payload):
+            response = self.assertRequestStatusCode(payload, 200)
+            data = json.loads(response.content)["data"]
+            return data["id"] if data is not None else None
+
+        self.assertEqual(oldest({}), orders[0].pk)
+        self.assertEqual(oldest({"destination": "Changi"}), orders[1].pk)
+        self.assertEqual(oldest({"color": 2}), orders[2].pk)
+        self.assertEqual(oldest({"destination": "Bishan", "color": 1}),
+                         orders[0].pk)
+        self.assertIsNone(oldest({"destination": "Bishan", "color": 2}))
+        self.assertIsNone(oldest({"destination": "Tampines"}))
+
+    def test_invalid_filters(self):
+        self.assertRequestStatusCode({"destination": 5}, 400)
+        self.assertRequestStatusCode({"color": "asdf"}, 400)
+        self.assertRequestStatusCode({"color": -1}, 400)
+        self.assertRequestStatusCode({"color": True}, 400)
+
+    def test_wait_times_out(self):
+        start = time.monotonic()
+
+        # Without notifications the orders are only queried once
+        with self.assertNumQueries(1):
+            response = self.assertRequestStatusCode({"wait": 0.2}, 200)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertIsNone(json.loads(response.content)["data"])
+
+    def test_wait_is_woken_by_new_order(self):
+        factory = RequestFactory()
+        created = {}
+
+        def create_order():
+            try:
+                request = factory.post(
+                    "/orders/new",
+                    data={"destination": "Bishan", "color": 5},
+                    content_type="application/json")
+                response = views.new_order(request)
+                created["id"] = json.loads(response.content)["data"]["id"]
+            finally:
+                connection.close()
+
+        timer = threading.Timer(0.2, create_order)
+        timer.start()
+
+        start = time.monotonic()
+        response = self.assertRequestStatusCode({"wait": 10}, 200)
+        timer.join()
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(json.loads(response.content)["data"]["id"],
+                         created["id"])
+
+
+class ClaimOrderViewTestCase(OrderViewTestCase):
+    def setUp(self):
+        super().setUp("orders/claim", views.claim_order)
+
+    def test_no_uncompleted_orders(self):
+        models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_ACTIVE
+        )
+
+        response = self.send_request()
+        response_json = json.loads(response.content)
+
+        self.assertIsNone(response_json["data"])
+
+    def test_claims_oldest_uncompleted_order(self):
+        oldest_order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE
+        )
+        newer_order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE
+        )
+
+        response = self.send_request()
+        response_json = json.loads(response.content)
+
+        # Check that the oldest order is returned and activated
+        self.assertEqual(response_json["data"]["id"], oldest_order.pk)
+        self.assertEqual(response_json["data"]["status"],
+                         models.Order.STATUS_ACTIVE)
+
+        oldest_order.refresh_from_db()
+        self.assertEqual(oldest_order.status, models.Order.STATUS_ACTIVE)
+
+        # The next claim moves on to the newer order
+        response = self.send_request()
+        response_json = json.loads(response.content)
+        self.assertEqual(response_json["data"]["id"], newer_order.pk)
+
+    def test_concurrent_claims_are_unique(self):
+        order_count = 20
+        for _ in range(order_count):
+            models.Order.objects.create(
+                destination_id=destinations.intern("Bishan"),
+                color=5,
+                status=models.Order.STATUS_NOT_ACTIVE
+            )
+
+        def claim(_):
+            try:
+                response = self.send_request()
+                return json.loads(response.content)["data"]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            claimed = list(executor.map(claim, range(order_count + 10)))
+
+        claimed_ids = [order["id"] for order in claimed if order is not None]
+
+        # Every order is claimed exactly once
+        self.assertEqual(len(claimed_ids), order_count)
+        self.assertEqual(len(set(claimed_ids)), order_count)
+        self.assertFalse(models.Order.objects.filter(
+            status=models.Order.STATUS_NOT_ACTIVE).exists())
+
+    def test_claims_oldest_order_of_queue(self):
+        for color in [1, 2, 2]:
+            models.Order.objects.create(
+                destination_id=destinations.intern("Bishan"),
+                color=color,
+                status=models.Order.STATUS_NOT_ACTIVE
+            )
+        orders = list(models.Order.objects.order_by("id"))
+
+        claimed = [
+            json.loads(self.assertRequestStatusCode(
+                {"destination": "Bishan", "color": 2}, 200).content)["data"]
+            for _ in range(3)
+        ]
+
+        self.assertEqual([order["id"] for order in claimed[:2]],
+                         [orders[1].pk, orders[2].pk])
+        self.assertIsNone(claimed[2])
+        self.assertEqual(
+            models.Order.objects.get(pk=orders[0].pk).status,
+            models.Order.STATUS_NOT_ACTIVE)
+
+
+class ClaimTripViewTestCase(OrderViewTestCase):
+    def setUp(self):
+        super().setUp("orders/claim/trip", views.claim_trip)
+
+        # Bishan has the oldest pending order, Changi the most
+        for destination, color in [("Bishan", 1), ("Changi", 1),
+                                   ("Changi", 2), ("Bishan", 2),
+                                   ("Changi", 1)]:
+            models.Order.objects.create(
+                destination_id=destinations.intern(destination),
+                color=color,
+                status=models.Order.STATUS_NOT_ACTIVE
+            )
+        self.orders = list(models.Order.objects.order_by("id"))
+
+    def claim(self, payload):
+        response = self.assertRequestStatusCode(payload, 200)
+        return json.loads(response.content)["data"]
+
+    def test_claims_oldest_backlog(self):
+        trip = self.claim({})
+
+        self.assertEqual(trip["destination"], "Bishan")
+        self.assertEqual([order["id"] for order in trip["orders"]],
+                         [self.orders[0].pk, self.orders[3].pk])
+        self.assertEqual(
+            list(models.Order.objects.filter(
+                status=models.Order.STATUS_ACTIVE,
+            ).order_by("id").values_list("id", flat=True)),
+            [self.orders[0].pk, self.orders[3].pk])
+        self.assertIsNotNone(
+            models.Order.objects.get(pk=self.orders[0].pk).lease_expires_at)
+
+    def test_claims_largest_backlog(self):
+        trip = self.claim({"strategy": "largest", "size": 2})
+
+        self.assertEqual(trip["destination"], "Changi")
+        self.assertEqual([order["id"] for order in trip["orders"]],
+                         [self.orders[1].pk, self.orders[2].pk])
+
+    def test_claims_in_queue(self):
+        trip = self.claim({"color": 1, "strategy": "largest"})
+
+        self.assertEqual(trip["destination"], "Changi")
+        self.assertEqual([order["id"] for order in trip["orders"]],
+                         [self.orders[1].pk, self.orders[4].pk])
+
+        trip = self.claim({"destination": "Changi"})
+        self.assertEqual([order["id"] for order in trip["orders"]],
+                         [self.orders[2].pk])
+
+        self.assertIsNone(self.claim({"destination": "Changi"}))
+
+    def test_claims_every_destination_in_turn(self):
+        trips = [self.claim({"strategy": "largest"}) for _ in range(3)]
+
+        self.assertEqual([trip["destination"] for trip in trips[:2]],
+                         ["Changi", "Bishan"])
+        self.assertIsNone(trips[2])
+        self.assertFalse(models.Order.objects.filter(
+            status=models.Order.STATUS_NOT_ACTIVE).exists())
+
+    def test_invalid_trip(self):
+        self.assertRequestStatusCode({"size": 0}, 400)
+        self.assertRequestStatusCode({"size": "asdf"}, 400)
+        self.assertRequestStatusCode({"strategy": "asdf"}, 400)
+        self.assertRequestStatusCode({"color": -1}, 400)
+
+
+class QueueDepthsViewTestCase(TransactionTestCase):
+    def setUp(self):
+        destinations.clear()
+        self.factory = RequestFactory()
+
+    def test_queue_depths(self):
+        for destination, color, status in [
+                ("Bishan", 1, models.Order.STATUS_NOT_ACTIVE),
+                ("Changi", 2, models.Order.STATUS_NOT_ACTIVE),
+                ("Changi", 2, models.Order.STATUS_NOT_ACTIVE),
+                ("Changi", 2, models.Order.STATUS_ACTIVE),
+                ("Tampines", 3, models.Order.STATUS_COMPLETED)]:
+            models.Order.objects.create(
+                destination_id=destinations.intern(destination),
+                color=color,
+                status=status,
+            )
+        orders = list(models.Order.objects.order_by("id"))
+
+        response = views.queue_depths(self.factory.get("/orders/queues/"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["data"], [
+            {"destination": "Changi", "color": 2, "pending": 2,
+             "oldest_id": orders[1].pk},
+            {"destination": "Bishan", "color": 1, "pending": 1,
+             "oldest_id": orders[0].pk},
+        ])
+
 
 class OrderStatusViewTestCase(OrderViewTestCase):
     def setUp(self):
@@ -259,19 +730,19 @@ class OrderStatusViewTestCase(OrderViewTestCase):
 
         # Create some orders
         self.not_active = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_NOT_ACTIVE,
         )
 
         self.active = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_ACTIVE,
         )
 
         self.completed = models.Order.objects.create(
-            destination="Bishan",
+            destination_id=destinations.intern("Bishan"),
             color=5,
             status=models.Order.STATUS_COMPLETED,
         )
@@ -318,3 +789,1900 @@ class OrderStatusViewTestCase(OrderViewTestCase):
 
         order_status = response_json["data"]["status"]
         self.assertEqual(order_status, models.Order.STATUS_COMPLETED)
+
+    def test_get_status_batch(self):
+        payload = {
+            "ids": [self.not_active.pk, self.completed.pk, 500],
+        }
+
+        # One query for the live orders, and one to look for the missing id
+        # in the archive
+        with self.assertNumQueries(2):
+            response = self.assertRequestStatusCode(payload, 200)
+        response_json = json.loads(response.content)
+
+        self.assertEqual(response_json["data"]["statuses"], {
+            str(self.not_active.pk): models.Order.STATUS_NOT_ACTIVE,
+            str(self.completed.pk): models.Order.STATUS_COMPLETED,
+        })
+        self.assertEqual(response_json["data"]["missing"], [500])
+
+    def test_get_status_batch_invalid_ids(self):
+        # Not a list
+        self.assertRequestStatusCode({"ids": self.active.pk}, 400)
+
+        # Empty list
+        self.assertRequestStatusCode({"ids": []}, 400)
+
+        # Invalid id in the list
+        self.assertRequestStatusCode({"ids": [self.active.pk, "asdf"]}, 400)
+
+        # Too many ids
+        with override_settings(ORDERS_MAX_BATCH_SIZE=2):
+            payload = {
+                "ids": [self.not_active.pk, self.active.pk,
+                        self.completed.pk],
+            }
+            self.assertRequestStatusCode(payload, 400)
+
+
+class OrderStatusDetailViewTestCase(OrderViewTestCase):
+    def setUp(self):
+        super().setUp("/orders/update", views.update_order)
+
+        self.order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE,
+        )
+
+    def get(self, order_id, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag is not None else {}
+        request = self.factory.get(
+            "/orders/status/{}/".format(order_id), **headers)
+
+        return views.order_status_detail(request, order_id=order_id)
+
+    def test_get_status(self):
+        response = self.get(self.order.pk)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"0"')
+        self.assertEqual(json.loads(response.content)["data"], {
+            "id": self.order.pk,
+            "status": models.Order.STATUS_NOT_ACTIVE,
+            "version": 0,
+        })
+
+    def test_unchanged_status_is_not_modified(self):
+        etag = self.get(self.order.pk)["ETag"]
+
+        # Served from the status cache
+        with self.assertNumQueries(0):
+            response = self.get(self.order.pk, etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        # Caches must not answer a binary request with a JSON response
+        self.assertIn("Accept", response["Vary"])
+
+    def test_status_change_changes_etag(self):
+        etag = self.get(self.order.pk)["ETag"]
+
+        self.assertRequestStatusCode({
+            "id": self.order.pk,
+            "new_status": models.Order.STATUS_ACTIVE,
+        }, 200)
+
+        response = self.get(self.order.pk, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"1"')
+
+        # A requeue returns to an earlier status with a new version
+        models.Order.objects.filter(pk=self.order.pk).update(
+            lease_expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        leases.requeue_expired()
+
+        response = self.get(self.order.pk, '"0", "1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"2"')
+        self.assertEqual(json.loads(response.content)["data"]["status"],
+                         models.Order.STATUS_NOT_ACTIVE)
+
+    def test_claim_changes_etag(self):
+        etag = self.get(self.order.pk)["ETag"]
+
+        views.claim_order(self.factory.post("/orders/claim"))
+
+        self.assertEqual(self.get(self.order.pk, etag)["ETag"], '"1"')
+
+    def test_missing_order(self):
+        response = self.get(500)
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response)
+
+
+class OrderStatusCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        self.factory = RequestFactory()
+
+        self.order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE,
+        )
+
+    def send_request(self, view, url, data):
+        request = self.factory.post(url, data=data,
+                                    content_type="application/json")
+        return json.loads(view(request).content)
+
+    def get_status(self):
+        response_json = self.send_request(
+            views.order_status, "/orders/status", {"id": self.order.pk})
+        return response_json["data"]["status"]
+
+    def update_status(self, new_status):
+        response_json = self.send_request(
+            views.update_order, "/orders/update",
+            {"id": self.order.pk, "new_status": new_status})
+        self.assertTrue(response_json["success"])
+
+    def test_reads_are_cached(self):
+        with self.assertNumQueries(1):
+            self.get_status()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_status(),
+                             models.Order.STATUS_NOT_ACTIVE)
+
+        self.assertEqual(status_cache.get_stats(), {"hits": 1, "misses": 1})
+
+    def test_reads_follow_writes(self):
+        self.assertEqual(self.get_status(), models.Order.STATUS_NOT_ACTIVE)
+
+        self.update_status(models.Order.STATUS_ACTIVE)
+        self.assertEqual(self.get_status(), models.Order.STATUS_ACTIVE)
+
+        self.update_status(models.Order.STATUS_COMPLETED)
+        self.assertEqual(self.get_status(), models.Order.STATUS_COMPLETED)
+
+    def test_new_orders_are_cached(self):
+        response_json = self.send_request(
+            views.new_order, "/orders/new",
+            {"destination": "Bishan", "color": 5})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                status_cache.get_status(response_json["data"]["id"]),
+                models.Order.STATUS_NOT_ACTIVE)
+
+    def test_stale_read_cannot_overwrite_write(self):
+        # A reader fetched the old status from the DB, but only tries to
+        # cache it after a write has gone through
+        self.update_status(models.Order.STATUS_ACTIVE)
+        status_cache._remember(
+            self.order.pk,
+            (models.Order.STATUS_NOT_ACTIVE, self.order.version))
+
+        self.assertEqual(self.get_status(), models.Order.STATUS_ACTIVE)
+
+    def test_late_write_cannot_overwrite_newer_write(self):
+        # A train's activation committed before the reaper requeued the
+        # order, but the train caches its state last
+        status_cache.set_status(
+            self.order.pk, models.Order.STATUS_NOT_ACTIVE, 2)
+        status_cache.set_status(self.order.pk, models.Order.STATUS_ACTIVE, 1)
+        self.assertEqual(status_cache.get_state(self.order.pk),
+                         (models.Order.STATUS_NOT_ACTIVE, 2))
+
+        status_cache.set_status(self.order.pk, models.Order.STATUS_ACTIVE, 3)
+        self.assertEqual(status_cache.get_state(self.order.pk),
+                         (models.Order.STATUS_ACTIVE, 3))
+
+    def test_batch_reads_are_cached(self):
+        other = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_ACTIVE,
+        )
+        self.get_status()
+
+        # Only the uncached order is fetched
+        with self.assertNumQueries(1):
+            statuses = status_cache.get_statuses([self.order.pk, other.pk])
+
+        self.assertEqual(statuses, {
+            self.order.pk: models.Order.STATUS_NOT_ACTIVE,
+            other.pk: models.Order.STATUS_ACTIVE,
+        })
+
+        with self.assertNumQueries(0):
+            status_cache.get_statuses([self.order.pk, other.pk])
+
+
+class OrderStatusStreamTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        self.factory = RequestFactory()
+
+        self.order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE,
+        )
+
+    def open_stream(self, order_id):
+        request = self.factory.get(
+            "/orders/status/{}/events".format(order_id))
+        return views.order_status_stream(request, order_id=order_id)
+
+    def update_status(self, new_status):
+        request = self.factory.post(
+            "/orders/update",
+            data={"id": self.order.pk, "new_status": new_status},
+            content_type="application/json")
+        self.assertEqual(views.update_order(request).status_code, 200)
+
+    def read_event(self, events):
+        event = next(events).decode()
+        data = event.split("data: ", 1)[1]
+        return json.loads(data)["status"]
+
+    def test_stream_status_changes(self):
+        response = self.open_stream(self.order.pk)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = iter(response.streaming_content)
+
+        # The current status is sent first
+        self.assertEqual(self.read_event(events),
+                         models.Order.STATUS_NOT_ACTIVE)
+
+        self.update_status(models.Order.STATUS_ACTIVE)
+        self.assertEqual(self.read_event(events),
+                         models.Order.STATUS_ACTIVE)
+
+        self.update_status(models.Order.STATUS_COMPLETED)
+        self.assertEqual(self.read_event(events),
+                         models.Order.STATUS_COMPLETED)
+
+        # The stream ends once the order is complete
+        with self.assertRaises(StopIteration):
+            next(events)
+
+        response.close()
+
+    def test_stream_nonexistent_order(self):
+        response = self.open_stream(500)
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(ORDERS_MAX_STREAMS=1)
+    def test_stream_limit(self):
+        first = self.open_stream(self.order.pk)
+        self.assertEqual(first.status_code, 200)
+
+        self.assertEqual(self.open_stream(self.order.pk).status_code, 503)
+
+        # Closing a stream frees its slot, even if it was never read
+        first.close()
+        second = self.open_stream(self.order.pk)
+        self.assertEqual(second.status_code, 200)
+        second.close()
+
+    def test_stream_polls_without_broadcasts(self):
+        broadcaster = broadcast.get_broadcaster()
+        with mock.patch.object(broadcaster, "poll_interval",
+                               return_value=0.01):
+            response = self.open_stream(self.order.pk)
+            events = iter(response.streaming_content)
+            self.read_event(events)
+
+            # A change that was never published is found by polling
+            models.Order.objects.filter(pk=self.order.pk).update(
+                status=models.Order.STATUS_ACTIVE)
+            self.assertEqual(self.read_event(events),
+                             models.Order.STATUS_ACTIVE)
+
+            response.close()
+
+
+class PostgresListenerTestCase(SimpleTestCase):
+    @override_settings(ORDERS_LISTEN_TIMEOUT=0.05)
+    def test_start_gives_up_waiting(self):
+        # The database cannot be reached. The listener thread ends once the
+        # test is over.
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def connect(**params):
+            released.wait()
+            raise SystemExit
+
+        patcher = mock.patch("psycopg2.connect", side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        listener = notify.PostgresListener("test", mock.Mock(), mock.Mock())
+        start = time.monotonic()
+        self.assertFalse(listener.start())
+        self.assertLess(time.monotonic() - start, 1)
+
+        # Only the first caller waits for the listener
+        with mock.patch.object(listener._listening, "wait") as wait:
+            self.assertFalse(listener.start())
+        wait.assert_not_called()
+
+    def test_bad_notification_is_skipped(self):
+        received = []
+
+        def on_notify(payload):
+            received.append(int(payload))
+
+        listener = notify.PostgresListener("test", on_notify, mock.Mock())
+
+        with self.assertLogs("orders.notify", "ERROR"):
+            listener._relay("not a number")
+        listener._relay("5")
+
+        self.assertEqual(received, [5])
+
+    @override_settings(ORDERS_POLL_INTERVAL=0.01)
+    def test_notifier_polls_without_listener(self):
+        notifier = notify.PostgresNotifier()
+
+        with mock.patch.object(notifier._listener, "is_listening",
+                               return_value=False):
+            # Asks the caller to look again after the poll interval
+            start = time.monotonic()
+            self.assertTrue(notifier.wait(notifier._generation, 5))
+            self.assertLess(time.monotonic() - start, 1)
+
+        with mock.patch.object(notifier._listener, "is_listening",
+                               return_value=True):
+            self.assertFalse(notifier.wait(notifier._generation, 0.01))
+
+    @override_settings(ORDERS_POLL_INTERVAL=0.01)
+    def test_subscriptions_poll_without_listener(self):
+        broadcaster = broadcast.PostgresBroadcaster()
+
+        with mock.patch.object(broadcaster._listener, "start"), \
+                mock.patch.object(broadcaster._listener, "is_listening",
+                                  return_value=False):
+            subscription = broadcaster.subscribe(1)
+            self.assertIs(subscription.get(5), broadcast.RESYNC)
+
+        # A malformed payload is logged by the listener, not delivered
+        with self.assertLogs("orders.notify", "ERROR"):
+            broadcaster._listener._relay("1")
+        broadcaster._listener._relay("1:2")
+        self.assertEqual(subscription.get(0), 2)
+
+
+class WriteBehindBufferTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+
+    def test_no_orders_lost_or_duplicated(self):
+        order_count = 200
+        # One id block covers every order, so only the flusher writes while
+        # orders are being submitted
+        buffer = ingest.WriteBehindBuffer(
+            max_size=order_count, batch_size=7, interval=0.01,
+            id_block_size=order_count)
+
+        def submit(i):
+            try:
+                return buffer.submit("Bishan", i % 10)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            order_ids = list(executor.map(submit, range(order_count)))
+
+        buffer.drain()
+
+        self.assertNotIn(None, order_ids)
+        self.assertEqual(len(set(order_ids)), order_count)
+        self.assertEqual(buffer.pending(), 0)
+
+        db_ids = list(models.Order.objects.values_list("id", flat=True))
+        self.assertEqual(sorted(db_ids), sorted(order_ids))
+
+    def test_full_buffer_rejects_orders(self):
+        buffer = ingest.WriteBehindBuffer(
+            max_size=2, batch_size=100, interval=60, id_block_size=10)
+
+        self.assertIsNotNone(buffer.submit("Bishan", 5))
+        self.assertIsNotNone(buffer.submit("Bishan", 5))
+        self.assertIsNone(buffer.submit("Bishan", 5))
+
+        # Draining writes the queued orders and stops accepting new ones
+        buffer.drain()
+        self.assertEqual(models.Order.objects.count(), 2)
+        self.assertIsNone(buffer.submit("Bishan", 5))
+
+    def test_refused_orders_are_dead_lettered(self):
+        counters.rebuild()
+        existing = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"), color=5,
+            status=models.Order.STATUS_NOT_ACTIVE)
+        counters.add_orders([(existing.destination_id, existing.status)])
+        buffer = ingest.WriteBehindBuffer(
+            max_size=10, batch_size=100, interval=60, id_block_size=10)
+
+        first = buffer.submit("Bishan", 1)
+        # The id is taken already, so the database refuses the batch
+        buffer.submit("Bishan", 2, order_id=existing.pk)
+        last = buffer.submit("Changi", 3)
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.pending(), 0)
+        self.assertEqual(
+            [order.color for order in buffer.dead_letters()], [2])
+        self.assertEqual(
+            sorted(models.Order.objects.values_list("id", "color")),
+            sorted([(existing.pk, 5), (first, 1), (last, 3)]))
+        self.assertEqual(counters.rebuild(check_only=True), [])
+
+        # Nothing is left to retry
+        self.assertEqual(buffer.flush(), 0)
+        buffer.drain()
+
+    def test_reserving_ids_does_not_block_the_buffer(self):
+        buffer = ingest.WriteBehindBuffer(
+            max_size=10, batch_size=100, interval=60, id_block_size=10)
+        destinations.intern("Bishan")
+
+        def submit():
+            try:
+                buffer.submit("Bishan", 1)
+            finally:
+                connection.close()
+
+        # Holding the lock stands in for a slow reservation of the next
+        # block of ids
+        with buffer._id_lock:
+            thread = threading.Thread(target=submit)
+            thread.start()
+            time.sleep(0.05)
+
+            self.assertEqual(buffer.pending(), 0)
+            self.assertEqual(buffer.submit("Bishan", 2, order_id=1000), 1000)
+            self.assertEqual(buffer.pending(), 1)
+
+        thread.join()
+        self.assertEqual(buffer.pending(), 2)
+        buffer.drain()
+
+    @override_settings(ORDERS_WRITE_BEHIND=True)
+    def test_check_settings(self):
+        ingest.check_settings()
+
+        with mock.patch.object(connection, "vendor", "oracle"):
+            with self.assertRaises(ImproperlyConfigured):
+                ingest.check_settings()
+
+            with self.settings(ORDERS_WRITE_BEHIND=False):
+                ingest.check_settings()
+
+    def test_reserved_ids_do_not_collide(self):
+        first = ingest.reserve_ids(5)
+        order = models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=models.Order.STATUS_NOT_ACTIVE,
+        )
+        second = ingest.reserve_ids(5)
+
+        ids = first + [order.pk] + second
+        self.assertEqual(len(set(ids)), len(ids))
+
+    @override_settings(ORDERS_WRITE_BEHIND=True)
+    def test_new_order_write_behind(self):
+        factory = RequestFactory()
+        request = factory.post(
+            "/orders/new", data={"destination": "Bishan", "color": 5},
+            content_type="application/json")
+
+        try:
+            response = views.new_order(request)
+            order_id = json.loads(response.content)["data"]["id"]
+            ingest.get_buffer().drain()
+        finally:
+            ingest._buffer = None
+
+        order = models.Order.objects.get(pk=order_id)
+        self.assertEqual(order.destination.name, "Bishan")
+        self.assertEqual(order.status, models.Order.STATUS_NOT_ACTIVE)
+
+
+class BenchmarkTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+
+    def test_run(self):
+        mix = benchmark.parse_mix("new=2,claim=2,update=2,status=2,login=1")
+        results = benchmark.run(
+            mix=mix, requests=40, threads=1, seed_orders=20)
+
+        self.assertEqual(set(results["endpoints"]),
+                         {"new", "claim", "update", "status", "login"})
+
+        for endpoint in results["endpoints"].values():
+            self.assertEqual(endpoint["errors"], 0)
+            self.assertLessEqual(endpoint["p50_ms"], endpoint["p99_ms"])
+
+        # Creating an order is an INSERT and two counter updates, plus
+        # BEGIN on backends that send it as a query
+        self.assertLessEqual(
+            results["endpoints"]["new"]["queries_per_request"], 4)
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=0)
+    def test_admission_is_off(self):
+        mix = benchmark.parse_mix("status=1")
+
+        results = benchmark.run(
+            mix=mix, requests=5, threads=1, seed_orders=2)
+        self.assertEqual(results["endpoints"]["status"]["errors"], 0)
+
+        # With admission control on, there is no concurrency slot to take
+        results = benchmark.run(
+            mix=mix, requests=5, threads=1, seed_orders=2, admission=True)
+        self.assertEqual(results["endpoints"]["status"]["errors"], 5)
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(benchmark.percentile(values, 0.5), 5)
+        self.assertEqual(benchmark.percentile(values, 0.9), 9)
+        self.assertEqual(benchmark.percentile(values, 0.95), 10)
+        self.assertEqual(benchmark.percentile(values, 0), 1)
+        self.assertEqual(benchmark.percentile(values, 1), 10)
+
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4, 5, 6], 0.5), 3)
+        self.assertEqual(
+            benchmark.percentile(list(range(1, 31)), 0.1), 3)
+        self.assertEqual(benchmark.percentile([7], 0.99), 7)
+        self.assertEqual(benchmark.percentile([], 0.5), 0)
+
+    def test_parse_mix(self):
+        self.assertEqual(benchmark.parse_mix("new=1, status=3"),
+                         {"new": 1, "status": 3})
+
+        with self.assertRaises(ValueError):
+            benchmark.parse_mix("unknown=1")
+
+        with self.assertRaises(ValueError):
+            benchmark.parse_mix("new=0")
+
+    def test_compare(self):
+        def make_results(rps, p95, queries):
+            return {"endpoints": {"status": {
+                "requests_per_second": rps,
+                "p95_ms": p95,
+                "queries_per_request": queries,
+            }}}
+
+        baseline = make_results(100, 10, 1)
+
+        self.assertEqual(
+            benchmark.compare(make_results(95, 10.5, 1), baseline), [])
+        self.assertEqual(
+            len(benchmark.compare(make_results(50, 20, 2), baseline)), 3)
+
+
+class OrderLeaseTestCase(OrderViewTestCase):
+    def setUp(self):
+        super().setUp("/orders/update", views.update_order)
+
+    def create_order(self, status, lease_expires_at=None):
+        return models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=status,
+            lease_expires_at=lease_expires_at,
+        )
+
+    def test_activation_starts_lease(self):
+        order = self.create_order(models.Order.STATUS_NOT_ACTIVE)
+
+        payload = {
+            "id": order.pk,
+            "new_status": models.Order.STATUS_ACTIVE,
+        }
+        response = self.assertRequestStatusCode(payload, 200)
+        data = json.loads(response.content)["data"]
+
+        order.refresh_from_db()
+        self.assertGreater(order.lease_expires_at, timezone.now())
+        self.assertEqual(data["lease_expires_at"],
+                         order.lease_expires_at.isoformat())
+        self.assertEqual(data["lease_token"], order.version)
+        self.assertEqual(status_cache.get_state(order.pk),
+                         (models.Order.STATUS_ACTIVE, order.version))
+
+        # Completing the order ends the lease
+        payload["new_status"] = models.Order.STATUS_COMPLETED
+        payload["lease_token"] = data["lease_token"]
+        self.assertRequestStatusCode(payload, 200)
+
+        order.refresh_from_db()
+        self.assertIsNone(order.lease_expires_at)
+        self.assertEqual(status_cache.get_state(order.pk),
+                         (models.Order.STATUS_COMPLETED, order.version))
+
+    def test_claim_starts_lease(self):
+        order = self.create_order(models.Order.STATUS_NOT_ACTIVE)
+
+        views.claim_order(self.factory.post("/orders/claim"))
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.STATUS_ACTIVE)
+        self.assertGreater(order.lease_expires_at, timezone.now())
+
+    def test_extend_lease(self):
+        expiry = timezone.now() + datetime.timedelta(seconds=1)
+        order = self.create_order(models.Order.STATUS_ACTIVE, expiry)
+
+        payload = {
+            "id": order.pk,
+            "extend_lease": True,
+        }
+        # Clients without the lease token get it back
+        response = self.assertRequestStatusCode(payload, 200)
+        self.assertEqual(
+            json.loads(response.content)["data"]["lease_token"],
+            order.version)
+
+        order.refresh_from_db()
+        self.assertGreater(order.lease_expires_at, expiry)
+
+        payload["lease_token"] = order.version
+        self.assertRequestStatusCode(payload, 200)
+
+        payload["lease_token"] = "asdf"
+        self.assertRequestStatusCode(payload, 400)
+        payload["lease_token"] = order.version
+
+        # Only active orders have a lease to extend
+        completed = self.create_order(models.Order.STATUS_COMPLETED)
+        payload["id"] = completed.pk
+        self.assertRequestStatusCode(payload, 400)
+
+    def test_requeued_lease_is_fenced(self):
+        self.create_order(models.Order.STATUS_NOT_ACTIVE)
+
+        def claim():
+            response = views.claim_order(self.factory.post("/orders/claim"))
+            return json.loads(response.content)["data"]
+
+        first = claim()
+        models.Order.objects.filter(pk=first["id"]).update(
+            lease_expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        leases.requeue_expired()
+        second = claim()
+        self.assertEqual(second["id"], first["id"])
+        self.assertNotEqual(second["lease_token"], first["lease_token"])
+
+        # The train that lost the lease can neither extend it nor complete
+        # the order
+        for payload in ({"extend_lease": True},
+                        {"new_status": models.Order.STATUS_COMPLETED}):
+            payload.update(id=first["id"], lease_token=first["lease_token"])
+            response = self.assertRequestStatusCode(payload, 400)
+
+        self.assertEqual(json.loads(response.content)["message"],
+                         "The lease_token is not the order's current lease")
+
+        self.assertRequestStatusCode({
+            "id": second["id"], "new_status": models.Order.STATUS_COMPLETED,
+            "lease_token": second["lease_token"],
+        }, 200)
+
+    def test_requeue_expired(self):
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        future = timezone.now() + datetime.timedelta(hours=1)
+
+        expired = [
+            self.create_order(models.Order.STATUS_ACTIVE, past)
+            for _ in range(5)
+        ]
+        leased = self.create_order(models.Order.STATUS_ACTIVE, future)
+        completed = self.create_order(models.Order.STATUS_COMPLETED)
+
+        # Work is bounded by the batch size and number of batches
+        self.assertEqual(
+            leases.requeue_expired(batch_size=2, max_batches=1), 2)
+        self.assertEqual(leases.requeue_expired(batch_size=2), 3)
+        self.assertEqual(leases.requeue_expired(batch_size=2), 0)
+
+        for order in expired:
+            order.refresh_from_db()
+            self.assertEqual(order.status, models.Order.STATUS_NOT_ACTIVE)
+            self.assertIsNone(order.lease_expires_at)
+
+        leased.refresh_from_db()
+        self.assertEqual(leased.status, models.Order.STATUS_ACTIVE)
+        completed.refresh_from_db()
+        self.assertEqual(completed.status, models.Order.STATUS_COMPLETED)
+
+        # Requeued orders can be claimed again
+        response = views.claim_order(self.factory.post("/orders/claim"))
+        self.assertEqual(json.loads(response.content)["data"]["id"],
+                         expired[0].pk)
+
+    def test_requeue_refreshes_status_cache(self):
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        order = self.create_order(models.Order.STATUS_ACTIVE, past)
+        status_cache.get_status(order.pk)
+
+        leases.requeue_expired()
+
+        self.assertEqual(status_cache.get_status(order.pk),
+                         models.Order.STATUS_NOT_ACTIVE)
+
+    def test_reap_orders_command(self):
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        self.create_order(models.Order.STATUS_ACTIVE, past)
+
+        out = io.StringIO()
+        call_command("reap_orders", stdout=out)
+
+        self.assertIn("Requeued 1 orders", out.getvalue())
+
+
+class ArchiveOrdersTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        self.factory = RequestFactory()
+
+    def create_order(self, status, completed_days_ago=None):
+        completed_at = None
+        if completed_days_ago is not None:
+            completed_at = timezone.now() - datetime.timedelta(
+                days=completed_days_ago)
+
+        return models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"),
+            color=5,
+            status=status,
+            completed_at=completed_at,
+        )
+
+    def test_archive_completed(self):
+        old = [
+            self.create_order(models.Order.STATUS_COMPLETED, 10)
+            for _ in range(5)
+        ]
+        recent = self.create_order(models.Order.STATUS_COMPLETED, 1)
+        active = self.create_order(models.Order.STATUS_ACTIVE)
+
+        older_than = datetime.timedelta(days=7)
+        self.assertEqual(archive.archive_completed(
+            older_than, batch_size=2, max_batches=1), 2)
+        self.assertEqual(archive.archive_completed(
+            older_than, batch_size=2), 3)
+
+        # Only old completed orders are moved, with their ids and data
+        self.assertEqual(
+            set(models.Order.objects.values_list("id", flat=True)),
+            {recent.pk, active.pk})
+        self.assertEqual(
+            set(models.OrderArchive.objects.values_list("id", flat=True)),
+            {order.pk for order in old})
+
+        archived = models.OrderArchive.objects.get(pk=old[0].pk)
+        self.assertEqual(archived.as_json(), old[0].as_json())
+        self.assertEqual(archived.completed_at, old[0].completed_at)
+
+    def test_status_falls_back_to_archive(self):
+        order = self.create_order(models.Order.STATUS_COMPLETED, 10)
+        archive.archive_completed(datetime.timedelta(days=7))
+
+        request = self.factory.post(
+            "/orders/status", data={"id": order.pk},
+            content_type="application/json")
+        response_json = json.loads(views.order_status(request).content)
+        self.assertEqual(response_json["data"]["status"],
+                         models.Order.STATUS_COMPLETED)
+
+        self.assertEqual(status_cache.get_statuses([order.pk]),
+                         {order.pk: models.Order.STATUS_COMPLETED})
+
+    def test_completion_sets_completed_at(self):
+        order = self.create_order(models.Order.STATUS_ACTIVE)
+
+        request = self.factory.post(
+            "/orders/update",
+            data={"id": order.pk,
+                  "new_status": models.Order.STATUS_COMPLETED,
+                  "lease_token": order.version},
+            content_type="application/json")
+        views.update_order(request)
+
+        order.refresh_from_db()
+        self.assertIsNotNone(order.completed_at)
+
+    def test_archive_orders_command(self):
+        self.create_order(models.Order.STATUS_COMPLETED, 10)
+
+        out = io.StringIO()
+        call_command("archive_orders", "--older-than-days", "7", stdout=out)
+
+        self.assertIn("Archived 1 orders", out.getvalue())
+
+
+class ExportOrdersTestCase(TransactionTestCase):
+    def setUp(self):
+        destinations.clear()
+        self.factory = RequestFactory()
+
+        self.orders = [
+            models.Order.objects.create(
+                destination_id=destinations.intern(destination),
+                color=5,
+                status=status,
+            )
+            for destination, status in [
+                ("Bishan", models.Order.STATUS_NOT_ACTIVE),
+                ("Changi", models.Order.STATUS_NOT_ACTIVE),
+                ("Bishan", models.Order.STATUS_COMPLETED),
+            ]
+        ]
+
+    def export(self, **params):
+        request = self.factory.get("/orders/export", params)
+        response = views.export_orders(request)
+        self.assertEqual(response.status_code, 200)
+
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_ndjson(self):
+        lines = self.export().splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines],
+                         [order.as_json() for order in self.orders])
+
+    def test_export_csv(self):
+        lines = self.export(format="csv").splitlines()
+
+        self.assertEqual(lines[0], "id,destination,color,status")
+        self.assertEqual(lines[1], "{},Bishan,5,0".format(self.orders[0].pk))
+        self.assertEqual(len(lines), 4)
+
+    def test_export_filters(self):
+        def exported_ids(**params):
+            return [json.loads(line)["id"]
+                    for line in self.export(**params).splitlines()]
+
+        self.assertEqual(exported_ids(destination="Bishan"),
+                         [self.orders[0].pk, self.orders[2].pk])
+        self.assertEqual(exported_ids(status=models.Order.STATUS_COMPLETED),
+                         [self.orders[2].pk])
+        self.assertEqual(
+            exported_ids(min_id=self.orders[1].pk, max_id=self.orders[1].pk),
+            [self.orders[1].pk])
+
+    def test_export_includes_archive(self):
+        archive.archive_completed(datetime.timedelta(0))
+
+        self.assertEqual(len(self.export().splitlines()), 2)
+        self.assertEqual(
+            len(self.export(include_archive="1").splitlines()), 3)
+
+    def test_invalid_parameters(self):
+        request = self.factory.get("/orders/export", {"format": "xml"})
+        self.assertEqual(views.export_orders(request).status_code, 400)
+
+        request = self.factory.get("/orders/export", {"status": "asdf"})
+        self.assertEqual(views.export_orders(request).status_code, 400)
+
+    def test_export_orders_command(self):
+        out = io.StringIO()
+        call_command("export_orders", "--format", "ndjson",
+                     "--destination", "Changi", stdout=out)
+
+        self.assertEqual([json.loads(line) for line in
+                          out.getvalue().splitlines()],
+                         [self.orders[1].as_json()])
+
+
+class ImportOrdersTestCase(TransactionTestCase):
+    def setUp(self):
+        destinations.clear()
+
+    def import_orders(self, content, file_format):
+        rejected = []
+
+        imported = importer.import_orders(
+            io.StringIO(content), file_format, chunk_size=2,
+            on_reject=lambda line, error: rejected.append(line))
+
+        return imported, rejected
+
+    def assertTimestamps(self):
+        # Active orders have a lease for the reaper, completed orders a
+        # completion time for the archive
+        for order in models.Order.objects.all():
+            self.assertEqual(
+                order.lease_expires_at is not None,
+                order.status == models.Order.STATUS_ACTIVE)
+            self.assertEqual(
+                order.completed_at is not None,
+                order.status == models.Order.STATUS_COMPLETED)
+
+        active = models.Order.objects.filter(
+            status=models.Order.STATUS_ACTIVE).first()
+        if active is not None:
+            self.assertGreater(active.lease_expires_at, timezone.now())
+
+    def test_import_csv(self):
+        content = (
+            "destination,color,status\n"
+            "Bishan,5,\n"
+            "Changi,asdf,0\n"
+            "Bishan,40000,0\n"
+            "Changi,3,2\n"
+            "Bishan,1,9\n"
+            "Changi,0,1\n"
+        )
+
+        imported, rejected = self.import_orders(content, "csv")
+
+        self.assertEqual(imported, 3)
+        self.assertEqual(rejected, [3, 4, 6])
+        self.assertEqual(
+            list(models.Order.objects.order_by("id").values_list(
+                "destination__name", "color", "status")),
+            [("Bishan", 5, models.Order.STATUS_NOT_ACTIVE),
+             ("Changi", 3, models.Order.STATUS_COMPLETED),
+             ("Changi", 0, models.Order.STATUS_ACTIVE)])
+        self.assertTimestamps()
+
+    def test_import_ndjson(self):
+        content = (
+            '{"destination": "Bishan", "color": 5}\n'
+            'not json\n'
+            '\n'
+            '{"destination": 5, "color": 5}\n'
+            '{"destination": "Changi", "color": "7", "status": 1}\n'
+            '{"destination": "Changi", "color": "\u00b2"}\n'
+            '{"destination": "Changi", "color": true}\n'
+            '{"destination": "Changi", "color": 1, "status": -1}\n'
+        )
+
+        imported, rejected = self.import_orders(content, "ndjson")
+
+        self.assertEqual(imported, 2)
+        self.assertEqual(rejected, [2, 4, 6, 7, 8])
+        self.assertEqual(
+            list(models.Order.objects.order_by("id").values_list(
+                "destination__name", "color", "status")),
+            [("Bishan", 5, models.Order.STATUS_NOT_ACTIVE),
+             ("Changi", 7, models.Order.STATUS_ACTIVE)])
+
+    def test_import_counts_orders(self):
+        counters.rebuild()
+        content = (
+            '{"destination": "Bishan", "color": 5}\n'
+            '{"destination": "Bishan", "color": 6, "status": 2}\n'
+            '{"destination": "Changi", "color": 7}\n'
+        )
+
+        self.import_orders(content, "ndjson")
+
+        self.assertEqual(counters.get_counts(), {
+            "by_status": {models.Order.STATUS_NOT_ACTIVE: 2,
+                          models.Order.STATUS_ACTIVE: 0,
+                          models.Order.STATUS_COMPLETED: 1},
+            "by_destination": {"Bishan": 2, "Changi": 1},
+        })
+        self.assertEqual(counters.rebuild(check_only=True), [])
+
+    def test_copy_sets_every_required_column(self):
+        for model, columns in (
+                (models.Destination, importer.DESTINATION_COLUMNS),
+                (models.Order, importer.ORDER_COLUMNS)):
+            required = {
+                field.column for field in model._meta.concrete_fields
+                if not field.null and not field.primary_key
+            }
+            self.assertLessEqual(
+                required, {column for column, _ in columns}, model)
+
+    @skipUnless(connection.vendor == "postgresql", "COPY needs PostgreSQL")
+    def test_import_with_copy(self):
+        counters.rebuild()
+        models.Order.objects.create(
+            destination_id=destinations.intern("Bishan"), color=1,
+            status=models.Order.STATUS_NOT_ACTIVE)
+        counters.add_orders([(destinations.intern("Bishan"),
+                              models.Order.STATUS_NOT_ACTIVE)])
+        content = (
+            "destination,color,status\n"
+            "Bishan,5,\n"
+            "Changi,3,2\n"
+            "Changi,asdf,0\n"
+            "Changi,4,1\n"
+        )
+
+        imported, rejected = self.import_orders(content, "csv")
+
+        self.assertEqual(imported, 3)
+        self.assertEqual(rejected, [4])
+        self.assertTimestamps()
+        self.assertEqual(
+            list(models.Order.objects.order_by("id").values_list(
+                "destination__name", "color", "status", "version")),
+            [("Bishan", 1, models.Order.STATUS_NOT_ACTIVE, 0),
+             ("Bishan", 5, models.Order.STATUS_NOT_ACTIVE, 0),
+             ("Changi", 3, models.Order.STATUS_COMPLETED, 0),
+             ("Changi", 4, models.Order.STATUS_ACTIVE, 0)])
+        self.assertEqual(counters.get_counts()["by_destination"],
+                         {"Bishan": 2, "Changi": 2})
+        self.assertEqual(counters.rebuild(check_only=True), [])
+
+    def test_import_orders_command(self):
+        with tempfile.NamedTemporaryFile(
+                "w", suffix=".csv", delete=False) as f:
+            f.write("destination,color\nBishan,5\nBishan,-1\n")
+
+        try:
+            out = io.StringIO()
+            err = io.StringIO()
+            call_command("import_orders", f.name, stdout=out, stderr=err)
+        finally:
+            os.remove(f.name)
+
+        self.assertIn("Imported 1 orders, rejected 1", out.getvalue())
+        self.assertIn("Rejected line 3", err.getvalue())
+
+
+class DestinationTestCase(TransactionTestCase):
+    def setUp(self):
+        destinations.clear()
+
+    def test_rolled_back_destination_is_forgotten(self):
+        try:
+            with transaction.atomic():
+                destinations.intern("Bishan")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        destination_id = destinations.intern("Bishan")
+        self.assertTrue(models.Destination.objects.filter(
+            pk=destination_id, name="Bishan").exists())
+
+    def test_migration_interns_destinations(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate([("orders", "0003_order_archive")])
+
+        old_apps = executor.loader.project_state(
+            ("orders", "0003_order_archive")).apps
+        OldOrder = old_apps.get_model("orders", "Order")
+        OldOrderArchive = old_apps.get_model("orders", "OrderArchive")
+        OldOrder.objects.create(destination="Bishan", color=1, status=0)
+        OldOrder.objects.create(destination="Changi", color=2, status=1)
+        OldOrderArchive.objects.create(
+            id=100, destination="Bishan", color=3, status=2)
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes("orders"))
+
+        self.assertEqual(
+            sorted(models.Destination.objects.values_list(
+                "name", flat=True)),
+            ["Bishan", "Changi"])
+        self.assertEqual(
+            list(models.Order.objects.order_by("id").values_list(
+                "destination__name", "color")),
+            [("Bishan", 1), ("Changi", 2)])
+        self.assertEqual(
+            models.OrderArchive.objects.get(pk=100).as_json(),
+            {"id": 100, "destination": "Bishan", "color": 3, "status": 2})
+
+    def test_migrations_upgrade_baseline_schema(self):
+        # Deployed databases have 0001_initial applied with only the
+        # original three columns
+        executor = MigrationExecutor(connection)
+        executor.migrate([("orders", "0001_initial")])
+
+        old_apps = executor.loader.project_state(
+            ("orders", "0001_initial")).apps
+        OldOrder = old_apps.get_model("orders", "Order")
+        self.assertEqual(
+            [field.name for field in OldOrder._meta.get_fields()],
+            ["id", "destination", "color", "status"])
+        self.assertEqual(OldOrder._meta.indexes, [])
+        OldOrder.objects.create(destination="Bishan", color=1, status=0)
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes("orders"))
+
+        order = models.Order.objects.get()
+        self.assertEqual(order.as_json(), {
+            "id": order.id, "destination": "Bishan", "color": 1,
+            "status": 0,
+        })
+        self.assertIsNone(order.lease_expires_at)
+        self.assertIsNone(order.completed_at)
+
+
+class OrderCountersTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        # Tables are emptied between tests, including the counter rows
+        counters.rebuild()
+
+        self.factory = RequestFactory()
+
+    def post(self, view, data):
+        request = self.factory.post(
+            "/orders/", data=data, content_type="application/json")
+        response = view(request)
+        self.assertEqual(response.status_code, 200)
+
+        return json.loads(response.content).get("data")
+
+    def test_write_paths_keep_counts(self):
+        first = self.post(views.new_order, {"destination": "Bishan",
+                                            "color": 1})["id"]
+        self.post(views.new_order_batch, [
+            {"destination": "Bishan", "color": 1},
+            {"destination": "Changi", "color": 2},
+            {"destination": "Changi", "color": 2},
+        ])
+        importer.import_orders(
+            io.StringIO("destination,color,status\nTampines,3,2\n"), "csv")
+
+        # Claim and complete the first order, claim a trip to Changi and
+        # let one of its leases expire
+        claimed = self.post(views.claim_order, {})
+        self.post(views.update_order, {
+            "id": first, "new_status": models.Order.STATUS_COMPLETED,
+            "lease_token": claimed["lease_token"]})
+        trip = self.post(views.claim_trip, {"destination": "Changi"})
+        models.Order.objects.filter(pk=trip["orders"][0]["id"]).update(
+            lease_expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        leases.requeue_expired()
+
+        # Archiving moves orders without changing the counts
+        archive.archive_completed(datetime.timedelta(0))
+
+        self.assertEqual(counters.rebuild(check_only=True), [])
+        self.assertEqual(counters.get_counts(), {
+            "by_status": {
+                models.Order.STATUS_NOT_ACTIVE: 2,
+                models.Order.STATUS_ACTIVE: 1,
+                models.Order.STATUS_COMPLETED: 2,
+            },
+            "by_destination": {"Bishan": 2, "Changi": 2, "Tampines": 1},
+        })
+
+    def test_write_behind_keeps_counts(self):
+        buffer = ingest.WriteBehindBuffer(
+            max_size=10, batch_size=10, interval=60, id_block_size=10)
+        try:
+            buffer.submit("Bishan", 1)
+            buffer.submit("Bishan", 2)
+            buffer.flush()
+        finally:
+            buffer.drain()
+            connection.close()
+
+        self.assertEqual(counters.rebuild(check_only=True), [])
+        self.assertEqual(counters.get_counts()["by_destination"],
+                         {"Bishan": 2})
+
+    def test_stats(self):
+        self.post(views.new_order, {"destination": "Bishan", "color": 1})
+
+        with self.assertNumQueries(2):
+            response = views.order_stats(self.factory.get("/orders/stats/"))
+
+        self.assertEqual(json.loads(response.content)["data"], {
+            "by_status": {"0": 1, "1": 0, "2": 0},
+            "by_destination": {"Bishan": 1},
+        })
+
+    def test_rebuild_counters_command(self):
+        self.post(views.new_order, {"destination": "Bishan", "color": 1})
+        models.StatusCount.objects.filter(
+            status=models.Order.STATUS_NOT_ACTIVE).update(count=0)
+        models.StatusCount.objects.filter(
+            status=models.Order.STATUS_NOT_ACTIVE, shard=0).update(count=5)
+        models.DestinationCount.objects.update(count=0)
+
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_counters", "--check", stdout=out)
+        self.assertIn("status 0: counted 5, actually 1", out.getvalue())
+        self.assertIn("destination Bishan: counted 0, actually 1",
+                      out.getvalue())
+
+        out = io.StringIO()
+        call_command("rebuild_counters", stdout=out)
+        self.assertIn("2 counters fixed", out.getvalue())
+
+        call_command("rebuild_counters", "--check", stdout=io.StringIO())
+        self.assertEqual(counters.get_counts()["by_status"][
+            models.Order.STATUS_NOT_ACTIVE], 1)
+
+    @override_settings(ORDERS_COUNTER_SHARDS=4)
+    def test_counts_are_sharded(self):
+        destination_id = destinations.intern("Bishan")
+
+        def add():
+            try:
+                with transaction.atomic():
+                    counters.add_orders([(destination_id, 0)] * 2)
+            finally:
+                connection.close()
+
+        # Each thread writes to a shard of its own choosing
+        for _ in range(8):
+            thread = threading.Thread(target=add)
+            thread.start()
+            thread.join()
+
+        counts = counters.get_counts()
+        self.assertEqual(counts["by_status"][0], 16)
+        self.assertEqual(counts["by_destination"], {"Bishan": 16})
+        for model in (models.StatusCount, models.DestinationCount):
+            self.assertLess(
+                max(model.objects.exclude(count=0).values_list(
+                    "shard", flat=True)), 4)
+
+        # No orders exist, so a rebuild sets every shard back to zero
+        self.assertEqual(counters.rebuild(check_only=True),
+                         [("status", 0, 16, 0),
+                          ("destination", "Bishan", 16, 0)])
+        counters.rebuild()
+        for model in (models.StatusCount, models.DestinationCount):
+            self.assertFalse(model.objects.exclude(count=0).exists())
+            self.assertEqual(model.objects.filter(shard=3).count(),
+                             model.objects.filter(shard=0).count())
+
+    def test_check_locks_nothing(self):
+        self.post(views.new_order, {"destination": "Bishan", "color": 1})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(counters.rebuild(check_only=True), [])
+
+        self.assertFalse(any("FOR UPDATE" in query["sql"]
+                             for query in queries))
+
+
+class IdempotencyKeyTestCase(TransactionTestCase):
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        idempotency.clear()
+        counters.rebuild()
+
+        self.factory = RequestFactory()
+
+    def post(self, view, data, key):
+        request = self.factory.post(
+            "/orders/", data=data, content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY=key)
+        return view(request)
+
+    def test_retry_returns_original_response(self):
+        order = {"destination": "Bishan", "color": 5}
+        first = self.post(views.new_order, order, "key-1")
+
+        # Answered from memory
+        with self.assertNumQueries(0):
+            retry = self.post(views.new_order, order, "key-1")
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(models.Order.objects.count(), 1)
+
+        # Another key creates another order
+        other = self.post(views.new_order, order, "key-2")
+        self.assertNotEqual(other.content, first.content)
+        self.assertEqual(models.Order.objects.count(), 2)
+
+    def test_retry_on_another_worker(self):
+        order = {"destination": "Bishan", "color": 5}
+        first = self.post(views.new_order, order, "key-1")
+
+        # The key is read from the database, before anything is inserted
+        idempotency.clear()
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.post(views.new_order, order, "key-1")
+
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]["sql"].startswith("SELECT"))
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(models.Order.objects.count(), 1)
+        self.assertEqual(counters.rebuild(check_only=True), [])
+
+    def test_key_reused_for_another_request(self):
+        self.post(views.new_order, {"destination": "Bishan", "color": 5},
+                  "key-1")
+        response = self.post(
+            views.new_order, {"destination": "Changi", "color": 5}, "key-1")
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(models.Order.objects.count(), 1)
+
+    def test_invalid_key(self):
+        response = self.post(
+            views.new_order, {"destination": "Bishan", "color": 5},
+            "x" * (idempotency.MAX_KEY_LENGTH + 1))
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_retry(self):
+        orders = [{"destination": "Bishan", "color": 5},
+                  {"destination": 5, "color": 5}]
+        first = self.post(views.new_order_batch, orders, "key-1")
+
+        idempotency.clear()
+        retry = self.post(views.new_order_batch, orders, "key-1")
+
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(models.Order.objects.count(), 1)
+
+        # Keys are per endpoint
+        response = self.post(views.new_order,
+                             {"destination": "Bishan", "color": 5}, "key-1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(models.Order.objects.count(), 2)
+
+    @override_settings(ORDERS_WRITE_BEHIND=True)
+    def test_write_behind_retry(self):
+        order = {"destination": "Bishan", "color": 5}
+
+        try:
+            first = self.post(views.new_order, order, "key-1")
+            idempotency.clear()
+            retry = self.post(views.new_order, order, "key-1")
+            ingest.get_buffer().drain()
+        finally:
+            ingest._buffer = None
+
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(models.Order.objects.count(), 1)
+
+    @override_settings(ORDERS_WRITE_BEHIND=True,
+                       ORDERS_WRITE_BEHIND_MAX_SIZE=0)
+    def test_write_behind_retry_after_full_buffer(self):
+        order = {"destination": "Bishan", "color": 5}
+
+        try:
+            first = self.post(views.new_order, order, "key-1")
+            retry = self.post(views.new_order, order, "key-1")
+        finally:
+            ingest._buffer = None
+
+        # The key was forgotten, the retry is not told of an order that
+        # was never created
+        self.assertEqual(first.status_code, 503)
+        self.assertEqual(retry.status_code, 503)
+        self.assertNotIn("Idempotent-Replayed", retry)
+        self.assertFalse(models.IdempotencyKey.objects.exists())
+
+    def test_lru_cache(self):
+        now = [0]
+        cache = idempotency.LRUCache(max_size=2, ttl=10,
+                                     clock=lambda: now[0])
+
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        # "b" is the least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.delete("c")
+        self.assertIsNone(cache.get("c"))
+        cache.delete("c")
+
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+
+    def test_purge_command(self):
+        self.post(views.new_order, {"destination": "Bishan", "color": 5},
+                  "old")
+        self.post(views.new_order, {"destination": "Bishan", "color": 5},
+                  "new")
+        models.IdempotencyKey.objects.filter(key="old").update(
+            created_at=timezone.now() - datetime.timedelta(days=2))
+
+        out = io.StringIO()
+        call_command("purge_idempotency_keys", "--batch-size", "1",
+                     stdout=out)
+
+        self.assertIn("Deleted 1 keys", out.getvalue())
+        self.assertEqual(
+            list(models.IdempotencyKey.objects.values_list(
+                "key", flat=True)),
+            ["new"])
+
+
+
+@override_settings(DATABASE_REPLICAS=["replica"], ADMISSION_ROUTES={})
+class ReplicaRoutingTestCase(TransactionTestCase):
+    # A second SQLite database stands in for the replica. Nothing copies
+    # the primary's rows to it, so the result of a read shows which
+    # database answered it.
+    databases = {"default", "replica"}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.databases["replica"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(cls.replica_dir, "replica.sqlite3"),
+        }
+        call_command("migrate", database="replica", run_syncdb=True,
+                     verbosity=0)
+
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+
+        connections["replica"].close()
+        del connections.databases["replica"]
+        delattr(connections._connections, "replica")
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        counters.rebuild()
+
+        destination = models.Destination.objects.create(name="Bishan")
+        self.active = models.Order.objects.create(
+            destination=destination, color=1,
+            status=models.Order.STATUS_ACTIVE)
+        self.pending = models.Order.objects.create(
+            destination=destination, color=1,
+            status=models.Order.STATUS_NOT_ACTIVE)
+
+        # The replica lags behind, it has not seen the claim of the first
+        # order nor the second order
+        replica_destination = models.Destination.objects.using(
+            "replica").create(pk=destination.pk, name="Bishan")
+        models.Order.objects.using("replica").create(
+            pk=self.active.pk, destination=replica_destination, color=1,
+            status=models.Order.STATUS_NOT_ACTIVE)
+
+        # The writes above pinned this thread to the primary
+        routers.reset()
+
+    def test_router(self):
+        router = routers.PrimaryReplicaRouter()
+
+        self.assertEqual(router.db_for_read(models.Order), "replica")
+        self.assertEqual(router.db_for_read(User), "default")
+
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(models.Order), "default")
+
+        self.assertEqual(router.db_for_write(models.Order), "default")
+        self.assertEqual(router.db_for_read(models.Order), "default")
+
+        routers.reset()
+        self.assertEqual(router.db_for_read(models.Order), "replica")
+
+        routers.reset(pinned=True)
+        self.assertEqual(router.db_for_read(models.Order), "default")
+
+        with override_settings(DATABASE_REPLICAS=[]):
+            routers.reset()
+            self.assertEqual(router.db_for_read(models.Order), "default")
+
+    def test_reads_own_writes(self):
+        response = self.client.post("/orders/uncompleted/")
+        self.assertEqual(response.json()["data"]["id"], self.active.pk)
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+        response = self.client.post(
+            "/orders/update/",
+            data={"id": self.active.pk,
+                  "new_status": models.Order.STATUS_COMPLETED,
+                  "lease_token": self.active.version},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+        # The cookie keeps this client on the primary
+        response = self.client.post("/orders/uncompleted/")
+        self.assertEqual(response.json()["data"]["id"], self.pending.pk)
+
+        # Other clients still read from the replica
+        response = Client().post("/orders/uncompleted/")
+        self.assertEqual(response.json()["data"]["id"], self.active.pk)
+
+    def test_wakeups_read_from_primary(self):
+        # The replica has no pending order of this color yet
+        order = models.Order.objects.create(
+            destination_id=self.pending.destination_id, color=2,
+            status=models.Order.STATUS_NOT_ACTIVE)
+        routers.reset()
+
+        notifier = mock.Mock()
+        notifier.current.return_value = 0
+        notifier.wait.return_value = True
+
+        with mock.patch.object(notify, "get_notifier",
+                               return_value=notifier):
+            found = views._wait_for_order(
+                lambda: views._find_uncompleted_order({"color": 2}), 5)
+
+        self.assertEqual(found, order)
+        self.assertEqual(notifier.wait.call_count, 1)
+        self.assertFalse(routers.is_pinned())
+
+    def test_claims_read_from_primary(self):
+        with CaptureQueriesContext(connections["replica"]) as queries:
+            response = self.client.post("/orders/claim/")
+
+        self.assertEqual(response.json()["data"]["id"], self.pending.pk)
+        self.assertEqual(len(queries), 0)
+
+
+class WireFormatTestCase(TransactionTestCase):
+    LAYOUTS = {
+        views.uncompleted_order: (wire.QUEUE, wire.ORDER),
+        views.claim_order: (wire.QUEUE, wire.CLAIMED_ORDER),
+        views.claim_trip: (wire.TRIP, wire.CLAIMED_TRIP),
+        views.new_order: (wire.NEW_ORDER, wire.CREATED_ORDER),
+        views.new_order_batch: (wire.NEW_ORDERS, wire.CREATED_ORDERS),
+        views.update_order: (wire.UPDATE, wire.LEASE),
+        views.order_status: (wire.STATUS_QUERY, wire.STATUSES),
+        views.order_status_detail: (None, wire.ORDER_STATE),
+        views.queue_depths: (None, wire.QUEUE_DEPTHS),
+        views.order_stats: (None, wire.STATS),
+        views.list_orders: (None, wire.ORDER_PAGE),
+    }
+
+    def setUp(self):
+        status_cache.clear()
+        destinations.clear()
+        counters.rebuild()
+
+        self.factory = RequestFactory()
+
+    def send(self, view, data=None, binary=False, args=()):
+        # Returns the status code and the decoded envelope
+        request_layout, response_layout = self.LAYOUTS[view]
+        headers = {"HTTP_ACCEPT": wire.CONTENT_TYPE} if binary else {}
+
+        if request_layout is None:
+            request = self.factory.get("/", data or {}, **headers)
+        elif binary:
+            body = (wire.encode_body(request_layout, data)
+                    if data is not None else b"")
+            request = self.factory.post(
+                "/", data=body, content_type=wire.CONTENT_TYPE, **headers)
+        else:
+            body = json.dumps(data) if data is not None else ""
+            request = self.factory.post(
+                "/", data=body, content_type="application/json")
+
+        response = view(request, *args)
+        self.assertIn("Accept", response["Vary"])
+
+        if binary:
+            self.assertEqual(response["Content-Type"], wire.CONTENT_TYPE)
+            return response.status_code, wire.decode_response(
+                response_layout, response.content)
+
+        return response.status_code, json.loads(response.content)
+
+    def assertSameResponse(self, view, data=None, args=()):
+        expected = self.send(view, data, args=args)
+        self.assertEqual(self.send(view, data, binary=True, args=args),
+                         expected)
+
+        return expected
+
+    def create_orders(self):
+        _, payload = self.send(views.new_order_batch, [
+            {"destination": "Bishan", "color": 1},
+            {"destination": "Changi-機場", "color": 2},
+            {"destination": "Changi-機場", "color": 2},
+        ])
+        return [item["id"] for item in payload["data"]]
+
+    def test_layouts_round_trip(self):
+        values = [
+            (wire.ORDER, {"id": 2 ** 40, "destination": "Changi-機場",
+                          "color": 32767, "status": 2}),
+            (wire.QUEUE, {}),
+            (wire.QUEUE, {"color": 0, "wait": 2.5}),
+            (wire.TRIP, {"destination": "Bishan", "size": 5,
+                         "strategy": "largest"}),
+            (wire.NEW_ORDERS, [{"destination": "", "color": 0}]),
+            (wire.CREATED_ORDERS, [{"id": 1}, {"error": "Bad color"}]),
+            (wire.CLAIMED_ORDER, {"id": 1, "destination": "Bishan",
+                                  "color": 0, "status": 1,
+                                  "lease_token": 2 ** 32 - 1}),
+            (wire.UPDATE, {"id": 1, "extend_lease": True,
+                           "lease_token": 3}),
+            (wire.LEASE,
+             {"lease_expires_at": "2026-10-18T12:30:01.000002+00:00",
+              "lease_token": 3}),
+            (wire.STATUSES, {"statuses": {"1": 0, "7": 2}, "missing": [3]}),
+            (wire.STATS, {"by_status": {"0": 1, "2": 5},
+                          "by_destination": {"Bishan": 6}}),
+        ]
+
+        for layout, value in values:
+            body = wire.encode_body(layout, value)
+            self.assertEqual(wire.decode_body(layout, body), value)
+
+        with self.assertRaises(wire.WireError):
+            wire.decode_body(wire.ORDER, wire.encode_body(
+                wire.ORDER, values[0][1])[:-1])
+        with self.assertRaises(wire.WireError):
+            wire.decode_body(wire.QUEUE, b"\x00\x00")
+        with self.assertRaises(wire.WireError):
+            wire.encode_body(wire.TRIP, {"strategy": "shortest"})
+
+    def test_reads(self):
+        order_ids = self.create_orders()
+
+        self.assertSameResponse(views.queue_depths)
+        self.assertSameResponse(views.order_stats)
+        self.assertSameResponse(views.uncompleted_order)
+        self.assertSameResponse(views.uncompleted_order, {
+            "destination": "Changi-機場", "color": 2, "wait": 0})
+        self.assertSameResponse(views.uncompleted_order, {"color": 7})
+        self.assertSameResponse(views.order_status, {"id": order_ids[0]})
+        self.assertSameResponse(views.order_status, {"id": 0})
+        self.assertSameResponse(
+            views.order_status, {"ids": order_ids + [0]})
+        self.assertSameResponse(
+            views.order_status_detail, args=(order_ids[1],))
+        self.assertSameResponse(views.order_status_detail, args=(0,))
+        self.assertSameResponse(views.list_orders)
+        self.assertSameResponse(views.list_orders, {"page_size": 1})
+
+    def test_writes(self):
+        status_code, payload = self.send(
+            views.new_order, {"destination": "Bishan", "color": 1},
+            binary=True)
+        self.assertEqual(status_code, 200)
+        order_id = payload["data"]["id"]
+        self.assertEqual(
+            self.send(views.new_order, {"destination": "Bishan", "color": 1}),
+            (200, {"message": "", "success": True,
+                   "data": {"id": order_id + 1}}))
+
+        status_code, payload = self.send(views.new_order_batch, [
+            {"destination": "Bishan", "color": 3},
+            {"destination": "Bishan", "color": 40000},
+        ], binary=True)
+        self.assertEqual(payload["data"], [
+            {"id": order_id + 2},
+            {"error": "The color must be at most 32767"},
+        ])
+
+        self.assertEqual(self.send(views.claim_order, binary=True), (
+            200, {"message": "", "success": True, "data": {
+                "id": order_id, "destination": "Bishan", "color": 1,
+                "status": models.Order.STATUS_ACTIVE, "lease_token": 1}}))
+        self.assertEqual(
+            self.send(views.claim_trip, {"size": 1, "strategy": "largest"},
+                      binary=True),
+            (200, {"message": "", "success": True, "data": {
+                "destination": "Bishan",
+                "orders": [{"id": order_id + 1, "destination": "Bishan",
+                            "color": 1,
+                            "status": models.Order.STATUS_ACTIVE,
+                            "lease_token": 1}]}}))
+
+        status_code, payload = self.send(
+            views.update_order,
+            {"id": order_id, "extend_lease": True, "lease_token": 1},
+            binary=True)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(payload["data"], {
+            "lease_expires_at": models.Order.objects.get(
+                pk=order_id).lease_expires_at.isoformat(),
+            "lease_token": 1,
+        })
+
+        completion = {"id": order_id, "new_status": 2, "lease_token": 1}
+        self.assertEqual(
+            self.send(views.update_order, completion, binary=True),
+            (200, {"message": "", "success": True}))
+        self.assertEqual(
+            self.send(views.update_order, completion, binary=True),
+            (400, {"message": "The order is already complete",
+                   "success": False}))
+
+        self.assertEqual(
+            self.send(views.claim_order, {"destination": "Bishan"},
+                      binary=True)[1]["data"]["id"], order_id + 2)
+
+        # Errors and empty results have the same envelope as in JSON
+        self.assertSameResponse(
+            views.claim_trip, {"destination": "Bishan", "size": 1})
+        self.assertSameResponse(views.claim_order, {"color": 9})
+
+    def test_bad_binary_body(self):
+        request = self.factory.post(
+            "/", data=b"\x01", content_type=wire.CONTENT_TYPE,
+            HTTP_ACCEPT=wire.CONTENT_TYPE)
+        response = views.new_order(request)
+
+        self.assertEqual(response.status_code, 400)
+        payload = wire.decode_response(wire.CREATED_ORDER, response.content)
+        self.assertFalse(payload["success"])
+        self.assertTrue(payload["message"].startswith("Bad binary body"))
+
+    def test_unencodable_response(self):
+        @wire.negotiate(response_layout=wire.CREATED_ORDER)
+        def view(request):
+            return base_helpers.create_json_response(data={"id": -1})
+
+        request = self.factory.get("/", HTTP_ACCEPT=wire.CONTENT_TYPE)
+        with self.assertLogs("orders.wire", "ERROR"):
+            response = view(request)
+
+        self.assertEqual(response.status_code, 406)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("Accept", response["Vary"])
+        self.assertFalse(json.loads(response.content)["success"])
+
+    def test_json_is_default(self):
+        # A binary request without the Accept header gets JSON back
+        request = self.factory.post(
+            "/", content_type=wire.CONTENT_TYPE, data=wire.encode_body(
+                wire.NEW_ORDER, {"destination": "Bishan", "color": 1}))
+        response = views.new_order(request)
+
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertTrue(json.loads(response.content)["success"])
+
+
+class ListOrdersViewTestCase(TransactionTestCase):
+    def setUp(self):
+        destinations.clear()
+        self.factory = RequestFactory()
+
+        bishan = destinations.intern("Bishan")
+        changi = destinations.intern("Changi")
+        models.Order.objects.bulk_create([
+            models.Order(destination_id=bishan if i % 3 else changi,
+                         color=i, status=i % 3)
+            for i in range(10)
+        ])
+        self.orders = [
+            order.as_json() for order in models.Order.objects.order_by("id")
+        ]
+
+    def send_request(self, **params):
+        response = views.list_orders(self.factory.get("/orders/", params))
+        return response.status_code, json.loads(response.content)
+
+    def list_all(self, **params):
+        # Follows the cursors to the last page, returns the orders and the
+        # number of pages
+        orders = []
+        pages = 0
+
+        while True:
+            status_code, payload = self.send_request(**params)
+            self.assertEqual(status_code, 200)
+
+            orders += payload["data"]["orders"]
+            pages += 1
+
+            if payload["data"]["next_cursor"] is None:
+                return orders, pages
+            params["cursor"] = payload["data"]["next_cursor"]
+
+    def test_pages_by_id(self):
+        orders, pages = self.list_all(page_size=3)
+        self.assertEqual(orders, self.orders)
+        self.assertEqual(pages, 4)
+
+        _, payload = self.send_request()
+        self.assertEqual(payload["data"],
+                         {"orders": self.orders, "next_cursor": None})
+
+    def test_pages_by_status(self):
+        orders, _ = self.list_all(order="status", page_size=3)
+        self.assertEqual(orders, sorted(
+            self.orders, key=lambda order: (order["status"], order["id"])))
+
+        orders, _ = self.list_all(
+            order="status", destination="Bishan", page_size=2)
+        self.assertEqual(orders, sorted(
+            [order for order in self.orders
+             if order["destination"] == "Bishan"],
+            key=lambda order: (order["status"], order["id"])))
+
+    def test_filters(self):
+        orders, _ = self.list_all(status=1, destination="Bishan", page_size=2)
+        self.assertEqual(orders, [
+            order for order in self.orders
+            if order["status"] == 1 and order["destination"] == "Bishan"
+        ])
+
+        orders, _ = self.list_all(destination="Changi", page_size=2)
+        self.assertEqual(orders, [
+            order for order in self.orders
+            if order["destination"] == "Changi"
+        ])
+
+        self.assertEqual(self.list_all(destination="Tampines"), ([], 1))
+
+    @override_settings(ORDERS_MAX_PAGE_SIZE=4)
+    def test_page_size_is_bounded(self):
+        _, payload = self.send_request(page_size=100)
+        self.assertEqual(payload["data"]["orders"], self.orders[:4])
+
+    def test_bad_requests(self):
+        _, payload = self.send_request(status=1, page_size=1)
+        cursor = payload["data"]["next_cursor"]
+
+        for params in [
+            {"order": "color"},
+            {"status": 3},
+            {"status": "x"},
+            {"page_size": 0},
+            {"cursor": "not a cursor"},
+            {"cursor": listing.encode_cursor(
+                {"order": "id", "status": None, "destination": None},
+                ["1"])},
+            # The cursor was made for status 1
+            {"cursor": cursor},
+            {"cursor": cursor, "status": 2},
+        ]:
+            status_code, payload = self.send_request(**params)
+            self.assertEqual(status_code, 400, params)
+            self.assertFalse(payload["success"])
+
+        status_code, _ = self.send_request(cursor=cursor, status=1)
+        self.assertEqual(status_code, 200)
+
+    def test_deep_pages_do_not_scan(self):
+        # Every page is read from where the previous one ended, in one
+        # query, or one per status crossed when ordered by status
+        _, payload = self.send_request(page_size=8)
+        params = {"page_size": 1, "cursor": payload["data"]["next_cursor"]}
+
+        with CaptureQueriesContext(connection) as queries:
+            _, payload = self.send_request(**params)
+
+        self.assertEqual(payload["data"]["orders"], self.orders[8:9])
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]["sql"].upper()
+        self.assertNotIn("OFFSET", sql)
+        self.assertNotIn("COUNT", sql)
+
+        _, payload = self.send_request(order="status", page_size=3)
+        with CaptureQueriesContext(connection) as queries:
+            _, payload = self.send_request(
+                order="status", page_size=3,
+                cursor=payload["data"]["next_cursor"])
+
+        self.assertEqual(
+            [(order["status"], order["id"])
+             for order in payload["data"]["orders"]],
+            [(0, self.orders[9]["id"]), (1, self.orders[1]["id"]),
+             (1, self.orders[4]["id"])])
+        self.assertEqual(len(queries), 2)
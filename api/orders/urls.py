@@ -3,7 +3,17 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path("", views.list_orders),
     path("uncompleted/", views.uncompleted_order),
+    path("claim/", views.claim_order),
+    path("claim/trip/", views.claim_trip),
     path("new/", views.new_order),
+    path("new/batch/", views.new_order_batch),
     path("update/", views.update_order),
+    path("status/", views.order_status),
+    path("status/<int:order_id>/", views.order_status_detail),
+    path("status/<int:order_id>/events/", views.order_status_stream),
+    path("export/", views.export_orders),
+    path("queues/", views.queue_depths),
+    path("stats/", views.order_stats),
 ]
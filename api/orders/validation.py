@@ -0,0 +1,82 @@
+import base.helpers as base_helpers
+from orders.models import Order
+
+# PositiveSmallIntegerField accepts [0, 32767]
+MAX_COLOR = 32767
+
+# How claim/trip/ picks the destination: the one with the oldest pending
+# order, or the one with the most pending orders
+TRIP_STRATEGIES = ("oldest", "largest")
+
+
+def validate_new_order(data):
+    # Returns an error message if the order cannot be created, otherwise None
+
+    # Check if there is a destination and color
+    if (not isinstance(data, dict) or
+            not base_helpers.has_keys({"destination", "color"}, data)):
+        return "Missing destination or color"
+
+    if not base_helpers.validate_positive_int(
+            data["color"], include_zero=True):
+        return "The color is not a non-negative integer"
+
+    if int(data["color"]) > MAX_COLOR:
+        return "The color must be at most {}".format(MAX_COLOR)
+
+    if not isinstance(data["destination"], str):
+        return "The destination must be a string"
+
+    # PostgreSQL text cannot hold NUL characters
+    if "\x00" in data["destination"]:
+        return "The destination must not contain NUL characters"
+
+    return None
+
+
+def validate_queue(data):
+    # Returns an error message if the optional destination and color
+    # filters of a queue are invalid, otherwise None
+    if "color" in data:
+        if (isinstance(data["color"], bool) or
+                not isinstance(data["color"], int) or
+                not 0 <= data["color"] <= MAX_COLOR):
+            return "The color must be an integer from 0 to {}".format(
+                MAX_COLOR)
+
+    if "destination" in data and not isinstance(data["destination"], str):
+        return "The destination must be a string"
+
+    return None
+
+
+def validate_trip(data):
+    # Returns an error message if the size or strategy of a trip is
+    # invalid, otherwise None
+    if "size" in data:
+        if (isinstance(data["size"], bool) or
+                not isinstance(data["size"], int) or data["size"] < 1):
+            return "The size must be a positive integer"
+
+    if data.get("strategy", "oldest") not in TRIP_STRATEGIES:
+        return "The strategy must be one of {}".format(
+            ", ".join(TRIP_STRATEGIES))
+
+    return None
+
+
+def validate_imported_order(data):
+    # Like validate_new_order, but imported orders may also carry a status
+    error = validate_new_order(data)
+    if error is not None:
+        return error
+
+    status = data.get("status")
+    if status is None or status == "":
+        return None
+
+    if (not base_helpers.validate_positive_int(status, include_zero=True) or
+            int(status) not in Order.STATUS_FLOW):
+        return "Bad status"
+
+    return None
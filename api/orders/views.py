@@ -1,18 +1,155 @@
 import json
+import math
+import queue
+import threading
+import time
 
+from django.conf import settings
+from django.db import (
+    DataError, IntegrityError, OperationalError, connection, connections,
+    router, transaction,
+)
+from django.db.models import Count, F, Min
+from django.db.models.sql import UpdateQuery
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.vary import vary_on_headers
+from django.views.decorators.http import (
+    condition, require_GET, require_POST,
+)
 
 from orders.models import Order
+from orders import (
+    broadcast, counters, destinations, export, idempotency, ingest, leases,
+    listing, notify, status_cache, validation, wire,
+)
 import base.helpers as base_helpers
+from base import routers
+
+
+def _read_options(request):
+    # Returns the options of the polling endpoints. These endpoints never
+    # required a body, so anything that is not a JSON object means no
+    # options.
+    try:
+        json_data = json.loads(request.body)
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+        return {}
+
+    if not isinstance(json_data, dict):
+        return {}
+
+    return json_data
+
+
+def _read_wait(json_data):
+    # Returns the number of seconds to wait for an order, or None if the
+    # wait parameter is invalid
+    wait = json_data.get("wait", 0)
+    # JSON, and the binary double, can hold NaN, which every comparison
+    # lets through
+    if (isinstance(wait, bool) or not isinstance(wait, (int, float)) or
+            not math.isfinite(wait) or wait < 0):
+        return None
+
+    return min(wait, getattr(settings, "ORDERS_MAX_WAIT", 30))
+
+
+def _wait_for_order(find_order, wait):
+    # Calls find_order until it returns an order or the wait expires. The
+    # query is only repeated after new_order sends a notification.
+    if not wait:
+        return find_order()
+
+    notifier = notify.get_notifier()
+    deadline = time.monotonic() + wait
+    woken = False
+
+    while True:
+        since = notifier.current()
+        # The write that sent the notification may not have reached the
+        # replicas yet
+        with routers.use_primary(woken):
+            order = find_order()
+
+        remaining = deadline - time.monotonic()
+        if order is not None or remaining <= 0:
+            return order
+
+        if not notifier.wait(since, remaining):
+            return None
+        woken = True
+
+
+def _bad_wait_response():
+    return base_helpers.create_json_response(
+        success=False,
+        message="Bad wait",
+        status=400,
+    )
+
+
+def _pending_orders(order_queue):
+    # Returns the pending orders of the queue oldest first, or None if the
+    # queue is for a destination that no order has used yet. Filtered
+    # queues are served by the partial indexes on pending orders.
+    filters = {"status": Order.STATUS_NOT_ACTIVE}
+
+    if "destination" in order_queue:
+        filters["destination_id"] = destinations.lookup(
+            order_queue["destination"])
+        if filters["destination_id"] is None:
+            return None
+    if "color" in order_queue:
+        filters["color"] = order_queue["color"]
+
+    return Order.objects.filter(**filters).order_by("id")
+
+
+def _find_uncompleted_order(order_queue):
+    pending = _pending_orders(order_queue)
+    if pending is None:
+        return None
+
+    return pending.first()
+
+
+def _read_queue(options):
+    # Returns the destination and color filters of the queue to poll, an
+    # empty queue is every pending order
+    return {
+        key: options[key] for key in ("destination", "color")
+        if key in options
+    }
+
+
+def _bad_request_response(error):
+    return base_helpers.create_json_response(
+        success=False,
+        message=error,
+        status=400,
+    )
 
 
 @csrf_exempt
 @require_POST
+@wire.negotiate(wire.QUEUE, wire.ORDER)
 def uncompleted_order(request):
+    options = _read_options(request)
+
+    wait = _read_wait(options)
+    if wait is None:
+        return _bad_wait_response()
+
+    error = validation.validate_queue(options)
+    if error is not None:
+        return _bad_request_response(error)
+    order_queue = _read_queue(options)
+
     # Get the latest uncompleted order
-    order = Order.objects.filter(
-        status=Order.STATUS_NOT_ACTIVE).order_by("id").first()
+    order = _wait_for_order(
+        lambda: _find_uncompleted_order(order_queue), wait)
 
     if order is not None:
         return base_helpers.create_json_response(
@@ -25,9 +162,329 @@ def uncompleted_order(request):
         )
 
 
+def _claim_next_order(order_queue):
+    pending = _pending_orders(order_queue)
+    if pending is None:
+        return None
+
+    # A replica may still list orders that were claimed already
+    pending = pending.using(router.db_for_write(Order))
+
+    if connection.features.has_select_for_update_skip_locked:
+        # Rows locked by other pollers are skipped instead of waited on, so
+        # concurrent claims never block on or return the same order
+        with transaction.atomic():
+            order = pending.select_for_update(skip_locked=True).first()
+
+            if order is not None:
+                order.status = Order.STATUS_ACTIVE
+                order.lease_expires_at = leases.new_lease_expiry()
+                order.version += 1
+                order.save(
+                    update_fields=["status", "lease_expires_at", "version"])
+                counters.move(1, Order.STATUS_NOT_ACTIVE, Order.STATUS_ACTIVE)
+
+            return order
+
+    # Without SKIP LOCKED (e.g. SQLite), retry until the conditional update
+    # wins the race for a pending order
+    while True:
+        try:
+            order = pending.first()
+            if order is None:
+                return None
+
+            lease_expires_at = leases.new_lease_expiry()
+            with transaction.atomic():
+                claimed = Order.objects.filter(
+                    pk=order.pk, status=Order.STATUS_NOT_ACTIVE,
+                    version=order.version,
+                ).update(status=Order.STATUS_ACTIVE,
+                         lease_expires_at=lease_expires_at,
+                         version=order.version + 1)
+                counters.move(claimed, Order.STATUS_NOT_ACTIVE,
+                              Order.STATUS_ACTIVE)
+        except OperationalError as e:
+            # SQLite reports a concurrent writer as a locked table rather
+            # than waiting for it, which is just another lost race
+            if "locked" not in str(e):
+                raise
+            continue
+
+        if claimed:
+            order.status = Order.STATUS_ACTIVE
+            order.lease_expires_at = lease_expires_at
+            order.version += 1
+            return order
+
+
+def _claimed_json(order):
+    # The lease token is the version the claim gave the order. Completing
+    # the order or extending its lease needs it, so a train whose lease ran
+    # out cannot change the order once it was requeued or claimed again.
+    return dict(order.as_json(), lease_token=order.version)
+
+
+@csrf_exempt
+@require_POST
+@wire.negotiate(wire.QUEUE, wire.CLAIMED_ORDER)
+def claim_order(request):
+    options = _read_options(request)
+
+    wait = _read_wait(options)
+    if wait is None:
+        return _bad_wait_response()
+
+    error = validation.validate_queue(options)
+    if error is not None:
+        return _bad_request_response(error)
+    order_queue = _read_queue(options)
+
+    # Get and activate the oldest uncompleted order in one step
+    order = _wait_for_order(lambda: _claim_next_order(order_queue), wait)
+
+    if order is not None:
+        status_cache.set_status(order.pk, order.status, order.version)
+        broadcast.get_broadcaster().publish(order.pk, order.status)
+
+        return base_helpers.create_json_response(
+            data=_claimed_json(order)
+        )
+    else:
+        return base_helpers.create_json_response(
+            message="There are no uncompleted orders",
+            empty_data=True,
+        )
+
+
+def _choose_destination(order_queue, strategy):
+    # Returns the id of the destination with the most pending orders, or
+    # with the oldest pending order, in the queue, using one aggregate query
+    pending = _pending_orders(order_queue)
+    if pending is None:
+        return None
+
+    backlogs = pending.order_by().values("destination_id").annotate(
+        pending=Count("id"), oldest_id=Min("id"))
+
+    if strategy == "largest":
+        backlogs = backlogs.order_by("-pending", "oldest_id")
+    else:
+        backlogs = backlogs.order_by("oldest_id")
+
+    backlog = backlogs.first()
+    return backlog["destination_id"] if backlog is not None else None
+
+
+def _claim_orders(pending, size):
+    # Activates up to `size` of the pending orders, oldest first, in one
+    # transaction. Returns the claimed orders.
+    pending = pending.using(router.db_for_write(Order))
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            orders = list(pending.select_for_update(skip_locked=True)[:size])
+
+            if orders:
+                lease_expires_at = leases.new_lease_expiry()
+                Order.objects.filter(
+                    pk__in=[order.pk for order in orders],
+                ).update(status=Order.STATUS_ACTIVE,
+                         lease_expires_at=lease_expires_at,
+                         version=F("version") + 1)
+                counters.move(len(orders), Order.STATUS_NOT_ACTIVE,
+                              Order.STATUS_ACTIVE)
+
+                # The rows are locked, so their versions were current
+                for order in orders:
+                    order.status = Order.STATUS_ACTIVE
+                    order.lease_expires_at = lease_expires_at
+                    order.version += 1
+
+            return orders
+
+    # Without SKIP LOCKED (e.g. SQLite), keep the orders whose conditional
+    # update wins the race
+    while True:
+        try:
+            with transaction.atomic():
+                lease_expires_at = leases.new_lease_expiry()
+                orders = [
+                    order for order in list(pending[:size])
+                    if Order.objects.filter(
+                        pk=order.pk, status=Order.STATUS_NOT_ACTIVE,
+                        version=order.version,
+                    ).update(status=Order.STATUS_ACTIVE,
+                             lease_expires_at=lease_expires_at,
+                             version=order.version + 1)
+                ]
+                counters.move(len(orders), Order.STATUS_NOT_ACTIVE,
+                              Order.STATUS_ACTIVE)
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            continue
+
+        for order in orders:
+            order.status = Order.STATUS_ACTIVE
+            order.lease_expires_at = lease_expires_at
+            order.version += 1
+
+        return orders
+
+
+def _claim_trip(order_queue, size, strategy):
+    # Claims up to `size` pending orders of the queue that go to the same
+    # destination. Returns the claimed orders, or None if there are none.
+    while True:
+        trip_queue = order_queue
+        if "destination" not in order_queue:
+            destination_id = _choose_destination(order_queue, strategy)
+            if destination_id is None:
+                return None
+
+            trip_queue = dict(
+                order_queue,
+                destination=destinations.name_of(destination_id))
+
+        pending = _pending_orders(trip_queue)
+        if pending is None:
+            return None
+
+        orders = _claim_orders(pending, size)
+        if orders:
+            return orders
+
+        if "destination" in order_queue:
+            return None
+
+        # Other trains claimed the whole backlog after it was chosen, try
+        # the next destination
+
+
+@csrf_exempt
+@require_POST
+@wire.negotiate(wire.TRIP, wire.CLAIMED_TRIP)
+def claim_trip(request):
+    options = _read_options(request)
+
+    wait = _read_wait(options)
+    if wait is None:
+        return _bad_wait_response()
+
+    error = (validation.validate_queue(options) or
+             validation.validate_trip(options))
+    if error is not None:
+        return _bad_request_response(error)
+    order_queue = _read_queue(options)
+
+    max_size = getattr(settings, "ORDERS_MAX_TRIP_SIZE", 50)
+    size = min(options.get("size", max_size), max_size)
+    strategy = options.get("strategy", "oldest")
+
+    # Get and activate a trip's worth of orders in one step
+    orders = _wait_for_order(
+        lambda: _claim_trip(order_queue, size, strategy), wait)
+
+    if orders is not None:
+        for order in orders:
+            status_cache.set_status(order.pk, order.status, order.version)
+            broadcast.get_broadcaster().publish(order.pk, order.status)
+
+        return base_helpers.create_json_response(
+            data={
+                "destination": destinations.name_of(orders[0].destination_id),
+                "orders": [_claimed_json(order) for order in orders],
+            }
+        )
+    else:
+        return base_helpers.create_json_response(
+            message="There are no uncompleted orders",
+            empty_data=True,
+        )
+
+
+def _read_idempotency_key(request, scope):
+    # Returns (key, request hash, response). The response is set if the
+    # key is invalid or a response for it is stored already.
+    key = idempotency.get_key(request)
+    if key is None:
+        return None, None, None
+
+    if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+        return key, None, base_helpers.create_json_response(
+            success=False,
+            message="The Idempotency-Key must be 1 to {} characters".format(
+                idempotency.MAX_KEY_LENGTH),
+            status=400,
+        )
+
+    request_hash = idempotency.hash_request(request.body)
+    return key, request_hash, _replay(scope, key, request_hash)
+
+
+def _replay(scope, key, request_hash):
+    # Returns the response stored for the key, or None if there is none
+    stored = idempotency.lookup(scope, key)
+    if stored is None:
+        return None
+
+    stored_hash, data = stored
+    if stored_hash != request_hash:
+        return base_helpers.create_json_response(
+            success=False,
+            message="The Idempotency-Key was used for another request",
+            status=422,
+        )
+
+    response = base_helpers.create_json_response(data=data)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _queue_new_order(destination, color, key, request_hash):
+    # Write-behind version of new_order. A key is recorded before the order
+    # is queued, since the insert happens later in another transaction.
+    buffer = ingest.get_buffer()
+    order_id = buffer.reserve_id()
+
+    if key is not None:
+        try:
+            with transaction.atomic():
+                idempotency.record(
+                    "new_order", key, request_hash, {"id": order_id})
+        except IntegrityError:
+            response = _replay("new_order", key, request_hash)
+            if response is None:
+                raise
+            return response
+
+    if buffer.submit(destination, color, order_id=order_id) is None:
+        if key is not None:
+            idempotency.forget("new_order", key)
+
+        response = base_helpers.create_json_response(
+            success=False,
+            message="Too many pending orders, try again later",
+            status=503,
+        )
+        response["Retry-After"] = "1"
+        return response
+
+    return base_helpers.create_json_response(
+        data={"id": order_id}
+    )
+
+
 @csrf_exempt
 @require_POST
+@wire.negotiate(wire.NEW_ORDER, wire.CREATED_ORDER)
 def new_order(request):
+    # A retry with the same Idempotency-Key gets the original response
+    key, request_hash, response = _read_idempotency_key(request, "new_order")
+    if response is not None:
+        return response
+
     # Read json
     try:
         json_data = json.loads(request.body)
@@ -38,42 +495,268 @@ def new_order(request):
             status=400
         )
 
-    # Check if there is a destination and color
-    if not base_helpers.has_keys({"destination", "color"}, json_data):
+    error = validation.validate_new_order(json_data)
+    if error is not None:
         return base_helpers.create_json_response(
             success=False,
-            message="Missing destination or color",
+            message=error,
             status=400,
         )
 
     destination = json_data["destination"]
     color = json_data["color"]
 
-    if not base_helpers.validate_positive_int(color, include_zero=True):
+    if getattr(settings, "ORDERS_WRITE_BEHIND", False):
+        # The order is written by a later bulk insert
+        return _queue_new_order(destination, color, key, request_hash)
+
+    destination_id = destinations.intern(destination)
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                destination_id=destination_id, color=color,
+                status=Order.STATUS_NOT_ACTIVE)
+            counters.add_orders([(destination_id, order.status)])
+
+            if key is not None:
+                idempotency.record(
+                    "new_order", key, request_hash, {"id": order.pk})
+    except IntegrityError:
+        # Another request with the same key was handled first, possibly by
+        # another worker. The order created here was rolled back.
+        response = (_replay("new_order", key, request_hash)
+                    if key is not None else None)
+        if response is None:
+            raise
+        return response
+
+    status_cache.set_status(order.pk, order.status, order.version)
+    notify.get_notifier().notify()
+
+    return base_helpers.create_json_response(
+        data={"id": order.pk}
+    )
+
+
+def _insert_orders(orders):
+    if connection.features.can_return_ids_from_bulk_insert:
+        # A single INSERT ... RETURNING id for the whole batch
+        Order.objects.bulk_create(orders)
+    else:
+        # Primary keys are not returned by bulk inserts here, so insert one
+        # by one but commit the batch together
+        for order in orders:
+            order.save(force_insert=True)
+
+
+def _insert_orders_one_by_one(orders):
+    # Returns the orders that were inserted. The others are left without a
+    # primary key.
+    inserted = []
+
+    for order in orders:
+        # Ids from the rolled back attempt are not valid anymore
+        order.pk = None
+        try:
+            with transaction.atomic():
+                order.save(force_insert=True)
+        except (DataError, IntegrityError):
+            order.pk = None
+        else:
+            inserted.append(order)
+
+    return inserted
+
+
+@csrf_exempt
+@require_POST
+@wire.negotiate(wire.NEW_ORDERS, wire.CREATED_ORDERS)
+def new_order_batch(request):
+    key, request_hash, response = _read_idempotency_key(
+        request, "new_order_batch")
+    if response is not None:
+        return response
+
+    # Read json
+    try:
+        json_data = json.loads(request.body)
+    except json.decoder.JSONDecodeError:
+        return base_helpers.create_json_response(
+            success=False,
+            message="Bad JSON",
+            status=400
+        )
+
+    if not isinstance(json_data, list) or not json_data:
+        return base_helpers.create_json_response(
+            success=False,
+            message="Expected a non-empty list of orders",
+            status=400,
+        )
+
+    max_batch_size = getattr(settings, "ORDERS_MAX_BATCH_SIZE", 500)
+    if len(json_data) > max_batch_size:
         return base_helpers.create_json_response(
             success=False,
-            message="The color is not a non-negative integer",
+            message="Too many orders, the limit is {}".format(max_batch_size),
+            status=400,
+        )
+
+    results = []
+    orders = []
+    for item in json_data:
+        error = validation.validate_new_order(item)
+
+        if error is not None:
+            results.append({"error": error})
+        else:
+            order = Order(
+                destination_id=destinations.intern(item["destination"]),
+                color=item["color"],
+                status=Order.STATUS_NOT_ACTIVE)
+            results.append(order)
+            orders.append(order)
+
+    try:
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    _insert_orders(orders)
+            except (DataError, IntegrityError):
+                # An order breaks a database constraint that validation
+                # does not know about. Insert the orders one by one in
+                # savepoints, so that only the refused ones fail.
+                orders = _insert_orders_one_by_one(orders)
+
+            counters.add_orders(
+                (order.destination_id, order.status) for order in orders)
+
+            data = []
+            for result in results:
+                if not isinstance(result, Order):
+                    data.append(result)
+                elif result.pk is None:
+                    data.append(
+                        {"error": "The order was refused by the database"})
+                else:
+                    data.append({"id": result.pk})
+            if key is not None:
+                idempotency.record(
+                    "new_order_batch", key, request_hash, data)
+    except IntegrityError:
+        response = (
+            _replay("new_order_batch", key, request_hash)
+            if key is not None else None)
+        if response is None:
+            raise
+        return response
+
+    for order in orders:
+        status_cache.set_status(order.pk, order.status, order.version)
+
+    if orders:
+        notify.get_notifier().notify()
+
+    return base_helpers.create_json_response(
+        data=data
+    )
+
+
+def _read_lease_token(json_data):
+    # Returns (lease token, error response). The token is optional, clients
+    # that send it may only touch the order while they hold its lease.
+    if "lease_token" not in json_data:
+        return None, None
+
+    if not base_helpers.validate_positive_int(
+            json_data["lease_token"], include_zero=True):
+        return None, base_helpers.create_json_response(
+            success=False,
+            message="Bad lease_token",
             status=400,
         )
 
-    if not isinstance(destination, str):
+    return int(json_data["lease_token"]), None
+
+
+def _update_returning_version(order_id, conditions, changes):
+    # Applies `changes` to the order if it matches `conditions`, and returns
+    # its new version, or None if it did not match
+    orders = Order.objects.using(router.db_for_write(Order)).filter(
+        **conditions)
+    db = connections[orders.db]
+
+    # UPDATE ... RETURNING is in PostgreSQL, and in SQLite since 3.35
+    if (db.vendor == "postgresql" or (
+            db.vendor == "sqlite" and
+            db.Database.sqlite_version_info >= (3, 35))):
+        query = orders.query.chain(UpdateQuery)
+        query.add_update_values(changes)
+        sql, params = query.get_compiler(orders.db).as_sql()
+        column = db.ops.quote_name(Order._meta.get_field("version").column)
+
+        with db.cursor() as cursor:
+            cursor.execute(sql + " RETURNING " + column, params)
+            row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    with transaction.atomic(using=orders.db):
+        if not orders.update(**changes):
+            return None
+        # The row is locked until the commit, so this is the version
+        # written above
+        return Order.objects.using(orders.db).filter(
+            pk=order_id).values_list("version", flat=True).get()
+
+
+def _extend_lease(json_data):
+    if not base_helpers.validate_positive_int(
+            json_data.get("id"), include_zero=True):
         return base_helpers.create_json_response(
             success=False,
-            message="The destination must be a string",
+            message="Bad id",
             status=400,
         )
 
-    order = Order.objects.create(
-        destination=destination, color=color,
-        status=Order.STATUS_NOT_ACTIVE)
+    lease_token, response = _read_lease_token(json_data)
+    if response is not None:
+        return response
+
+    conditions = {"pk": int(json_data["id"]), "status": Order.STATUS_ACTIVE}
+    if lease_token is not None:
+        conditions["version"] = lease_token
+
+    lease_expires_at = leases.new_lease_expiry()
+    if lease_token is None:
+        # The token is returned, so that the client can send it from now on
+        lease_token = _update_returning_version(
+            conditions["pk"], conditions,
+            {"lease_expires_at": lease_expires_at})
+        updated = lease_token is not None
+    else:
+        updated = Order.objects.filter(**conditions).update(
+            lease_expires_at=lease_expires_at)
+
+    if not updated:
+        message = "There is no active order with that id"
+        if lease_token is not None:
+            message += " and lease_token"
+
+        return base_helpers.create_json_response(
+            success=False,
+            message=message,
+            status=400,
+        )
 
     return base_helpers.create_json_response(
-        data={"id": order.pk}
+        data={"lease_expires_at": lease_expires_at.isoformat(),
+              "lease_token": lease_token}
     )
 
 
 @csrf_exempt
 @require_POST
+@wire.negotiate(wire.UPDATE, wire.LEASE)
 def update_order(request):
     # Read json
     try:
@@ -85,6 +768,11 @@ def update_order(request):
             status=400
         )
 
+    # A train still working on an order sends only its id to keep the lease
+    if (isinstance(json_data, dict) and "new_status" not in json_data and
+            json_data.get("extend_lease") is True):
+        return _extend_lease(json_data)
+
     if not base_helpers.has_keys({"id", "new_status"}, json_data):
         return base_helpers.create_json_response(
             success=False,
@@ -107,40 +795,112 @@ def update_order(request):
         )
 
     new_status = json_data["new_status"]
+    order_id = int(json_data["id"])
+
+    # Only allow changes in this order:
+    # NOT_ACTIVE > ACTIVE > COMPLETED
+    # The check and the write happen in a single conditional UPDATE so that
+    # concurrent updates cannot both succeed
+    # Activating an order starts its lease, anything else ends it
+    conditions = {"pk": order_id, "status": new_status - 1}
+    changes = {"status": new_status, "lease_expires_at": None,
+               "version": F("version") + 1}
+    if new_status == Order.STATUS_ACTIVE:
+        changes["lease_expires_at"] = leases.new_lease_expiry()
+    elif new_status == Order.STATUS_COMPLETED:
+        # With a lease token, only the holder of the current lease may
+        # complete the order
+        lease_token, response = _read_lease_token(json_data)
+        if response is not None:
+            return response
+        if lease_token is not None:
+            conditions["version"] = lease_token
+        changes["completed_at"] = timezone.now()
+
+    with transaction.atomic():
+        if "version" in conditions:
+            # The version written is already known
+            updated = Order.objects.filter(**conditions).update(**changes)
+            version = conditions["version"] + 1
+        else:
+            version = _update_returning_version(
+                order_id, conditions, changes)
+            updated = int(version is not None)
+        counters.move(updated, new_status - 1, new_status)
+
+    if not updated:
+        # Only failed updates pay for more queries to explain the failure
+        current_status = status_cache.fetch_status(order_id)
+
+        if current_status is None:
+            message = "There is no order with that id"
+        elif current_status == Order.STATUS_FLOW[-1]:
+            message = "The order is already complete"
+        elif "version" in conditions and current_status == new_status - 1:
+            message = "The lease_token is not the order's current lease"
+        else:
+            message = "Cannot update status beyond 1 step"
 
-    # Find the order
-    try:
-        order = Order.objects.get(pk=int(json_data["id"]))
-    except Order.DoesNotExist:
         return base_helpers.create_json_response(
             success=False,
-            message="There is no order with that id",
+            message=message,
             status=400,
         )
 
-    # Only allow changes in this order:
-    # NOT_ACTIVE > ACTIVE > COMPLETED
-    if order.status == Order.STATUS_FLOW[-1]:
+    status_cache.set_status(order_id, new_status, version)
+    broadcast.get_broadcaster().publish(order_id, new_status)
+
+    if new_status == Order.STATUS_ACTIVE:
+        return base_helpers.create_json_response(
+            data={"lease_expires_at": changes["lease_expires_at"].isoformat(),
+                  "lease_token": version}
+        )
+
+    return base_helpers.create_json_response()
+
+
+def _order_statuses(ids):
+    if not isinstance(ids, list) or not ids:
+        return base_helpers.create_json_response(
+            success=False,
+            message="ids must be a non-empty list",
+            status=400,
+        )
+
+    max_batch_size = getattr(settings, "ORDERS_MAX_BATCH_SIZE", 500)
+    if len(ids) > max_batch_size:
         return base_helpers.create_json_response(
             success=False,
-            message="The order is already complete",
+            message="Too many ids, the limit is {}".format(max_batch_size),
             status=400,
         )
-    elif new_status - order.status != 1:
+
+    if not all(base_helpers.validate_positive_int(order_id, include_zero=True)
+               for order_id in ids):
         return base_helpers.create_json_response(
             success=False,
-            message="Cannot update status beyond 1 step",
+            message="Bad id",
             status=400,
         )
 
-    order.status = new_status
-    order.save()
+    ids = {int(order_id) for order_id in ids}
 
-    return base_helpers.create_json_response()
+    statuses = status_cache.get_statuses(ids)
+
+    return base_helpers.create_json_response(
+        data={
+            "statuses": {
+                str(order_id): status
+                for order_id, status in statuses.items()
+            },
+            "missing": sorted(ids - statuses.keys()),
+        }
+    )
 
 
 @csrf_exempt
 @require_POST
+@wire.negotiate(wire.STATUS_QUERY, wire.STATUSES)
 def order_status(request):
     # Read json
     try:
@@ -152,6 +912,9 @@ def order_status(request):
             status=400
         )
 
+    if isinstance(json_data, dict) and "ids" in json_data:
+        return _order_statuses(json_data["ids"])
+
     if "id" not in json_data:
         return base_helpers.create_json_response(
             success=False,
@@ -167,16 +930,317 @@ def order_status(request):
             status=400,
         )
 
-    # Get the order
+    # Get the order status
+    order_status = status_cache.get_status(int(json_data["id"]))
+
+    if order_status is None:
+        return base_helpers.create_json_response(
+            success=False,
+            message="There is no order with that id",
+            status=400,
+        )
+
+    return base_helpers.create_json_response(
+        data={"status": order_status}
+    )
+
+
+def _status_etag(request, order_id):
+    # The version changes with every status change. Read from the status
+    # cache, so a poll for an unchanged order does not touch the database.
+    state = status_cache.get_state(order_id)
+    return str(state[1]) if state is not None else None
+
+
+@require_GET
+@vary_on_headers("Accept")
+@condition(etag_func=_status_etag)
+@wire.negotiate(response_layout=wire.ORDER_STATE)
+def order_status_detail(request, order_id):
+    # Answers If-None-Match with 304 Not Modified while the version is
+    # unchanged. Those responses come from condition, the Vary header is
+    # set outside of it so that they have it too.
+    state = status_cache.get_state(order_id)
+
+    if state is None:
+        return base_helpers.create_json_response(
+            success=False,
+            message="There is no order with that id",
+            status=404,
+        )
+
+    status, version = state
+    return base_helpers.create_json_response(
+        data={"id": order_id, "status": status, "version": version}
+    )
+
+
+_stream_lock = threading.Lock()
+_open_streams = 0
+
+
+def _acquire_stream_slot():
+    global _open_streams
+
+    with _stream_lock:
+        if _open_streams >= getattr(settings, "ORDERS_MAX_STREAMS", 2):
+            return False
+
+        _open_streams += 1
+        return True
+
+
+def _release_stream_slot():
+    global _open_streams
+
+    with _stream_lock:
+        _open_streams -= 1
+
+
+def _format_status_event(order_id, status):
+    return "event: status\ndata: {}\n\n".format(
+        json.dumps({"id": order_id, "status": status}))
+
+
+class _StatusEventStream:
+    # The response closes this when the client is done, which releases the
+    # stream slot even if streaming never started. A plain generator would
+    # not run its cleanup in that case.
+
+    def __init__(self, subscription, status):
+        self._subscription = subscription
+        self._status = status
+        self._closed = False
+
+    def __iter__(self):
+        return self._events()
+
+    def _events(self):
+        order_id = self._subscription.order_id
+        status = self._status
+        keepalive = getattr(settings, "ORDERS_STREAM_KEEPALIVE", 15)
+
+        yield _format_status_event(order_id, status)
+        sent_at = time.monotonic()
+
+        while status != Order.STATUS_FLOW[-1]:
+            # The subscription may return RESYNC before the timeout when
+            # it polls, which must not delay the keepalives
+            try:
+                new_status = self._subscription.get(
+                    max(0, sent_at + keepalive - time.monotonic()))
+            except queue.Empty:
+                # Comments keep proxies from timing out the connection
+                yield ": keepalive\n\n"
+                sent_at = time.monotonic()
+                continue
+
+            if new_status is broadcast.RESYNC:
+                new_status = status_cache.fetch_status(order_id)
+                if new_status is None:
+                    return
+
+            if new_status != status:
+                status = new_status
+                yield _format_status_event(order_id, status)
+                sent_at = time.monotonic()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._subscription.close()
+            _release_stream_slot()
+
+
+@require_GET
+def order_status_stream(request, order_id):
+    if not _acquire_stream_slot():
+        return base_helpers.create_json_response(
+            success=False,
+            message="Too many open streams",
+            status=503,
+        )
+
+    subscription = None
     try:
-        order = Order.objects.get(pk=json_data["id"])
-    except Order.DoesNotExist:
+        # Subscribe before reading the status so that no change is missed
+        # in between
+        subscription = broadcast.get_broadcaster().subscribe(order_id)
+        status = status_cache.fetch_status(order_id)
+    except BaseException:
+        if subscription is not None:
+            subscription.close()
+        _release_stream_slot()
+        raise
+
+    stream = _StatusEventStream(subscription, status)
+
+    if status is None:
+        stream.close()
         return base_helpers.create_json_response(
             success=False,
             message="There is no order with that id",
             status=400,
         )
 
+    response = StreamingHttpResponse(
+        stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the events
+    response["X-Accel-Buffering"] = "no"
+
+    return response
+
+
+@require_GET
+def export_orders(request):
+    export_format = request.GET.get("format", "ndjson")
+    if export_format not in export.FORMATS:
+        return base_helpers.create_json_response(
+            success=False,
+            message="format must be one of {}".format(
+                ", ".join(export.FORMATS)),
+            status=400,
+        )
+
+    filters = {}
+    for name in ("status", "min_id", "max_id"):
+        value = request.GET.get(name)
+        if value is None:
+            continue
+
+        if not base_helpers.validate_positive_int(value, include_zero=True):
+            return base_helpers.create_json_response(
+                success=False,
+                message="Bad {}".format(name),
+                status=400,
+            )
+        filters[name] = int(value)
+
+    if "destination" in request.GET:
+        filters["destination"] = request.GET["destination"]
+
+    rows = export.export_rows(
+        include_archive=request.GET.get("include_archive") == "1",
+        **filters)
+
+    if export_format == "csv":
+        response = StreamingHttpResponse(
+            export.format_csv(rows), content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="orders.csv"'
+    else:
+        response = StreamingHttpResponse(
+            export.format_ndjson(rows), content_type="application/x-ndjson")
+
+    return response
+
+
+@require_GET
+@wire.negotiate(response_layout=wire.QUEUE_DEPTHS)
+def queue_depths(request):
+    # Returns the number of pending orders in every destination and color
+    # queue, deepest first. Only pending orders are read, which the partial
+    # indexes cover.
+    depths = Order.objects.filter(
+        status=Order.STATUS_NOT_ACTIVE,
+    ).values("destination_id", "color").annotate(
+        pending=Count("id"), oldest_id=Min("id"),
+    ).order_by("-pending", "destination_id", "color")
+
+    return base_helpers.create_json_response(
+        data=[
+            {
+                "destination": destinations.name_of(depth["destination_id"]),
+                "color": depth["color"],
+                "pending": depth["pending"],
+                "oldest_id": depth["oldest_id"],
+            }
+            for depth in depths
+        ]
+    )
+
+
+@require_GET
+@wire.negotiate(response_layout=wire.STATS)
+def order_stats(request):
+    # Returns the number of orders by status and by destination, including
+    # archived orders. The counts are kept up to date on every write, so
+    # this never counts the orders table.
+    counts = counters.get_counts()
+
+    return base_helpers.create_json_response(
+        data={
+            "by_status": {
+                str(status): count
+                for status, count in sorted(counts["by_status"].items())
+            },
+            "by_destination": counts["by_destination"],
+        }
+    )
+
+
+@require_GET
+@wire.negotiate(response_layout=wire.ORDER_PAGE)
+def list_orders(request):
+    # Lists orders a page at a time, ordered by id or by status then id.
+    # Pages continue from the opaque cursor of the previous page rather
+    # than an offset, and the total is never counted, so every page costs
+    # about the same.
+    query = {
+        "order": request.GET.get("order", "id"),
+        "status": None,
+        "destination": request.GET.get("destination"),
+    }
+
+    if query["order"] not in listing.ORDERINGS:
+        return base_helpers.create_json_response(
+            success=False,
+            message="order must be one of {}".format(
+                ", ".join(listing.ORDERINGS)),
+            status=400,
+        )
+
+    if "status" in request.GET:
+        status = request.GET["status"]
+        if (not base_helpers.validate_positive_int(
+                status, include_zero=True) or
+                int(status) not in Order.STATUS_FLOW):
+            return base_helpers.create_json_response(
+                success=False,
+                message="Bad status",
+                status=400,
+            )
+        query["status"] = int(status)
+
+    max_size = getattr(settings, "ORDERS_MAX_PAGE_SIZE", 500)
+    size = request.GET.get("page_size")
+    if size is None:
+        size = getattr(settings, "ORDERS_PAGE_SIZE", 100)
+    elif base_helpers.validate_positive_int(size):
+        size = int(size)
+    else:
+        return base_helpers.create_json_response(
+            success=False,
+            message="Bad page_size",
+            status=400,
+        )
+
+    after = None
+    if "cursor" in request.GET:
+        after = listing.decode_cursor(request.GET["cursor"], query)
+        if after is None:
+            return base_helpers.create_json_response(
+                success=False,
+                message="Bad cursor, or not one for these filters",
+                status=400,
+            )
+
+    orders, after = listing.list_orders(query, after, min(size, max_size))
+
     return base_helpers.create_json_response(
-        data={"status": order.status}
+        data={
+            "orders": orders,
+            "next_cursor": (listing.encode_cursor(query, after)
+                            if after is not None else None),
+        }
     )
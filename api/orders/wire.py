@@ -0,0 +1,542 @@
+import datetime
+import functools
+import json
+import logging
+import struct
+
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_datetime
+
+import base.helpers as base_helpers
+
+logger = logging.getLogger(__name__)
+
+# The binary format of the orders endpoints, for clients that cannot
+# afford to parse JSON. It is specified in docs/wire-format.md, which
+# must be kept in step with the layouts below. JSON stays the default:
+# requests are decoded from binary when sent with this Content-Type, and
+# responses are encoded to binary when it is in the Accept header.
+CONTENT_TYPE = "application/vnd.orders.v1"
+
+VERSION = 1
+
+# What follows the envelope header
+DATA_ABSENT = 0
+DATA_NULL = 1
+DATA_PRESENT = 2
+
+_HEADER = struct.Struct(">BBBH")
+_COUNT = struct.Struct(">I")
+_LENGTH = struct.Struct(">H")
+
+
+class WireError(ValueError):
+    pass
+
+
+class Scalar:
+    # A fixed size value, packed with the struct format character `code`
+
+    def __init__(self, code):
+        self.code = code
+
+    def to_wire(self, value):
+        return value
+
+    def from_wire(self, value):
+        return value
+
+
+class IntKey(Scalar):
+    # An integer that JSON has as a string, such as the keys of objects
+
+    def to_wire(self, value):
+        return int(value)
+
+    def from_wire(self, value):
+        return str(value)
+
+
+class Enum(Scalar):
+    # One of a few strings, sent as its index
+
+    def __init__(self, *choices):
+        super().__init__("B")
+        self.choices = choices
+
+    def to_wire(self, value):
+        try:
+            return self.choices.index(value)
+        except ValueError:
+            raise WireError("Unknown choice {!r}".format(value))
+
+    def from_wire(self, value):
+        try:
+            return self.choices[value]
+        except IndexError:
+            raise WireError("Unknown choice {}".format(value))
+
+
+class Timestamp(Scalar):
+    # An ISO 8601 date and time, sent as microseconds since the epoch
+
+    _EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def __init__(self):
+        super().__init__("q")
+
+    def to_wire(self, value):
+        moment = parse_datetime(value)
+        if moment is None or timezone.is_naive(moment):
+            raise WireError("Bad timestamp {!r}".format(value))
+
+        return (moment - self._EPOCH) // datetime.timedelta(microseconds=1)
+
+    def from_wire(self, value):
+        return (self._EPOCH + datetime.timedelta(microseconds=value)) \
+            .isoformat()
+
+
+class Str:
+    # UTF-8 text after its length in bytes
+    code = None
+
+    def encode(self, value, out):
+        if not isinstance(value, str):
+            raise WireError("Expected a string")
+
+        data = value.encode()
+        out.append(_LENGTH.pack(len(data)))
+        out.append(data)
+
+    def decode(self, buffer, offset):
+        length, = _LENGTH.unpack_from(buffer, offset)
+        offset += _LENGTH.size
+
+        data = bytes(buffer[offset:offset + length])
+        if len(data) != length:
+            raise WireError("Truncated string")
+
+        try:
+            return data.decode(), offset + length
+        except UnicodeDecodeError:
+            raise WireError("Bad UTF-8")
+
+
+class List:
+    # The number of items, then the items
+    code = None
+
+    def __init__(self, item):
+        self.item = item
+
+    def encode(self, value, out):
+        if not isinstance(value, list):
+            raise WireError("Expected a list")
+
+        out.append(_COUNT.pack(len(value)))
+
+        if self.item.code is not None:
+            out.append(struct.pack(
+                ">{}{}".format(len(value), self.item.code),
+                *[self.item.to_wire(item) for item in value]))
+            return
+
+        for item in value:
+            self.item.encode(item, out)
+
+    def decode(self, buffer, offset):
+        count, = _COUNT.unpack_from(buffer, offset)
+        offset += _COUNT.size
+
+        if self.item.code is not None:
+            items = struct.Struct(">{}{}".format(count, self.item.code))
+            values = items.unpack_from(buffer, offset)
+            return ([self.item.from_wire(value) for value in values],
+                    offset + items.size)
+
+        values = []
+        for _ in range(count):
+            value, offset = self.item.decode(buffer, offset)
+            values.append(value)
+
+        return values, offset
+
+
+class Map:
+    # The number of entries, then each entry as a record of its key and
+    # value
+    code = None
+
+    def __init__(self, key, value):
+        self.entry = Record(("key", key), ("value", value))
+
+    def encode(self, value, out):
+        if not isinstance(value, dict):
+            raise WireError("Expected an object")
+
+        out.append(_COUNT.pack(len(value)))
+        for key, entry_value in value.items():
+            self.entry.encode({"key": key, "value": entry_value}, out)
+
+    def decode(self, buffer, offset):
+        count, = _COUNT.unpack_from(buffer, offset)
+        offset += _COUNT.size
+
+        values = {}
+        for _ in range(count):
+            entry, offset = self.entry.decode(buffer, offset)
+            values[entry["key"]] = entry["value"]
+
+        return values, offset
+
+
+OPTIONAL = "optional"
+# An optional field that JSON has as null when absent
+NULLABLE = "nullable"
+
+
+class Record:
+    # A JSON object with known keys. The fixed size fields are packed
+    # together first, after a bitmap of the optional fields that are
+    # present, then come the other fields in order. Absent fields are sent
+    # as zeros if fixed size, and left out otherwise.
+    code = None
+
+    def __init__(self, *fields):
+        self.fields = [
+            (field[0], field[1],
+             OPTIONAL in field[2:] or NULLABLE in field[2:])
+            for field in fields
+        ]
+        self.optional = [name for name, _, optional in self.fields
+                         if optional]
+        self.nullable = [field[0] for field in fields
+                         if NULLABLE in field[2:]]
+        self.fixed = [(name, type_) for name, type_, _ in self.fields
+                      if type_.code is not None]
+        self.variable = [(name, type_) for name, type_, _ in self.fields
+                         if type_.code is None]
+
+        if len(self.optional) > 16:
+            raise ValueError("Too many optional fields")
+
+        self.bitmap = ("" if not self.optional else
+                       "B" if len(self.optional) <= 8 else "H")
+        self._struct = struct.Struct(">" + self.bitmap + "".join(
+            type_.code for _, type_ in self.fixed))
+
+    def _present(self, name, present):
+        if name not in self.optional:
+            return True
+
+        return bool(present & 1 << self.optional.index(name))
+
+    def encode(self, value, out):
+        if not isinstance(value, dict):
+            raise WireError("Expected an object")
+
+        present = 0
+        for bit, name in enumerate(self.optional):
+            if name in value and (value[name] is not None or
+                                  name not in self.nullable):
+                present |= 1 << bit
+
+        fixed = [present] if self.bitmap else []
+        for name, type_ in self.fixed:
+            if self._present(name, present):
+                if name not in value:
+                    raise WireError("Missing {}".format(name))
+                fixed.append(type_.to_wire(value[name]))
+            else:
+                fixed.append(0)
+
+        out.append(self._struct.pack(*fixed))
+
+        for name, type_ in self.variable:
+            if self._present(name, present):
+                if name not in value:
+                    raise WireError("Missing {}".format(name))
+                type_.encode(value[name], out)
+
+    def decode(self, buffer, offset):
+        fixed = list(self._struct.unpack_from(buffer, offset))
+        offset += self._struct.size
+
+        present = fixed.pop(0) if self.bitmap else 0
+        if present >> len(self.optional):
+            raise WireError("Unknown optional fields")
+
+        values = {}
+        for (name, type_), value in zip(self.fixed, fixed):
+            if self._present(name, present):
+                values[name] = type_.from_wire(value)
+
+        for name, type_ in self.variable:
+            if self._present(name, present):
+                values[name], offset = type_.decode(buffer, offset)
+
+        for name in self.nullable:
+            values.setdefault(name, None)
+
+        # Keep the declared order, like the JSON objects
+        return {name: values[name] for name, _, _ in self.fields
+                if name in values}, offset
+
+
+def _encode(layout, value, out):
+    try:
+        if layout.code is not None:
+            out.append(struct.pack(">" + layout.code, layout.to_wire(value)))
+        else:
+            layout.encode(value, out)
+    except struct.error as e:
+        raise WireError(str(e))
+
+
+def _decode(layout, buffer, offset):
+    try:
+        if layout.code is not None:
+            value, = struct.unpack_from(">" + layout.code, buffer, offset)
+            return (layout.from_wire(value),
+                    offset + struct.calcsize(">" + layout.code))
+
+        return layout.decode(buffer, offset)
+    except struct.error:
+        raise WireError("Truncated body")
+
+
+def encode_body(layout, data):
+    out = []
+    _encode(layout, data, out)
+    return b"".join(out)
+
+
+def decode_body(layout, body):
+    buffer = memoryview(body)
+    data, offset = _decode(layout, buffer, 0)
+
+    if offset != len(buffer):
+        raise WireError("Unexpected bytes after the body")
+
+    return data
+
+
+def encode_response(layout, payload):
+    # Encodes the envelope of create_json_response
+    message = payload["message"].encode()
+
+    if "data" not in payload:
+        data_kind = DATA_ABSENT
+    elif payload["data"] is None:
+        data_kind = DATA_NULL
+    else:
+        data_kind = DATA_PRESENT
+
+    try:
+        header = _HEADER.pack(
+            VERSION, payload["success"], data_kind, len(message))
+    except struct.error as e:
+        raise WireError(str(e))
+
+    out = [header, message]
+    if data_kind == DATA_PRESENT:
+        if layout is None:
+            raise WireError("This endpoint returns no data")
+        _encode(layout, payload["data"], out)
+
+    return b"".join(out)
+
+
+def decode_response(layout, content):
+    buffer = memoryview(content)
+
+    try:
+        version, success, data_kind, length = _HEADER.unpack_from(buffer)
+    except struct.error:
+        raise WireError("Truncated header")
+
+    if version != VERSION:
+        raise WireError("Unknown version {}".format(version))
+
+    offset = _HEADER.size + length
+    payload = {
+        "message": bytes(buffer[_HEADER.size:offset]).decode(),
+        "success": bool(success),
+    }
+
+    if data_kind == DATA_NULL:
+        payload["data"] = None
+    elif data_kind == DATA_PRESENT:
+        payload["data"], offset = _decode(layout, buffer, offset)
+
+    if offset != len(buffer):
+        raise WireError("Unexpected bytes after the body")
+
+    return payload
+
+
+def accepts_binary(request):
+    return any(
+        media_type.split(";")[0].strip() == CONTENT_TYPE
+        for media_type in request.META.get("HTTP_ACCEPT", "").split(","))
+
+
+def _encode_binary(layout, response):
+    # Returns the binary form of a JSON response. A payload the layout
+    # cannot hold, such as an out of range number, is a bug in the view or
+    # the layout. The client gets a 406 in JSON, and can ask for JSON.
+    try:
+        content = encode_response(layout, response.payload)
+    except WireError as e:
+        logger.exception("Cannot encode the response in %s", CONTENT_TYPE)
+        return base_helpers.create_json_response(
+            success=False,
+            message="The response cannot be sent as {}: {}".format(
+                CONTENT_TYPE, e),
+            status=406,
+        )
+
+    binary_response = HttpResponse(
+        content, status=response.status_code, content_type=CONTENT_TYPE)
+
+    for header, value in response.items():
+        if header.lower() != "content-type":
+            binary_response[header] = value
+
+    return binary_response
+
+
+def negotiate(request_layout=None, response_layout=None):
+    # Lets a JSON view also speak the binary format. A binary body is
+    # decoded and handed to the view as JSON, and the view's response is
+    # encoded if the client accepts it.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = None
+
+            if (request_layout is not None and
+                    request.content_type == CONTENT_TYPE and request.body):
+                try:
+                    data = decode_body(request_layout, request.body)
+                except WireError as e:
+                    response = base_helpers.create_json_response(
+                        success=False,
+                        message="Bad binary body: {}".format(e),
+                        status=400,
+                    )
+                else:
+                    request._body = json.dumps(data).encode()
+
+            if response is None:
+                response = view(request, *args, **kwargs)
+
+            if accepts_binary(request) and hasattr(response, "payload"):
+                response = _encode_binary(response_layout, response)
+
+            patch_vary_headers(response, ["Accept"])
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+ORDER = Record(
+    ("id", Scalar("Q")),
+    ("destination", Str()),
+    ("color", Scalar("H")),
+    ("status", Scalar("B")),
+)
+
+CLAIMED_ORDER = Record(
+    ("id", Scalar("Q")),
+    ("destination", Str()),
+    ("color", Scalar("H")),
+    ("status", Scalar("B")),
+    ("lease_token", Scalar("I")),
+)
+
+QUEUE = Record(
+    ("destination", Str(), OPTIONAL),
+    ("color", Scalar("H"), OPTIONAL),
+    ("wait", Scalar("d"), OPTIONAL),
+)
+
+TRIP = Record(
+    ("destination", Str(), OPTIONAL),
+    ("color", Scalar("H"), OPTIONAL),
+    ("wait", Scalar("d"), OPTIONAL),
+    ("size", Scalar("H"), OPTIONAL),
+    ("strategy", Enum("oldest", "largest"), OPTIONAL),
+)
+
+CLAIMED_TRIP = Record(
+    ("destination", Str()),
+    ("orders", List(CLAIMED_ORDER)),
+)
+
+NEW_ORDER = Record(
+    ("destination", Str()),
+    ("color", Scalar("H")),
+)
+
+NEW_ORDERS = List(NEW_ORDER)
+
+CREATED_ORDER = Record(
+    ("id", Scalar("Q")),
+)
+
+CREATED_ORDERS = List(Record(
+    ("id", Scalar("Q"), OPTIONAL),
+    ("error", Str(), OPTIONAL),
+))
+
+UPDATE = Record(
+    ("id", Scalar("Q")),
+    ("new_status", Scalar("B"), OPTIONAL),
+    ("extend_lease", Scalar("?"), OPTIONAL),
+    ("lease_token", Scalar("I"), OPTIONAL),
+)
+
+LEASE = Record(
+    ("lease_expires_at", Timestamp()),
+    ("lease_token", Scalar("I")),
+)
+
+STATUS_QUERY = Record(
+    ("id", Scalar("Q"), OPTIONAL),
+    ("ids", List(Scalar("Q")), OPTIONAL),
+)
+
+STATUSES = Record(
+    ("status", Scalar("B"), OPTIONAL),
+    ("statuses", Map(IntKey("Q"), Scalar("B")), OPTIONAL),
+    ("missing", List(Scalar("Q")), OPTIONAL),
+)
+
+ORDER_STATE = Record(
+    ("id", Scalar("Q")),
+    ("status", Scalar("B")),
+    ("version", Scalar("I")),
+)
+
+QUEUE_DEPTHS = List(Record(
+    ("destination", Str()),
+    ("color", Scalar("H")),
+    ("pending", Scalar("Q")),
+    ("oldest_id", Scalar("Q")),
+))
+
+STATS = Record(
+    ("by_status", Map(IntKey("B"), Scalar("Q"))),
+    ("by_destination", Map(Str(), Scalar("Q"))),
+)
+
+ORDER_PAGE = Record(
+    ("orders", List(ORDER)),
+    ("next_cursor", Str(), NULLABLE),
+)